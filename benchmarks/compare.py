@@ -0,0 +1,47 @@
+"""
+    Compare two benchmarks/throughput.py result files, e.g. of two commits:
+
+        python benchmarks/compare.py base.json new.json
+"""
+import json
+from argparse import ArgumentParser
+
+
+def change(base, new):
+    if base is None or new is None or base == 0:
+        return '-'
+    return f'{100 * (new - base) / base:+.1f}%'
+
+
+def fmt(value):
+    return '-' if value is None else f'{value:.3g}'
+
+
+def main():
+    parser = ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('base', type=str, help='Reference results')
+    parser.add_argument('new', type=str, help='Results to compare with the reference')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base.get('commit')} ({base.get('time')}) vs new {new.get('commit')} ({new.get('time')})")
+
+    for mode in sorted(set(base['results']) & set(new['results'])):
+        b, n = base['results'][mode], new['results'][mode]
+        if 'ligands_per_hour' not in b or 'ligands_per_hour' not in n:
+            print(f'\n{mode}: not comparable ({b.get("skipped") or b.get("failed") or n.get("skipped") or n.get("failed")})')
+            continue
+        print(f"\n{mode}: {fmt(b['ligands_per_hour'])} -> {fmt(n['ligands_per_hour'])} ligands/hour ({change(b['ligands_per_hour'], n['ligands_per_hour'])}), "
+              f"peak RSS {fmt(b['peak_rss_mb'])} -> {fmt(n['peak_rss_mb'])} MB")
+        print(f"  {'stage':<16}{'p50 base':>10}{'p50 new':>10}{'change':>10}{'p90 base':>10}{'p90 new':>10}{'change':>10}")
+        for stage in sorted(set(b['stages']) | set(n['stages'])):
+            bs, ns = b['stages'].get(stage, {}), n['stages'].get(stage, {})
+            print(f"  {stage:<16}{fmt(bs.get('p50')):>10}{fmt(ns.get('p50')):>10}{change(bs.get('p50'), ns.get('p50')):>10}"
+                  f"{fmt(bs.get('p90')):>10}{fmt(ns.get('p90')):>10}{change(bs.get('p90'), ns.get('p90')):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+    Parity and speed of models/inference_model.py's InferenceScoreModel against the eager TensorProductScoreModel.
+
+        python -m benchmarks.compiled_model                   # compiled core, CPU (not used by inference.py)
+        python -m benchmarks.compiled_model --cuda --out compiled.json
+        python -m benchmarks.compiled_model --no_compile      # only the graph / core split, eagerly
+
+    The bundled ligands are featurised against --protein_path (with zero ESM embeddings), randomised as in inference.py
+    and run through both models at several diffusion times and batch sizes. Every output has to match the eager one
+    within --atol + --rtol * |eager|, the script exits with an error otherwise. Without a workdir the score model is
+    a randomly initialised one of the released architecture, which is enough to check the numerics.
+"""
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from functools import partial
+
+import numpy as np
+
+from benchmarks.throughput import BUNDLED_LIGANDS, DEFAULT_MODEL_PARAMETERS, build_dataset, load_model_parameters, \
+    seed_everything, write_zero_embeddings
+
+# architecture of the released score model, used with random weights when the workdir is not there
+DEFAULT_SCORE_MODEL_PARAMETERS = dict(DEFAULT_MODEL_PARAMETERS, embedding_type='sinusoidal', sigma_embed_dim=32,
+                                      embedding_scale=1000, esm_embeddings_path='esm', no_torsion=False,
+                                      num_conv_layers=6, max_radius=5, scale_by_sigma=True, ns=48, nv=10,
+                                      distance_embed_dim=64, cross_distance_embed_dim=64, no_batch_norm=False,
+                                      dropout=0.0, use_second_order_repr=False, cross_max_distance=80,
+                                      dynamic_max_cross=True, tr_sigma_min=0.1, tr_sigma_max=19, rot_sigma_min=0.03,
+                                      rot_sigma_max=1.55, tor_sigma_min=0.0314, tor_sigma_max=3.14,
+                                      res_tr_sigma_min=0.01, res_tr_sigma_max=1, res_rot_sigma_min=0.01,
+                                      res_rot_sigma_max=1, res_chi_sigma_min=0.01, res_chi_sigma_max=1)
+OUTPUTS = ['lddt', 'affinity', 'tr', 'rot', 'tor', 'res_tr', 'res_rot', 'res_chi']
+
+
+def timed(function, repeats, device):
+    import torch
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        outputs = function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return outputs, times
+
+
+def main():
+    parser = ArgumentParser(description='Parity and speed of the compiled inference score model')
+    parser.add_argument('--protein_path', type=str, default='data/1qg8_cleaned.pdb', help='Receptor used for all ligands')
+    parser.add_argument('--model_dir', type=str, default='workdir/big_score_model_sanyueqi_with_time', help='Score model directory')
+    parser.add_argument('--ckpt', type=str, default='ema_inference_epoch314_model.pt', help='Score model checkpoint')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='Batch sizes to check')
+    parser.add_argument('--times', type=float, nargs='+', default=[1.0, 0.5, 0.05], help='Diffusion times to check')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed forward passes per configuration')
+    parser.add_argument('--atol', type=float, default=1e-4, help='Absolute tolerance of the parity check')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='Relative tolerance of the parity check')
+    parser.add_argument('--no_compile', action='store_true', default=False, help='Run the numeric core eagerly')
+    parser.add_argument('--compile_cache', type=str, default=None, help='Compile cache directory (see models/inference_model.py)')
+    parser.add_argument('--cuda', action='store_true', default=False, help='Run on the GPU')
+    parser.add_argument('--cores', '-c', type=int, default=1, help='CPU cores to use')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the weights, conformers and positions')
+    parser.add_argument('--out', type=str, default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    import torch
+    from torch_geometric.data import Batch
+    from torch_geometric.loader import DataLoader
+    from models.inference_model import InferenceScoreModel
+    from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl, set_time
+    from utils.sampling import randomize_position
+    from utils.utils import get_model
+
+    torch.set_num_threads(args.cores)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    model_args = load_model_parameters(args.model_dir)
+    weights = 'checkpoint' if model_args is not None else 'random'
+    model_args = model_args or Namespace(**DEFAULT_SCORE_MODEL_PARAMETERS)
+
+    seed_everything(args.seed)
+    t_to_sigma = partial(t_to_sigma_compl, args=model_args)
+    model = get_model(model_args, device, t_to_sigma=t_to_sigma, no_parallel=True)
+    if weights == 'checkpoint':
+        model.load_state_dict(torch.load(os.path.join(args.model_dir, args.ckpt), map_location=torch.device('cpu')), strict=True)
+    model = model.to(device).eval()
+    wrapped = InferenceScoreModel(model, compile=not args.no_compile, cache_dir=args.compile_cache, compile_on_cpu=not args.cuda)
+
+    work_dir = tempfile.mkdtemp(prefix='dynamicbind_compiled_')
+    results, failures = [], 0
+    try:
+        os.makedirs(os.path.join(work_dir, 'esm'))
+        write_zero_embeddings(args.protein_path, os.path.join(work_dir, 'esm'))
+        names = [f'bench_{i}' for i in range(len(BUNDLED_LIGANDS))]
+        dataset = build_dataset(args, work_dir, 'cache', BUNDLED_LIGANDS, names, model_args, None)
+        for complex_graph in DataLoader(dataset=dataset, batch_size=1, shuffle=False):
+            for batch_size in args.batch_sizes:
+                data_list = [copy.deepcopy(complex_graph) for _ in range(batch_size)]
+                randomize_position(data_list, model_args.no_torsion, False, model_args.tr_sigma_max, model_args.rot_sigma_max,
+                                   model_args.tor_sigma_max, model_args.res_tr_sigma_max, model_args.res_rot_sigma_max)
+                for t in args.times:
+                    batch = Batch.from_data_list(data_list).to(device)
+                    set_time(batch, t, t, t, t, t, t, batch_size, model_args.all_atoms, device)
+                    with torch.no_grad():
+                        eager, eager_times = timed(lambda: model(batch), args.repeats, device)
+                    start = time.perf_counter()
+                    wrapped(batch)  # compiles (or loads from the cache) the first time a configuration is seen
+                    first_call = time.perf_counter() - start
+                    outputs, wrapped_times = timed(lambda: wrapped(batch), args.repeats, device)
+
+                    errors = {}
+                    for name, a, b in zip(OUTPUTS, outputs, eager):
+                        difference = (a.float() - b.float()).abs()
+                        errors[name] = float(difference.max()) if difference.numel() else 0.
+                        if difference.numel() and bool((difference > args.atol + args.rtol * b.float().abs()).any()):
+                            failures += 1
+                            print(f'PARITY FAILURE {complex_graph.name[0]} batch {batch_size} t={t} {name}: max error {errors[name]:.3g}')
+                    entry = {'complex': complex_graph.name[0], 'batch_size': batch_size, 't': t,
+                             'eager_ms': 1000 * float(np.median(eager_times)),
+                             'wrapped_ms': 1000 * float(np.median(wrapped_times)),
+                             'first_call_s': first_call, 'max_error': errors}
+                    results.append(entry)
+                    print(f"{complex_graph.name[0]:<10} batch {batch_size:>3} t={t:<5} eager {entry['eager_ms']:8.1f} ms  "
+                          f"{'compiled' if wrapped.compiled else 'eager core'} {entry['wrapped_ms']:8.1f} ms  "
+                          f"first call {first_call:6.2f} s  max error {max(errors.values()):.2e}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print('All outputs match the eager model' if not failures else f'{failures} outputs differ from the eager model')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'device': device.type, 'weights': weights, 'compiled': wrapped.compiled, 'torch': torch.__version__,
+                       'config': vars(args), 'results': results, 'failures': failures}, f, indent=2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+    Start-up time of the entry points and import-time profile of the library modules.
+
+    Every entry is run in a fresh interpreter, a few times, from the repository root:
+
+        python -m benchmarks.imports                   # table of start-up times
+        python -m benchmarks.imports --top 15          # plus the slowest imports of every module (python -X importtime)
+        python -m benchmarks.imports --out imports.json
+
+    Scripts are started with --help (or on an empty results directory), which measures what a job pays before it
+    does any work. Modules are imported on their own, which shows what a script pays for importing them.
+"""
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+# (name, command line arguments of the interpreter), {empty} is replaced by an empty directory
+SCRIPTS = [
+    ('python', ['-c', 'pass']),
+    ('inferenceVS.py --help', ['inferenceVS.py', '--help']),
+    ('inference.py --help', ['inference.py', '--help']),
+    ('summarize_results.py', ['summarize_results.py', '{empty}']),
+    ('summarize_metrics.py', ['summarize_metrics.py', '{empty}']),
+    ('relaunchFailedCompounds.py', ['relaunchFailedCompounds.py', '{empty}']),
+    ('movie_generation.py --help', ['movie_generation.py', '--help']),
+]
+MODULES = ['utils.metrics', 'utils.journal', 'utils.so3', 'utils.torus', 'utils.clash', 'utils.visualise',
+           'utils.trajectory', 'utils.diffusion_utils', 'utils.sampling', 'utils.utils', 'datasets.process_mols',
+           'datasets.pdbbind']
+
+
+def run(arguments, repeats):
+    times, process = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable] + arguments, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+    return times, process
+
+
+def parse_importtime(stderr):
+    """(module, self seconds, cumulative seconds) of every line of the python -X importtime output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|', 2)
+        imports.append((module.rstrip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return imports
+
+
+def main():
+    parser = ArgumentParser(description='Start-up time of the scripts and import time of the library modules')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per entry, the median is reported')
+    parser.add_argument('--top', type=int, default=0, help='Also list the N slowest direct imports of every module')
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='Modules to profile')
+    parser.add_argument('--no_scripts', action='store_true', default=False, help='Only profile the modules')
+    parser.add_argument('--out', type=str, default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {'scripts': [], 'modules': []}
+    with tempfile.TemporaryDirectory() as empty:
+        print(f"{'entry point':<40}{'median s':>10}{'min s':>10}  status")
+        for name, arguments in ([] if args.no_scripts else SCRIPTS):
+            times, process = run([a.replace('{empty}', empty) for a in arguments], args.repeats)
+            entry = {'name': name, 'median': statistics.median(times), 'min': min(times), 'returncode': process.returncode}
+            results['scripts'].append(entry)
+            print(f"{name:<40}{entry['median']:>10.3f}{entry['min']:>10.3f}  {'ok' if process.returncode == 0 else 'exit ' + str(process.returncode)}")
+
+        print(f"\n{'module':<40}{'median s':>10}{'min s':>10}  status")
+        for module in args.modules:
+            times, process = run(['-X', 'importtime', '-c', f'import {module}'], args.repeats)
+            entry = {'name': module, 'median': statistics.median(times), 'min': min(times), 'returncode': process.returncode}
+            if process.returncode != 0:
+                entry['error'] = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else ''
+            else:
+                imports = parse_importtime(process.stderr)
+                # the direct imports of the module are the lines indented by one level under it
+                direct = [(m.strip(), s, c) for m, s, c in imports if m.startswith('   ') and not m.startswith('    ')]
+                entry['slowest'] = [{'module': m, 'cumulative': c} for m, _, c in sorted(direct, key=lambda x: -x[2])[:args.top]]
+            results['modules'].append(entry)
+            print(f"{module:<40}{entry['median']:>10.3f}{entry['min']:>10.3f}  {'ok' if process.returncode == 0 else entry['error']}")
+            for slow in entry.get('slowest', []):
+                print(f"    {slow['module']:<36}{slow['cumulative']:>10.3f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(dict(results, time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=sys.version.split()[0]), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,482 @@
+"""
+    Microbenchmarks and numerical parity checks of the geometry hot kernels.
+
+    Every kernel runs on random ligand / receptor inputs at a few sizes. Its output is compared with the plain
+    implementation in benchmarks/reference.py and it is timed, on the CPU and optionally on CUDA. Run from the
+    repository root:
+
+        python -m benchmarks.kernels                    # all kernels, CPU
+        python -m benchmarks.kernels --kernels modify_pdb get_calpha_neighbors --cuda --out kernels.json
+        python -m benchmarks.kernels --parity_only      # exits with 1 if a kernel does not match its reference
+
+    Use it before and after replacing one of these kernels with a faster version: the parity check has to pass, and
+    the timings of two runs can be compared.
+"""
+import json
+import string
+import sys
+import time
+import zlib
+from argparse import ArgumentParser
+
+import numpy as np
+
+from benchmarks import reference
+
+RECEPTOR_TEMPLATE = 'data/1opl_P16_A_aligned_to_P00519.pdb'
+
+
+class Kernel:
+    """
+    make(size, rng, device) builds the inputs, run(inputs) calls the kernel of the tree and reference(inputs) the one
+    of benchmarks/reference.py. Both return arrays (or tuples of arrays) that have to agree within atol. make is
+    called again for every use, with the same seed, so kernels are free to modify their inputs in place.
+    """
+
+    def __init__(self, name, unit, sizes, make, run, ref, atol, devices=('cpu',), compare=None):
+        self.name = name
+        self.unit = unit
+        self.sizes = sizes
+        self.make = make
+        self.run = run
+        self.reference = ref
+        self.atol = atol
+        self.devices = devices
+        self.compare = compare or max_abs_error
+
+
+def as_numpy(x):
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=np.float64) if np.asarray(x).dtype != bool else np.asarray(x)
+
+
+def max_abs_error(out, ref):
+    """Largest absolute difference over all outputs, inf when the shapes differ"""
+    out = out if isinstance(out, tuple) else (out,)
+    ref = ref if isinstance(ref, tuple) else (ref,)
+    if len(out) != len(ref):
+        return float('inf')
+    error = 0.
+    for o, r in zip(out, ref):
+        o, r = as_numpy(o), as_numpy(r)
+        if o.shape != r.shape:
+            return float('inf')
+        if o.size:
+            error = max(error, float(np.abs(o.astype(np.float64) - r.astype(np.float64)).max()))
+    return error
+
+
+def random_rotations(rng, n, max_angle=np.pi):
+    axis = rng.normal(size=(n, 3))
+    axis /= np.linalg.norm(axis, axis=1, keepdims=True)
+    return axis * rng.uniform(0, max_angle, size=(n, 1))
+
+
+def random_ligand(num_atoms, rng):
+    """
+    Random tree shaped ligand with 1.5 A bonds. Returns the positions, the bonds as (parent, child), and for every
+    bond whose child has children of its own the atoms it rotates, like get_transformation_mask.
+    """
+    parent = np.r_[-1, [rng.integers(max(0, i - 3), i) for i in range(1, num_atoms)]]
+    directions = rng.normal(size=(num_atoms, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    pos = np.zeros((num_atoms, 3))
+    for i in range(1, num_atoms):
+        pos[i] = pos[parent[i]] + 1.5 * directions[i]
+    subtree = np.eye(num_atoms, dtype=bool)
+    for i in range(num_atoms - 1, 0, -1):
+        subtree[parent[i]] |= subtree[i]
+    bonds = np.stack([parent[1:], np.arange(1, num_atoms)], axis=1)
+    rotatable = subtree[bonds[:, 1]].sum(axis=1) > 1
+    return pos - pos.mean(axis=0), bonds, rotatable, subtree[bonds[rotatable, 1]]
+
+
+def random_backbone(num_residues, rng):
+    """C-alpha trace of ~3.8 A steps folded into a globule, with N and C atoms around every C-alpha"""
+    c_alpha = np.zeros((num_residues, 3))
+    radius = 3 * num_residues ** (1 / 3) + 5
+    for i in range(1, num_residues):
+        while True:
+            step = rng.normal(size=3)
+            # not exactly 3.8, neighbours at exactly the same distance could be cut to max_neighbor in any order
+            candidate = c_alpha[i - 1] + rng.uniform(3.75, 3.85) * step / np.linalg.norm(step)
+            if np.linalg.norm(candidate) < radius:
+                break
+        c_alpha[i] = candidate
+    directions = rng.normal(size=(2, num_residues, 3))
+    directions /= np.linalg.norm(directions, axis=2, keepdims=True)
+    return c_alpha, c_alpha + 1.46 * directions[0], c_alpha + 1.52 * directions[1]
+
+
+def receptor_structure(num_residues):
+    """The bundled receptor, tiled over extra chains or cut, so it has num_residues amino acids with N, CA and C"""
+    from Bio.PDB import PDBParser
+    from Bio.PDB.Chain import Chain
+    template = PDBParser(QUIET=True).get_structure('template', RECEPTOR_TEMPLATE)[0]
+    residues = [res for res in template.get_residues() if res.resname != 'HOH' and all(a in res for a in ('N', 'CA', 'C'))]
+    for chain in list(template):
+        template.detach_child(chain.id)
+    for k in range(int(np.ceil(num_residues / len(residues)))):
+        chain = Chain(string.ascii_uppercase[k % 26] + (str(k // 26) if k >= 26 else ''))
+        for res in residues[:num_residues - k * len(residues)]:
+            res = res.copy()
+            for atom in res:
+                atom.set_coord(atom.coord + np.array([80. * k, 0, 0], dtype=np.float32))
+            chain.add(res)
+        template.add(chain)
+    return template
+
+
+# modify_conformer_torsion_angles
+
+
+def make_torsions(size, rng, device):
+    import torch
+    pos, bonds, rotatable, mask_rotate = random_ligand(size, rng)
+    updates = rng.uniform(-np.pi, np.pi, size=len(mask_rotate))
+    return dict(pos=torch.tensor(pos, dtype=torch.float32, device=device), edge_index=torch.from_numpy(bonds[rotatable]),
+                mask_rotate=mask_rotate, torsion_updates=updates)
+
+
+def run_torsions(x):
+    from utils.torsion import modify_conformer_torsion_angles
+    return modify_conformer_torsion_angles(x['pos'], x['edge_index'], x['mask_rotate'], x['torsion_updates'])
+
+
+def ref_torsions(x):
+    return reference.torsion_angles(as_numpy(x['pos']), x['edge_index'].numpy(), x['mask_rotate'], x['torsion_updates'])
+
+
+# get_transformation_mask
+
+
+def make_transformation_mask(size, rng, device):
+    import torch
+    from rdkit import Chem
+    from torch_geometric.data import HeteroData
+    from benchmarks.throughput import synthetic_ligands
+    mol = Chem.AddHs(Chem.MolFromSmiles(synthetic_ligands(1, size, int(rng.integers(2 ** 31)))[0]))
+    bond_types = {Chem.BondType.SINGLE: 0, Chem.BondType.DOUBLE: 1, Chem.BondType.TRIPLE: 2, Chem.BondType.AROMATIC: 3}
+    edge_index, edge_attr = [], []
+    for bond in mol.GetBonds():
+        u, v = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        edge_index += [[u, v], [v, u]]
+        edge_attr += 2 * [np.eye(4)[bond_types[bond.GetBondType()]]]
+    data = HeteroData()
+    data['ligand'].x = torch.zeros(mol.GetNumAtoms(), 1)
+    data['ligand', 'lig_bond', 'ligand'].edge_index = torch.tensor(edge_index, dtype=torch.long).T
+    data['ligand', 'lig_bond', 'ligand'].edge_attr = torch.tensor(np.array(edge_attr), dtype=torch.float)
+    return dict(data=data)
+
+
+def run_transformation_mask(x):
+    from utils.torsion import get_transformation_mask
+    return get_transformation_mask(x['data'])
+
+
+def ref_transformation_mask(x):
+    return reference.transformation_mask(x['data'])
+
+
+# axis_angle_to_matrix
+
+
+def make_axis_angle(size, rng, device):
+    import torch
+    return dict(axis_angle=torch.tensor(random_rotations(rng, size), dtype=torch.float32, device=device))
+
+
+def run_axis_angle(x):
+    from utils.geometry import axis_angle_to_matrix
+    return axis_angle_to_matrix(x['axis_angle'])
+
+
+def ref_axis_angle(x):
+    return reference.axis_angle_to_matrix(as_numpy(x['axis_angle']))
+
+
+# rigid_transform_Kabsch_3D_torch
+
+
+def make_kabsch(size, rng, device):
+    import torch
+    B = rng.normal(scale=5., size=(3, size))
+    rot = reference.axis_angle_to_matrix(random_rotations(rng, 1))[0]
+    A = rot.T @ (B + rng.normal(scale=0.3, size=B.shape)) + rng.normal(scale=10., size=(3, 1))
+    return dict(A=torch.tensor(A, dtype=torch.float32, device=device), B=torch.tensor(B, dtype=torch.float32, device=device))
+
+
+def run_kabsch(x):
+    from utils.geometry import rigid_transform_Kabsch_3D_torch
+    return rigid_transform_Kabsch_3D_torch(x['A'], x['B'])
+
+
+def ref_kabsch(x):
+    return reference.kabsch(as_numpy(x['A']), as_numpy(x['B']))
+
+
+# modify_conformer (one denoising update of the ligand and the receptor)
+
+
+def make_modify_conformer(size, rng, device):
+    import torch
+    from torch_geometric.data import HeteroData
+    num_residues = 10 * size
+    pos, bonds, rotatable, mask_rotate = random_ligand(size, rng)
+    edge_index = np.stack([bonds, bonds[:, ::-1]], axis=1).reshape(-1, 2)
+    edge_mask = np.stack([rotatable, np.zeros_like(rotatable)], axis=1).reshape(-1)
+    c_alpha, n, c = random_backbone(num_residues, rng)
+    chi_masks = (rng.random((num_residues, 7)) < 0.6).astype(np.float32)
+    data = HeteroData()
+    data['ligand'].pos = torch.tensor(pos, dtype=torch.float32, device=device)
+    data['ligand'].edge_mask = torch.from_numpy(edge_mask)
+    data['ligand'].mask_rotate = mask_rotate
+    data['ligand', 'lig_bond', 'ligand'].edge_index = torch.from_numpy(edge_index.T.copy())
+    data['receptor'].pos = torch.tensor(c_alpha, dtype=torch.float32, device=device)
+    data['receptor'].lf_3pts = torch.tensor(np.stack([n, c_alpha, c], axis=1), dtype=torch.float32, device=device)
+    data['receptor'].chis = torch.tensor(rng.uniform(0, 2 * np.pi, (num_residues, 7)) * chi_masks, dtype=torch.float32, device=device)
+    data['receptor'].chi_masks = torch.tensor(chi_masks, device=device)
+    data['receptor'].acc_pred_chis = torch.zeros(num_residues, 5, device=device)
+
+    def tensor(array):
+        return torch.tensor(array, dtype=torch.float32, device=device)
+    return dict(data=data, tr_update=tensor(rng.normal(size=(1, 3))), rot_update=tensor(random_rotations(rng, 1, 0.5)),
+                torsion_updates=rng.uniform(-0.5, 0.5, size=len(mask_rotate)),
+                res_tr_update=tensor(rng.normal(scale=0.3, size=(num_residues, 3))),
+                res_rot_update=tensor(random_rotations(rng, num_residues, 0.2)),
+                res_chi_update=tensor(rng.uniform(-0.5, 0.5, size=(num_residues, 5))))
+
+
+def modify_conformer_outputs(pos, lf_3pts, chis, acc_pred_chis):
+    # angles are compared on the unit circle, a torsion of 2 pi - eps matches one of 0
+    chis, acc_pred_chis = as_numpy(chis), as_numpy(acc_pred_chis)
+    return pos, lf_3pts, np.cos(chis), np.sin(chis), np.cos(acc_pred_chis), np.sin(acc_pred_chis)
+
+
+def run_modify_conformer(x):
+    from utils.diffusion_utils import modify_conformer
+    data = modify_conformer(x['data'], x['tr_update'], x['rot_update'], x['torsion_updates'], x['res_tr_update'],
+                            x['res_rot_update'], x['res_chi_update'])
+    return modify_conformer_outputs(data['ligand'].pos, data['receptor'].lf_3pts, data['receptor'].chis,
+                                    data['receptor'].acc_pred_chis)
+
+
+def ref_modify_conformer(x):
+    data = x['data']
+    torsion_edges = data['ligand', 'ligand'].edge_index.T[data['ligand'].edge_mask].numpy()
+    return modify_conformer_outputs(*reference.modify_conformer(
+        as_numpy(data['ligand'].pos), torsion_edges, data['ligand'].mask_rotate, as_numpy(data['receptor'].lf_3pts),
+        as_numpy(data['receptor'].chis), as_numpy(data['receptor'].chi_masks), as_numpy(data['receptor'].acc_pred_chis),
+        as_numpy(x['tr_update']), as_numpy(x['rot_update']), x['torsion_updates'], as_numpy(x['res_tr_update']),
+        as_numpy(x['res_rot_update']), as_numpy(x['res_chi_update'])))
+
+
+# modify_pdb / rotate_chi (rebuilding a receptor from the predicted frames and side chain torsions)
+
+
+def make_modify_pdb(size, rng, device):
+    from utils.visualise import complete_chi_bond_dict
+    structure = receptor_structure(size)
+    residues = list(structure.get_residues())
+    lf_3pts = np.array([[res['N'].coord, res['CA'].coord, res['C'].coord] for res in residues], dtype=np.float64)
+    original_center = lf_3pts[:, 1].mean(axis=0)
+    rot = reference.axis_angle_to_matrix(random_rotations(rng, size, 0.2))
+    lf_3pts = (lf_3pts - lf_3pts[:, [1]]) @ rot.transpose(0, 2, 1) + lf_3pts[:, [1]] - original_center
+    lf_3pts += rng.normal(scale=0.5, size=(size, 1, 3))
+    # like get_sidechain_torsion, only the torsions the residue type has are set
+    chi_masks = np.array([[complete_chi_bond_dict[f'chi{i + 1}'].get(res.resname) is not None for i in range(5)] for res in residues])
+    return dict(ppdb=structure, lf_3pts=lf_3pts.astype(np.float32), pred_chis=rng.uniform(0, 2 * np.pi, (size, 5)).astype(np.float16),
+                chi_masks=chi_masks, original_center=original_center.astype(np.float32))
+
+
+def structure_coords(ppdb):
+    return np.stack([atom.coord for atom in ppdb.get_atoms()])
+
+
+def run_modify_pdb(x):
+    from utils.visualise import modify_pdb_from_arrays
+    return structure_coords(modify_pdb_from_arrays(x['ppdb'], x['lf_3pts'], x['pred_chis'], x['chi_masks'], x['original_center']))
+
+
+def ref_modify_pdb(x):
+    return structure_coords(reference.modify_pdb(x['ppdb'], x['lf_3pts'], x['pred_chis'].astype(np.float32), x['chi_masks'], x['original_center']))
+
+
+# ReceptorTemplate (writing the receptor of every sample of a ligand, utils/pdb_writer.py)
+
+RECEPTOR_SAMPLES = 10
+
+
+def make_receptor_files(size, rng, device):
+    x = make_modify_pdb(size, rng, device)
+    samples = []
+    for _ in range(RECEPTOR_SAMPLES):
+        lf_3pts = x['lf_3pts'] + rng.normal(scale=0.2, size=x['lf_3pts'].shape[:1] + (1, 3)).astype(np.float32)
+        samples.append((lf_3pts, rng.uniform(0, 2 * np.pi, x['pred_chis'].shape).astype(np.float16), x['chi_masks'], x['original_center']))
+    return dict(ppdb=x['ppdb'], samples=samples)
+
+
+def run_receptor_files(x):
+    from utils.pdb_writer import ReceptorTemplate
+    from utils.visualise import modify_pdb_from_arrays
+    template = ReceptorTemplate(x['ppdb'])
+    files = []
+    for sample in x['samples']:
+        modify_pdb_from_arrays(x['ppdb'], *sample)
+        files.append(template.render())
+        template.reset()
+    return files
+
+
+def ref_receptor_files(x):
+    return reference.receptor_pdb_files(x['ppdb'], x['samples'])
+
+
+def same_files(out, ref):
+    return 0. if out == ref else float('inf')
+
+
+# compute_clash_score
+
+
+def make_clash(size, rng, device):
+    from scipy.spatial.distance import cdist
+    ligand, _, _, _ = random_ligand(size, rng)
+    receptor = rng.uniform(-15, 15, size=(50 * size, 3))
+    vdw = rng.choice([1.52, 1.55, 1.7, 1.8], size=len(receptor))[:, None] + rng.choice([1.47, 1.52, 1.55, 1.7], size=size)[None, :]
+    return dict(dis=cdist(receptor, ligand), base_vdw_dis=vdw)
+
+
+def run_clash(x):
+    from utils.clash import compute_clash_score
+    score, overlap, n_clash, n = compute_clash_score(x['dis'], x['base_vdw_dis'])
+    return score, np.sort(overlap), n_clash, n
+
+
+def ref_clash(x):
+    score, overlap, n_clash, n = reference.clash_score(x['dis'], x['base_vdw_dis'])
+    return score, np.sort(overlap), n_clash, n
+
+
+# get_calpha_neighbors (the residue graph of get_calpha_graph and get_fullrec_graph)
+
+
+def make_calpha(size, rng, device):
+    c_alpha, n, c = random_backbone(size, rng)
+    return dict(c_alpha_coords=c_alpha, n_coords=n, c_coords=c, cutoff=15, max_neighbor=24)
+
+
+def run_calpha(x):
+    from datasets.process_mols import get_calpha_neighbors
+    src, dst, mean_norms, lf_3pts = get_calpha_neighbors('bench', x['c_alpha_coords'], x['n_coords'], x['c_coords'],
+                                                         x['cutoff'], x['max_neighbor'])
+    return np.asarray([src, dst]), mean_norms, lf_3pts
+
+
+def ref_calpha(x):
+    return reference.calpha_neighbors(x['c_alpha_coords'], x['n_coords'], x['c_coords'], x['cutoff'], x['max_neighbor'])
+
+
+KERNELS = {kernel.name: kernel for kernel in [
+    Kernel('modify_conformer_torsion_angles', 'atoms', [16, 64, 256], make_torsions, run_torsions, ref_torsions, 1e-3),
+    Kernel('get_transformation_mask', 'heavy atoms', [16, 48, 128], make_transformation_mask, run_transformation_mask, ref_transformation_mask, 0),
+    Kernel('axis_angle_to_matrix', 'rotations', [100, 10000, 1000000], make_axis_angle, run_axis_angle, ref_axis_angle, 1e-5, ('cpu', 'cuda')),
+    Kernel('rigid_transform_Kabsch_3D_torch', 'points', [16, 256, 4096], make_kabsch, run_kabsch, ref_kabsch, 1e-3, ('cpu', 'cuda')),
+    Kernel('modify_conformer', 'atoms (10 residues per atom)', [16, 64, 256], make_modify_conformer, run_modify_conformer, ref_modify_conformer, 1e-3, ('cpu', 'cuda')),
+    Kernel('modify_pdb', 'residues', [50, 450, 1800], make_modify_pdb, run_modify_pdb, ref_modify_pdb, 1e-2),
+    Kernel('receptor_files', f'residues ({RECEPTOR_SAMPLES} samples)', [50, 450, 1800], make_receptor_files, run_receptor_files, ref_receptor_files, 0, compare=same_files),
+    Kernel('compute_clash_score', 'ligand atoms (50 receptor atoms per atom)', [16, 64, 256], make_clash, run_clash, ref_clash, 1e-6),
+    Kernel('get_calpha_neighbors', 'residues', [100, 800, 4000], make_calpha, run_calpha, ref_calpha, 1e-5),
+]}
+
+
+def make_inputs(kernel, size, device, seed):
+    # the same inputs for a kernel and size on every call and every device
+    rng = np.random.default_rng([seed, zlib.crc32(kernel.name.encode()), size])
+    return kernel.make(size, rng, device)
+
+
+def synchronize(device):
+    if device == 'cuda':
+        import torch
+        torch.cuda.synchronize()
+
+
+def time_kernel(kernel, size, device, seed, repeats):
+    # fresh inputs for every call, kernels that work in place are not timed on their own output
+    times = []
+    for i in range(repeats + 1):
+        inputs = make_inputs(kernel, size, device, seed)
+        synchronize(device)
+        start = time.perf_counter()
+        kernel.run(inputs)
+        synchronize(device)
+        if i:  # the first call is a warm up
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def check_parity(kernel, size, device, seed):
+    out = kernel.run(make_inputs(kernel, size, device, seed))
+    ref = kernel.reference(make_inputs(kernel, size, 'cpu', seed))
+    error = kernel.compare(out, ref)
+    return error, error <= kernel.atol
+
+
+def main():
+    parser = ArgumentParser(description='Microbenchmarks and parity checks of the geometry kernels')
+    parser.add_argument('--kernels', nargs='+', default=list(KERNELS), choices=list(KERNELS), help='Which kernels to run')
+    parser.add_argument('--sizes', nargs='+', type=int, default=None, help='Input sizes instead of the default ones of every kernel')
+    parser.add_argument('--repeats', type=int, default=10, help='Timed calls per kernel, size and device')
+    parser.add_argument('--cuda', action='store_true', default=False, help='Also time the torch kernels on the GPU')
+    parser.add_argument('--parity_only', action='store_true', default=False, help='Only check the outputs against the references')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random inputs')
+    parser.add_argument('--out', type=str, default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    devices = ['cpu']
+    if args.cuda:
+        import torch
+        if torch.cuda.is_available():
+            devices.append('cuda')
+        else:
+            print('CUDA is not available, only running on the CPU')
+
+    results, failed = [], []
+    print(f"{'kernel':<34}{'size':>9}{'device':>8}{'median ms':>12}{'min ms':>10}{'max error':>12}  parity")
+    for name in args.kernels:
+        kernel = KERNELS[name]
+        for size in args.sizes or kernel.sizes:
+            for device in [d for d in devices if d in kernel.devices]:
+                entry = {'kernel': name, 'size': size, 'unit': kernel.unit, 'device': device}
+                try:
+                    if device == 'cpu':
+                        entry['max_error'], entry['parity'] = check_parity(kernel, size, device, args.seed)
+                    if not args.parity_only:
+                        times = time_kernel(kernel, size, device, args.seed, args.repeats)
+                        entry['median_ms'], entry['min_ms'] = 1000 * float(np.median(times)), 1000 * min(times)
+                except ImportError as e:
+                    entry['skipped'] = str(e)
+                results.append(entry)
+                if entry.get('parity') is False:
+                    failed.append(f'{name} ({size} {kernel.unit})')
+                if 'skipped' in entry:
+                    print(f"{name:<34}{size:>9}{device:>8}  skipped: {entry['skipped']}")
+                    continue
+
+                def fmt(key, spec):
+                    return format(entry[key], spec) if key in entry else '-'
+                print(f"{name:<34}{size:>9}{device:>8}{fmt('median_ms', '.3f'):>12}{fmt('min_ms', '.3f'):>10}"
+                      f"{fmt('max_error', '.2e'):>12}  {'-' if 'parity' not in entry else 'ok' if entry['parity'] else 'FAILED'}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': vars(args), 'results': results}, f, indent=2)
+    if failed:
+        print('Outputs differ from the reference for: ' + ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+    Speed and accuracy of the reduced precision modes of utils/precision.py against fp32.
+
+        python -m benchmarks.precision                                   # fp32, bf16 and int8-dynamic on the CPU
+        python -m benchmarks.precision --cuda --precisions fp32 bf16 fp16 --out precision.json
+
+    The bundled ligands are featurised against --protein_path (with zero ESM embeddings) and compared in two ways:
+    single forward passes of the score model at several diffusion times (speed and max error of every output against
+    fp32), and the full reverse diffusion from the same seed (wall time, absolute difference of the predicted lddt and
+    affinity, and RMSD of the final ligand poses to the fp32 poses). The reverse diffusion is stochastic, so small
+    numeric differences grow over the steps: the RMSD is the one a user would see, not the error of a single forward
+    pass. Without a workdir the score model is a randomly initialised one of the released architecture, which is
+    enough for the speed and the forward pass errors but may send ligands out of the pocket during the diffusion.
+    Such complexes are counted as failed; use the checkpoint for meaningful pose and affinity differences.
+"""
+import copy
+import json
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from functools import partial
+
+import numpy as np
+
+from benchmarks.compiled_model import DEFAULT_SCORE_MODEL_PARAMETERS, OUTPUTS, timed
+from benchmarks.throughput import BUNDLED_LIGANDS, build_dataset, load_model_parameters, seed_everything, \
+    write_zero_embeddings
+
+
+def forward_batches(dataset, model_args, device, args):
+    """Randomised batches of samples_per_complex copies of every complex, at every time of args.times"""
+    from torch_geometric.data import Batch
+    from torch_geometric.loader import DataLoader
+    from utils.diffusion_utils import set_time
+    from utils.sampling import randomize_position
+
+    seed_everything(args.seed)
+    batches = []
+    for orig_complex_graph in DataLoader(dataset=dataset, batch_size=1, shuffle=False):
+        data_list = [copy.deepcopy(orig_complex_graph) for _ in range(args.samples_per_complex)]
+        randomize_position(data_list, model_args.no_torsion, False, model_args.tr_sigma_max, model_args.rot_sigma_max,
+                           model_args.tor_sigma_max, model_args.res_tr_sigma_max, model_args.res_rot_sigma_max)
+        for t in args.times:
+            batch = Batch.from_data_list(data_list).to(device)
+            set_time(batch, t, t, t, t, t, t, len(data_list), model_args.all_atoms, device)
+            batches.append((orig_complex_graph.name[0], t, batch))
+    return batches
+
+
+def run_sampling(dataset, model, model_args, t_to_sigma, device, args):
+    """(seconds, ligand positions, lddt, affinity) of every complex of the dataset, None where the diffusion failed"""
+    import torch
+    from torch_geometric.loader import DataLoader
+    from utils.diffusion_utils import get_t_schedule
+    from utils.sampling import randomize_position, sampling
+
+    schedule = get_t_schedule(inference_steps=args.inference_steps)
+    seed_everything(args.seed)
+    outputs = []
+    for orig_complex_graph in DataLoader(dataset=dataset, batch_size=1, shuffle=False):
+        data_list = [copy.deepcopy(orig_complex_graph) for _ in range(args.samples_per_complex)]
+        randomize_position(data_list, model_args.no_torsion, False, model_args.tr_sigma_max, model_args.rot_sigma_max,
+                           model_args.tor_sigma_max, model_args.res_tr_sigma_max, model_args.res_rot_sigma_max)
+        start = time.perf_counter()
+        try:
+            final_data_list, _, lddt, affinity = sampling(
+                data_list=data_list, model=model, inference_steps=args.inference_steps, tr_schedule=schedule,
+                rot_schedule=schedule, tor_schedule=schedule, res_tr_schedule=schedule, res_rot_schedule=schedule,
+                res_chi_schedule=schedule, device=device, t_to_sigma=t_to_sigma, model_args=model_args, ode=False,
+                batch_size=args.samples_per_complex, no_final_step_noise=True, protein_dynamic=True)
+        except RuntimeError as e:
+            print(f'Reverse diffusion of {orig_complex_graph.name[0]} failed: {e}')
+            outputs.append(None)
+            continue
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        outputs.append((time.perf_counter() - start,
+                        np.stack([complex_graph['ligand'].pos.cpu().numpy() for complex_graph in final_data_list]),
+                        lddt.float().cpu().numpy().reshape(-1), affinity.float().cpu().numpy().reshape(-1)))
+    return outputs
+
+
+def compare_forward(model, batches, reference, device, args):
+    import torch
+    times, errors = [], {name: 0. for name in OUTPUTS}
+    with torch.no_grad():
+        for (_, _, batch), eager in zip(batches, reference):
+            outputs, forward_times = timed(lambda: model(batch), args.repeats, device)
+            times.append(float(np.median(forward_times)))
+            for name, a, b in zip(OUTPUTS, outputs, eager):
+                if a.numel():
+                    errors[name] = max(errors[name], float((a.float() - b.float()).abs().max()))
+    return times, errors
+
+
+def compare_sampling(outputs, reference):
+    pairs = [(output, ref) for output, ref in zip(outputs, reference) if output is not None and ref is not None]
+    entry = {'sampling_failed': sum(output is None for output in outputs)}
+    if not pairs:
+        return entry
+    rmsd = np.concatenate([np.sqrt(((output[1] - ref[1]) ** 2).sum(-1).mean(-1)) for output, ref in pairs])
+    lddt_error = np.concatenate([np.abs(output[2] - ref[2]) for output, ref in pairs])
+    affinity_error = np.concatenate([np.abs(output[3] - ref[3]) for output, ref in pairs])
+    seconds = float(np.mean([output[0] for output, _ in pairs]))
+    entry.update({'seconds_per_complex': seconds, 'sampling_speedup': float(np.mean([ref[0] for _, ref in pairs])) / seconds,
+                  'lddt_mae': float(lddt_error.mean()), 'lddt_max_error': float(lddt_error.max()),
+                  'affinity_mae': float(affinity_error.mean()), 'affinity_max_error': float(affinity_error.max()),
+                  'rmsd_mean': float(rmsd.mean()), 'rmsd_max': float(rmsd.max())})
+    return entry
+
+
+def main():
+    from utils.precision import PRECISIONS
+    parser = ArgumentParser(description='Speed and accuracy of the reduced precision inference modes')
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'bf16', 'int8-dynamic'], choices=PRECISIONS, help='Precisions to compare, fp32 is always run as the reference')
+    parser.add_argument('--protein_path', type=str, default='data/1qg8_cleaned.pdb', help='Receptor used for all ligands')
+    parser.add_argument('--model_dir', type=str, default='workdir/big_score_model_sanyueqi_with_time', help='Score model directory')
+    parser.add_argument('--ckpt', type=str, default='ema_inference_epoch314_model.pt', help='Score model checkpoint')
+    parser.add_argument('--samples_per_complex', type=int, default=4, help='Number of samples per ligand (the batch size)')
+    parser.add_argument('--times', type=float, nargs='+', default=[1.0, 0.5, 0.05], help='Diffusion times of the forward pass comparison')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed forward passes per batch')
+    parser.add_argument('--inference_steps', type=int, default=20, help='Number of denoising steps')
+    parser.add_argument('--no_sampling', action='store_true', default=False, help='Only compare single forward passes')
+    parser.add_argument('--cuda', action='store_true', default=False, help='Run on the GPU')
+    parser.add_argument('--cores', '-c', type=int, default=1, help='CPU cores to use')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the weights, conformers and sampling')
+    parser.add_argument('--out', type=str, default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    import torch
+    from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl
+    from utils.precision import apply_precision, resolve_precision
+    from utils.utils import get_model
+
+    torch.set_num_threads(args.cores)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    model_args = load_model_parameters(args.model_dir)
+    weights = 'checkpoint' if model_args is not None else 'random'
+    model_args = model_args or Namespace(**DEFAULT_SCORE_MODEL_PARAMETERS)
+    t_to_sigma = partial(t_to_sigma_compl, args=model_args)
+
+    seed_everything(args.seed)
+    state_dict = get_model(model_args, device, t_to_sigma=t_to_sigma, no_parallel=True).state_dict()
+    if weights == 'checkpoint':
+        state_dict = torch.load(os.path.join(args.model_dir, args.ckpt), map_location=torch.device('cpu'))
+
+    work_dir = tempfile.mkdtemp(prefix='dynamicbind_precision_')
+    results = []
+    try:
+        os.makedirs(os.path.join(work_dir, 'esm'))
+        write_zero_embeddings(args.protein_path, os.path.join(work_dir, 'esm'))
+        names = [f'bench_{i}' for i in range(len(BUNDLED_LIGANDS))]
+        dataset = build_dataset(args, work_dir, 'cache', BUNDLED_LIGANDS, names, model_args, None)
+        batches = forward_batches(dataset, model_args, device, args)
+        reference, reference_times, reference_sampling = None, None, None
+        for precision in ['fp32'] + [precision for precision in args.precisions if precision != 'fp32']:
+            if precision != 'fp32' and resolve_precision(precision, device) == 'fp32':
+                results.append({'precision': precision, 'skipped': f'not supported on this {device.type}'})
+                continue
+            # int8-dynamic quantises in place, every precision starts from a fresh fp32 model
+            model = get_model(model_args, device, t_to_sigma=t_to_sigma, no_parallel=True)
+            model.load_state_dict(state_dict, strict=True)
+            model = apply_precision(model.to(device).eval(), precision, device)
+            if reference is None:
+                with torch.no_grad():
+                    reference = [model(batch) for _, _, batch in batches]
+            forward_times, errors = compare_forward(model, batches, reference, device, args)
+            reference_times = reference_times or forward_times
+            entry = {'precision': precision, 'forward_ms': 1000 * float(np.mean(forward_times)),
+                     'forward_speedup': float(np.mean(reference_times) / np.mean(forward_times)), 'max_error': errors}
+            print(f"{precision}: forward pass {entry['forward_ms']:.1f} ms ({entry['forward_speedup']:.2f}x), max error "
+                  + ' '.join(f'{name} {error:.2e}' for name, error in errors.items()))
+            if not args.no_sampling:
+                outputs = run_sampling(dataset, model, model_args, t_to_sigma, device, args)
+                reference_sampling = reference_sampling or outputs
+                entry.update(compare_sampling(outputs, reference_sampling))
+                if 'seconds_per_complex' in entry:
+                    print(f"{precision}: sampling {entry['seconds_per_complex']:.2f} s per complex ({entry['sampling_speedup']:.2f}x), "
+                          f"lddt mae {entry['lddt_mae']:.4f}, affinity mae {entry['affinity_mae']:.4f}, "
+                          f"pose rmsd mean {entry['rmsd_mean']:.3f} max {entry['rmsd_max']:.3f}")
+                if entry['sampling_failed']:
+                    print(f"{precision}: the reverse diffusion failed for {entry['sampling_failed']} complexes")
+            results.append(entry)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for entry in results:
+        if 'skipped' in entry:
+            print(f"{entry['precision']}: skipped, {entry['skipped']}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'device': device.type, 'weights': weights, 'torch': torch.__version__, 'config': vars(args),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+    Reference implementations of the geometry hot kernels, used by benchmarks/kernels.py to check the numerical parity
+    of the implementations in the tree.
+
+    These are deliberately plain: the per residue loop of get_calpha_graph and the networkx version of
+    get_transformation_mask as they were before they were vectorised, and straightforward float64 NumPy/SciPy
+    versions of the other kernels. Do not optimise them, they are what optimised kernels are checked against.
+"""
+import numpy as np
+from scipy.spatial.transform import Rotation
+from scipy.special import softmax
+
+
+def calpha_neighbors(c_alpha_coords, n_coords, c_coords, cutoff, max_neighbor=None):
+    """Per residue loop of get_calpha_graph, returns the edges [2, n_edges], mu_r_norm and lf_3pts"""
+    from scipy import spatial
+    num_residues = len(c_alpha_coords)
+    distances = spatial.distance.cdist(c_alpha_coords, c_alpha_coords)
+    src_list, dst_list, mean_norm_list, lf_3pts = [], [], [], []
+    for i in range(num_residues):
+        dst = list(np.where(distances[i, :] < cutoff)[0])
+        dst.remove(i)
+        if max_neighbor != None and len(dst) > max_neighbor:
+            dst = list(np.argsort(distances[i, :]))[1: max_neighbor + 1]
+        assert len(dst), 'isolated residue'
+        src = [i] * len(dst)
+        src_list.extend(src)
+        dst_list.extend(dst)
+        valid_dist_np = distances[i, dst]
+        sigma = np.array([1., 2., 5., 10., 30.]).reshape((-1, 1))
+        weights = softmax(- valid_dist_np.reshape((1, -1)) ** 2 / sigma, axis=1)
+        diff_vecs = c_alpha_coords[src, :] - c_alpha_coords[dst, :]
+        mean_vec = weights.dot(diff_vecs)
+        denominator = weights.dot(np.linalg.norm(diff_vecs, axis=1))
+        mean_norm_list.append(np.linalg.norm(mean_vec, axis=1) / denominator)
+        lf_3pts.append(np.array([n_coords[i], c_alpha_coords[i], c_coords[i]]))
+    return np.asarray([src_list, dst_list]), np.array(mean_norm_list), np.array(lf_3pts)
+
+
+def transformation_mask(pyg_data):
+    """networkx version of get_transformation_mask: one connectivity check per bond"""
+    import networkx as nx
+    from torch_geometric.utils import to_networkx
+    G = to_networkx(pyg_data.to_homogeneous(), to_undirected=False)
+    to_rotate = []
+    edges = pyg_data['ligand', 'ligand'].edge_index.T.numpy()
+    edges_attr = pyg_data['ligand', 'ligand'].edge_attr.numpy()
+    for i in range(0, edges.shape[0], 2):
+        assert edges[i, 0] == edges[i+1, 1]
+        G2 = G.to_undirected()
+        G2.remove_edge(*edges[i])
+        if not nx.is_connected(G2) and edges_attr[i, 0] == 1:
+            l = list(sorted(nx.connected_components(G2), key=len)[0])
+            if len(l) > 1:
+                if edges[i, 0] in l:
+                    to_rotate.append([])
+                    to_rotate.append(l)
+                else:
+                    to_rotate.append(l)
+                    to_rotate.append([])
+                continue
+        to_rotate.append([])
+        to_rotate.append([])
+
+    mask_edges = np.asarray([0 if len(l) == 0 else 1 for l in to_rotate], dtype=bool)
+    mask_rotate = np.zeros((np.sum(mask_edges), len(G.nodes())), dtype=bool)
+    idx = 0
+    for i in range(len(G.edges())):
+        if mask_edges[i]:
+            mask_rotate[idx][np.asarray(to_rotate[i], dtype=int)] = True
+            idx += 1
+    return mask_edges, mask_rotate
+
+
+def axis_angle_to_matrix(axis_angle):
+    axis_angle = np.asarray(axis_angle, dtype=np.float64)
+    return Rotation.from_rotvec(axis_angle.reshape(-1, 3)).as_matrix().reshape(axis_angle.shape[:-1] + (3, 3))
+
+
+def torsion_angles(pos, edge_index, mask_rotate, torsion_updates):
+    """Sequential torsion updates, one bond at a time, in float64"""
+    pos = np.array(pos, dtype=np.float64)
+    for idx_edge, (u, v) in enumerate(np.asarray(edge_index)):
+        if torsion_updates[idx_edge] == 0:
+            continue
+        assert not mask_rotate[idx_edge, u] and mask_rotate[idx_edge, v]
+        rot_vec = pos[u] - pos[v]
+        rot_vec = rot_vec * torsion_updates[idx_edge] / np.linalg.norm(rot_vec)
+        rot_mat = Rotation.from_rotvec(rot_vec).as_matrix()
+        pos[mask_rotate[idx_edge]] = (pos[mask_rotate[idx_edge]] - pos[v]) @ rot_mat.T + pos[v]
+    return pos
+
+
+def kabsch(A, B):
+    """R, t minimising |R @ A + t - B| for 3xN point sets, in float64"""
+    A, B = np.asarray(A, dtype=np.float64), np.asarray(B, dtype=np.float64)
+    centroid_A, centroid_B = A.mean(axis=1, keepdims=True), B.mean(axis=1, keepdims=True)
+    U, S, Vt = np.linalg.svd((A - centroid_A) @ (B - centroid_B).T)
+    R = Vt.T @ U.T
+    if np.linalg.det(R) < 0:
+        R = Vt.T @ np.diag([1., 1., -1.]) @ U.T
+    return R, centroid_B - R @ centroid_A
+
+
+def modify_conformer(lig_pos, torsion_edges, mask_rotate, lf_3pts, chis, chi_masks, acc_pred_chis,
+                     tr_update, rot_update, torsion_updates, res_tr_update, res_rot_update, res_chi_update):
+    """utils.diffusion_utils.modify_conformer in float64. Returns the ligand positions, lf_3pts, chis and acc_pred_chis"""
+    lig_pos, lf_3pts = np.asarray(lig_pos, dtype=np.float64), np.asarray(lf_3pts, dtype=np.float64)
+    chis, chi_masks = np.asarray(chis, dtype=np.float64), np.asarray(chi_masks, dtype=np.float64)
+    center = lig_pos.mean(axis=0, keepdims=True)
+    rigid = (lig_pos - center) @ axis_angle_to_matrix(np.reshape(rot_update, 3)).T + np.reshape(tr_update, (1, 3)) + center
+    flexible = torsion_angles(rigid, torsion_edges, mask_rotate, torsion_updates)
+    R, t = kabsch(flexible.T, rigid.T)
+    lig_pos = flexible @ R.T + t.T
+
+    res_rot_mat = axis_angle_to_matrix(res_rot_update)
+    lf_3pts = (lf_3pts - lf_3pts[:, [1]]) @ res_rot_mat.transpose(0, 2, 1) + lf_3pts[:, [1]] + np.asarray(res_tr_update)[:, None]
+    acc_pred_chis = ((np.asarray(acc_pred_chis, dtype=np.float64) + res_chi_update) * chi_masks[:, [0, 2, 4, 5, 6]]) % (2 * np.pi)
+    chis = ((chis + np.asarray(res_chi_update)[:, [0, 0, 1, 1, 2, 3, 4]]) * chi_masks) % (2 * np.pi)
+    for a, b in [(0, 1), (2, 3)]:
+        chis[:, a], chis[:, b] = np.maximum(chis[:, a], chis[:, b]), np.minimum(chis[:, a], chis[:, b])
+    return lig_pos, lf_3pts, chis, acc_pred_chis
+
+
+def modify_pdb(ppdb, lf_3pts, pred_chis, chi_masks, original_center):
+    """utils.visualise.modify_pdb_from_arrays as a per residue, per atom loop in float64, returns ppdb"""
+    from utils.visualise import complete_chi_bond_dict
+    lf_3pts = np.asarray(lf_3pts, dtype=np.float64)
+    original_center = np.asarray(original_center, dtype=np.float64).reshape(3)
+    for res_idx, res in enumerate(ppdb.get_residues()):
+        if res.resname == 'HOH' or 'CA' not in res or 'N' not in res or 'C' not in res:
+            continue
+        # the local frame of the input residue and of the prediction, as rotation and origin
+        frames = []
+        for p_neg_x_axis, origin, p_xy_plane in [(res['C'].coord, res['CA'].coord, res['N'].coord),
+                                                 (lf_3pts[res_idx, 2], lf_3pts[res_idx, 1], lf_3pts[res_idx, 0])]:
+            p_neg_x_axis, origin, p_xy_plane = (np.asarray(x, dtype=np.float64) for x in (p_neg_x_axis, origin, p_xy_plane))
+            e0 = origin - p_neg_x_axis
+            e0 = e0 / np.linalg.norm(e0)
+            e1 = p_xy_plane - origin
+            e1 = e1 - e0 * (e0 @ e1)
+            e1 = e1 / np.linalg.norm(e1)
+            frames.append((np.stack([e0, e1, np.cross(e0, e1)], axis=1), origin))
+        (rot, origin), (pred_rot, pred_origin) = frames
+        for atom in res.get_atoms():
+            local = rot.T @ (atom.coord.astype(np.float64) - origin)
+            atom.set_coord(pred_rot @ local + pred_origin + original_center)
+
+        for i in range(5):
+            if chi_masks[res_idx][i] == 0 or complete_chi_bond_dict[f'chi{i + 1}'].get(res.resname) is None:
+                continue
+            atom1, atom2, rotate_atom_list = complete_chi_bond_dict[f'chi{i + 1}'][res.resname]
+            if atom1 not in res or atom2 not in res:
+                continue
+            rot_vec = res[atom2].coord.astype(np.float64) - res[atom1].coord
+            rot_mat = Rotation.from_rotvec(float(pred_chis[res_idx][i]) * rot_vec / (np.linalg.norm(rot_vec) + 1e-6)).as_matrix()
+            for rotate_atom in rotate_atom_list:
+                if rotate_atom in res:
+                    res[rotate_atom].set_coord((res[rotate_atom].coord - res[atom1].coord) @ rot_mat.T + res[atom1].coord)
+    return ppdb
+
+
+def receptor_pdb_files(ppdb, samples):
+    """The receptor files the samples (lf_3pts, pred_chis, chi_masks, original_center) were written as before
+    utils/pdb_writer.py: modify_pdb_from_arrays on a deep copy and PDBIO without the hydrogens, like save_protein"""
+    import copy
+    import io
+    from Bio.PDB import PDBIO, Select
+    from utils.visualise import modify_pdb_from_arrays
+
+    class RemoveHs(Select):
+        def accept_atom(self, atom):
+            return atom.element != 'H'
+
+    files = []
+    for sample in samples:
+        receptor = modify_pdb_from_arrays(copy.deepcopy(ppdb), *sample)
+        handle = io.StringIO()
+        pdbio = PDBIO()
+        pdbio.set_structure(receptor)
+        pdbio.save(handle, RemoveHs())
+        files.append(handle.getvalue())
+    return files
+
+
+def clash_score(dis, base_vdw_dis, neighbor_mask=None, clash_thr=4):
+    """compute_clash_score with an explicit loop over the contacts"""
+    total, n, overlaps = 0., 0, []
+    for i, j in zip(*np.nonzero(dis < clash_thr)):
+        if neighbor_mask is not None and not neighbor_mask[i, j]:
+            continue
+        n += 1
+        overlap = base_vdw_dis[i, j] - dis[i, j]
+        if overlap > 0:
+            total += overlap ** 2
+            overlaps.append(overlap)
+    return np.sqrt(total / (1e-8 + n)), np.array(overlaps), len(overlaps), n
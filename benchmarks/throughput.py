@@ -0,0 +1,283 @@
+"""
+    End-to-end throughput benchmarks on the bundled inputs.
+
+    Runs offline, directly in the current Python environment (no Slurm or Singularity), from the repository root:
+
+        python -m benchmarks.throughput --modes preprocessing sampling inference relax --out bench.json
+
+    Modes:
+        preprocessing   conformer generation and featurisation of the ligand set (PDBBind.inference_preprocessing)
+        sampling        reverse diffusion + confidence of the preprocessed complexes on the CPU (needs the workdir)
+        inference       inference.py as a CPU-only subprocess on the ligand set (needs the workdir)
+        relax           relax_final.py's OpenMM relaxation of the bundled 1opl complex (needs OpenMM)
+
+    The ligand set is the bundled SDFs plus --synthetic deterministic SMILES of --heavy_atoms heavy atoms. ESM
+    embeddings are replaced by zeros of the right shape, which does not change the amount of work. Every mode reports
+    ligands/hour, the per stage latency percentiles of utils/metrics.py and the peak RSS. The JSON output of two
+    commits can be compared with benchmarks/compare.py.
+"""
+import copy
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from functools import partial
+
+import numpy as np
+
+from utils.metrics import MetricsRecorder, Stopwatch, read_metrics, summarize
+from utils.structure_arrays import read_structure_arrays, residue_starts, atom_index_table
+
+MODES = ['preprocessing', 'sampling', 'inference', 'relax']
+BUNDLED_LIGANDS = ['data/1opj_STI_A.sdf', 'data/1opl_P16_A.sdf']
+RELAX_COMPLEX = ('data/1opl_P16_A_aligned_to_P00519.pdb', 'data/1opl_P16_A.sdf')
+ESM_DIM = 1280
+# the featurisation parameters of the released model, used for preprocessing when the workdir is not there
+DEFAULT_MODEL_PARAMETERS = dict(receptor_radius=30, remove_hs=True, c_alpha_max_neighbors=10, all_atoms=False,
+                                atom_radius=5, atom_max_neighbors=8, matching_popsize=20, matching_maxiter=20)
+
+# chain building blocks for the synthetic ligands, every token links the previous one to the next
+_TOKENS = ['C', 'C', 'C', 'N', 'O', 'C(=O)', 'C(=O)N', 'C(C)', 'C(F)', 'c1ccc(cc1)', 'c1ccc(nc1)', 'C1CCN(CC1)']
+
+
+def synthetic_ligands(count, heavy_atoms, seed):
+    """count distinct, deterministic drug-like SMILES with about heavy_atoms heavy atoms each"""
+    from rdkit import Chem
+    rng = random.Random(seed)
+    smiles = []
+    while len(smiles) < count:
+        tokens = ['c1ccc(cc1)']
+        while True:
+            mol = Chem.MolFromSmiles(''.join(tokens))
+            if mol is None or mol.GetNumHeavyAtoms() >= heavy_atoms:
+                break
+            tokens.append(rng.choice(_TOKENS))
+        if mol is None:
+            continue
+        canonical = Chem.MolToSmiles(mol)
+        if canonical not in smiles:
+            smiles.append(canonical)
+    return smiles
+
+
+def write_zero_embeddings(protein_path, esm_dir):
+    """ESM embedding files with the layout of proteinEmbedding.py, all zeros"""
+    import torch
+    atoms = read_structure_arrays(protein_path)
+    atoms = atoms[atoms['resname'] != 'HOH']
+    backbone = atom_index_table(atoms, ['CA', 'N', 'C'])
+    valid = (backbone >= 0).all(axis=1)
+    chain_index = atoms['chain_index'][residue_starts(atoms)]
+    protein_name = os.path.basename(protein_path)
+    for j, chain in enumerate(np.unique(chain_index)):
+        n_residues = int(valid[chain_index == chain].sum())
+        label = f'{protein_name}_chain_{j}'
+        torch.save({'label': label, 'representations': {33: torch.zeros(n_residues, ESM_DIM)}}, os.path.join(esm_dir, label + '.pt'))
+
+
+def load_model_parameters(model_dir):
+    import yaml
+    path = os.path.join(model_dir, 'model_parameters.yml')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return Namespace(**yaml.full_load(f))
+
+
+def seed_everything(seed):
+    import torch
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def result(ligands, wall, metrics_file, **info):
+    entries = read_metrics([metrics_file]) if os.path.exists(metrics_file) else []
+    return dict(ligands=ligands, wall=wall, ligands_per_hour=3600 * ligands / wall if wall else None,
+                peak_rss_mb=peak_rss_mb(), stages=summarize(entries), **info)
+
+
+def build_dataset(args, work_dir, cache_name, ligand_descriptions, names, model_args, metrics):
+    from datasets.pdbbind import PDBBind
+    return PDBBind(transform=None, root='', name_list=list(names), protein_path_list=[args.protein_path] * len(names),
+                   ligand_descriptions=list(ligand_descriptions), receptor_radius=model_args.receptor_radius,
+                   cache_path=os.path.join(work_dir, cache_name), remove_hs=model_args.remove_hs, max_lig_size=None,
+                   c_alpha_max_neighbors=model_args.c_alpha_max_neighbors, matching=False, keep_original=False,
+                   popsize=model_args.matching_popsize, maxiter=model_args.matching_maxiter, center_ligand=True,
+                   all_atoms=model_args.all_atoms, atom_radius=model_args.atom_radius,
+                   atom_max_neighbors=model_args.atom_max_neighbors, esm_embeddings_path=os.path.join(work_dir, 'esm'),
+                   require_ligand=True, require_receptor=True, num_workers=1, keep_local_structures=False,
+                   use_existing_cache=False, num_conformer_workers=args.cores, conformer_timeout=None,
+                   conformer_seed=args.seed, metrics=metrics)
+
+
+def bench_preprocessing(args, work_dir, ligand_descriptions, names):
+    model_args = load_model_parameters(args.model_dir)
+    parameters = 'workdir' if model_args is not None else 'defaults'
+    model_args = model_args or Namespace(**DEFAULT_MODEL_PARAMETERS)
+    metrics_file = os.path.join(work_dir, 'metrics_preprocessing.jsonl')
+    metrics = MetricsRecorder(metrics_file, 'preprocessing')
+    seed_everything(args.seed)
+    start = time.perf_counter()
+    dataset = build_dataset(args, work_dir, 'preprocessing_cache', ligand_descriptions, names, model_args, metrics)
+    wall = time.perf_counter() - start
+    metrics.write_remaining('ok')
+    return result(len(dataset), wall, metrics_file, model_parameters=parameters)
+
+
+def bench_sampling(args, work_dir, ligand_descriptions, names):
+    model_args = load_model_parameters(args.model_dir)
+    if model_args is None:
+        return {'skipped': f'no model parameters in {args.model_dir}'}
+    import torch
+    from torch_geometric.loader import DataLoader
+    from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl, get_t_schedule
+    from utils.sampling import randomize_position, sampling
+    from utils.utils import get_model
+
+    dataset = build_dataset(args, work_dir, 'sampling_cache', ligand_descriptions, names, model_args, None)
+    device = torch.device('cpu')
+    t_to_sigma = partial(t_to_sigma_compl, args=model_args)
+    model = get_model(model_args, device, t_to_sigma=t_to_sigma, no_parallel=True)
+    model.load_state_dict(torch.load(os.path.join(args.model_dir, args.ckpt), map_location=device), strict=True)
+    model.eval()
+    schedule = get_t_schedule(inference_steps=args.inference_steps)
+
+    metrics_file = os.path.join(work_dir, 'metrics_sampling.jsonl')
+    metrics = MetricsRecorder(metrics_file, 'sampling')
+    seed_everything(args.seed)
+    start = time.perf_counter()
+    ligands = 0
+    for orig_complex_graph in DataLoader(dataset=dataset, batch_size=1, shuffle=False):
+        data_list = [copy.deepcopy(orig_complex_graph) for _ in range(args.samples_per_complex)]
+        randomize_position(data_list, model_args.no_torsion, False, model_args.tr_sigma_max, model_args.rot_sigma_max,
+                           model_args.tor_sigma_max, model_args.res_tr_sigma_max, model_args.res_rot_sigma_max)
+        sampling(data_list=data_list, model=model, inference_steps=args.inference_steps, tr_schedule=schedule,
+                 rot_schedule=schedule, tor_schedule=schedule, res_tr_schedule=schedule, res_rot_schedule=schedule,
+                 res_chi_schedule=schedule, device=device, t_to_sigma=t_to_sigma, model_args=model_args, ode=False,
+                 batch_size=args.batch_size, no_final_step_noise=True, protein_dynamic=True,
+                 metrics=metrics.ligand(orig_complex_graph.name[0]))
+        metrics.write(orig_complex_graph.name[0], samples=args.samples_per_complex, steps=args.inference_steps)
+        ligands += 1
+    return result(ligands, time.perf_counter() - start, metrics_file, samples_per_complex=args.samples_per_complex,
+                  inference_steps=args.inference_steps)
+
+
+def bench_inference(args, work_dir, ligand_descriptions, names):
+    if load_model_parameters(args.model_dir) is None:
+        return {'skipped': f'no model parameters in {args.model_dir}'}
+    out_dir = os.path.join(work_dir, 'inference')
+    csv = os.path.join(work_dir, 'bench_inference.csv')
+    with open(csv, 'w') as f:
+        f.write('name;protein_path;ligand\n')
+        for name, ligand in zip(names, ligand_descriptions):
+            f.write(f'{name};{args.protein_path};{ligand}\n')
+    cmd = [sys.executable, '-u', 'inference.py', '--protein_ligand_csv', csv, '--out_dir', out_dir,
+           '--samples_per_complex', str(args.samples_per_complex), '--inference_steps', str(args.inference_steps),
+           '--model_dir', args.model_dir, '--ckpt', args.ckpt, '--esm_embeddings_path', os.path.join(work_dir, 'esm'),
+           '--cache_path', os.path.join(work_dir, 'inference_cache'), '--batch_size', str(args.batch_size),
+           '--seed', str(args.seed), '-c', str(args.cores), '--protein_dynamic', '--no_final_step_noise']
+    start = time.perf_counter()
+    process = subprocess.run(cmd, env=dict(os.environ, CUDA_VISIBLE_DEVICES=''), capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        return {'failed': process.stderr[-2000:]}
+    metrics_file = os.path.join(out_dir, 'jobs_out', 'metrics_bench_inference.jsonl')
+    docked = sum(1 for entry in read_metrics([metrics_file]) if entry['status'] == 'ok') if os.path.exists(metrics_file) else 0
+    bench = result(docked, wall, metrics_file, samples_per_complex=args.samples_per_complex, inference_steps=args.inference_steps)
+    bench['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return bench
+
+
+def bench_relax(args, work_dir, ligand_descriptions, names):
+    try:
+        from utils.relax import openmm_relax
+    except ImportError as e:
+        return {'skipped': f'OpenMM is not available ({e})'}
+    protein_file, ligand_file = RELAX_COMPLEX
+    metrics_file = os.path.join(work_dir, 'metrics_relax.jsonl')
+    metrics = MetricsRecorder(metrics_file, 'relax')
+    relax_dir = os.path.join(work_dir, 'relax')
+    os.makedirs(relax_dir, exist_ok=True)
+    start = time.perf_counter()
+    for i in range(args.relax_repeats):
+        name = f'relax_{i}'
+        files = [os.path.join(relax_dir, f'{kind}_{i}.{extension}') for kind, extension in
+                 [('fixed', 'pdb'), ('relaxed_protein', 'pdb'), ('relaxed_complex', 'pdb'), ('relaxed_ligand', 'sdf')]]
+        stopwatch = Stopwatch()
+        ret = openmm_relax((protein_file, ligand_file, files[0], files[1], 'none', 1000, 3000, files[2], files[3], False))
+        metrics.ligand(name).add('relax', stopwatch.stop())
+        metrics.write(name, einit=ret['einit'], efinal=ret['efinal'])
+    return result(args.relax_repeats, time.perf_counter() - start, metrics_file)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description='Offline throughput benchmarks on the bundled inputs')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES, help='Which benchmarks to run')
+    parser.add_argument('--protein_path', type=str, default='data/1qg8_cleaned.pdb', help='Receptor used for all ligands')
+    parser.add_argument('--synthetic', type=int, default=8, help='Number of synthetic ligands added to the bundled ones')
+    parser.add_argument('--heavy_atoms', type=int, default=30, help='Heavy atoms per synthetic ligand')
+    parser.add_argument('--no_bundled', action='store_true', default=False, help='Only use the synthetic ligands')
+    parser.add_argument('--samples_per_complex', type=int, default=1, help='Number of samples per ligand')
+    parser.add_argument('--inference_steps', type=int, default=20, help='Number of denoising steps')
+    parser.add_argument('--batch_size', type=int, default=32, help='Sampling batch size')
+    parser.add_argument('--relax_repeats', type=int, default=3, help='How often the relax benchmark relaxes the bundled complex')
+    parser.add_argument('--model_dir', type=str, default='workdir/big_score_model_sanyueqi_with_time', help='Score model directory')
+    parser.add_argument('--ckpt', type=str, default='ema_inference_epoch314_model.pt', help='Score model checkpoint')
+    parser.add_argument('--cores', '-c', type=int, default=1, help='CPU cores to use')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the ligand set, the conformers and the sampling')
+    parser.add_argument('--work_dir', type=str, default=None, help='Keep the intermediate files here instead of a temporary directory')
+    parser.add_argument('--out', type=str, default=None, help='Write the results to this JSON file (printed otherwise)')
+    args = parser.parse_args()
+
+    import torch
+    torch.set_num_threads(args.cores)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='dynamicbind_bench_')
+    os.makedirs(os.path.join(work_dir, 'esm'), exist_ok=True)
+    write_zero_embeddings(args.protein_path, os.path.join(work_dir, 'esm'))
+    ligand_descriptions = ([] if args.no_bundled else list(BUNDLED_LIGANDS)) + synthetic_ligands(args.synthetic, args.heavy_atoms, args.seed)
+    names = [f'bench_{i}' for i in range(len(ligand_descriptions))]
+
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname(),
+              'python': platform.python_version(), 'torch': torch.__version__, 'config': vars(args),
+              'ligand_set': ligand_descriptions, 'results': {}}
+    benchmarks = {'preprocessing': bench_preprocessing, 'sampling': bench_sampling, 'inference': bench_inference, 'relax': bench_relax}
+    try:
+        for mode in args.modes:
+            print(f'Running the {mode} benchmark..')
+            report['results'][mode] = benchmarks[mode](args, work_dir, ligand_descriptions, names)
+            print(json.dumps({key: value for key, value in report['results'][mode].items() if key != 'stages'}, default=str))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f'Results are in {args.out}')
+    else:
+        print(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
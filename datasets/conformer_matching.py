@@ -4,8 +4,6 @@ from collections import defaultdict
 from rdkit import Chem, RDLogger
 from rdkit.Chem import AllChem, rdMolTransforms
 from rdkit import Geometry
-import networkx as nx
-from scipy.optimize import differential_evolution
 from rdkit.Chem.rdchem import BondType as BT
 
 RDLogger.DisableLog('rdApp.*')
@@ -30,6 +28,7 @@ def apply_changes(mol, values, rotable_bonds, conf_id):
 
 def optimize_rotatable_bonds(mol, true_mol, rotable_bonds, probe_id=-1, ref_id=-1, seed=0, popsize=15, maxiter=500,
                              mutation=(0.5, 1), recombination=0.8):
+    from scipy.optimize import differential_evolution
     opt = OptimizeConformer(mol, true_mol, rotable_bonds, seed=seed, probe_id=probe_id, ref_id=ref_id)
     max_bound = [np.pi] * len(opt.rotable_bonds)
     min_bound = [-np.pi] * len(opt.rotable_bonds)
@@ -63,6 +62,8 @@ class OptimizeConformer:
 
 
 def get_torsion_angles(mol):
+    # only needed for conformer matching, networkx is not imported with the module
+    import networkx as nx
     torsions_list = []
     G = nx.Graph()
     for i, atom in enumerate(mol.GetAtoms()):
@@ -0,0 +1,167 @@
+"""
+    Multi-molecule ligand libraries: SDF files and SMILES files (one "SMILES name" per line), optionally gzipped. A
+    library is indexed once by the byte offset of every record, and a ligand of a library is referenced as
+    <library path>::<offset> in the job csvs, so no file per ligand is needed. The offsets of a gzipped library are
+    offsets in the decompressed stream. LibraryReader reads the records in order with a single open file, a job
+    therefore reads (and decompresses) its own range of the library once.
+
+    Indexing and reading only use the standard library, RDKit is imported when a record is parsed.
+"""
+import glob
+import gzip
+import os
+import re
+
+SDF_SUFFIXES = ('.sdf', '.sdf.gz', '.sd', '.sd.gz')
+SMILES_SUFFIXES = ('.smi', '.smi.gz', '.smiles', '.smiles.gz')
+RECORD_SEPARATOR = '::'
+
+
+def library_format(path):
+    """'sdf' or 'smi' for a library file, None for anything else"""
+    lower = path.lower()
+    if lower.endswith(SDF_SUFFIXES):
+        return 'sdf'
+    if lower.endswith(SMILES_SUFFIXES):
+        return 'smi'
+    return None
+
+
+def open_library(path):
+    return gzip.open(path, 'rb') if path.lower().endswith('.gz') else open(path, 'rb')
+
+
+def library_stem(path):
+    name = os.path.basename(path)
+    for suffix in SDF_SUFFIXES + SMILES_SUFFIXES:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name.split('.')[0]
+
+
+def clean_name(name):
+    # the names end up in file names and in the ';' separated job csvs
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_')
+
+
+def index_library(path):
+    """(name, offset) of every record of a library. Names are the SDF titles or the SMILES names, made unique"""
+    fmt = library_format(path)
+    stem = library_stem(path)
+    records, seen = [], set()
+
+    def add(title, offset):
+        name = clean_name(title) or f'{stem}_{len(records)}'
+        if name in seen:
+            name = f'{name}_{len(records)}'
+        seen.add(name)
+        records.append((name, offset))
+
+    with open_library(path) as f:
+        offset = 0
+        if fmt == 'sdf':
+            start, title, content = 0, None, False
+            for line in f:
+                if title is None:
+                    title = line.decode(errors='replace').strip()
+                content = content or bool(line.strip())
+                offset += len(line)
+                if line.rstrip() == b'$$$$':
+                    add(title, start)
+                    start, title, content = offset, None, False
+            # the last record may miss its $$$$ line
+            if content:
+                add(title, start)
+        else:
+            for i, line in enumerate(f):
+                fields = line.decode(errors='replace').split()
+                if fields and not fields[0].startswith('#') and not (i == 0 and fields[0].lower() == 'smiles'):
+                    add(fields[1] if len(fields) > 1 else '', offset)
+                offset += len(line)
+    return records
+
+
+def list_ligands(ligand):
+    """
+    (name, ligand description) of every ligand of --ligand of inferenceVS.py: the mol2/sdf files of a directory, or
+    the records of a library file
+    """
+    if os.path.isdir(ligand):
+        paths = sorted(glob.glob(f"{ligand}/*.sdf") + glob.glob(f"{ligand}/*.mol2"))
+        return [(os.path.basename(path).split('.')[0], path) for path in paths]
+    path = os.path.abspath(ligand)
+    return [(name, f'{path}{RECORD_SEPARATOR}{offset}') for name, offset in index_library(path)]
+
+
+def parse_reference(description):
+    """(library path, offset) of a record reference, None for any other ligand description"""
+    if not isinstance(description, str) or RECORD_SEPARATOR not in description:
+        return None
+    path, _, offset = description.rpartition(RECORD_SEPARATOR)
+    if not offset.isdigit() or library_format(path) is None:
+        return None
+    return path, int(offset)
+
+
+class LibraryRecord:
+    """The text of one record of a library. molecule() parses it, so that happens in the worker processes"""
+
+    def __init__(self, fmt, text, reference, error=None):
+        self.format = fmt
+        self.text = text
+        self.reference = reference
+        self.error = error
+
+    def molecule(self):
+        """An RDKit molecule for an SDF record, the SMILES string for a SMILES record"""
+        if self.error is not None:
+            raise ValueError(f'Could not read {self.reference}: {self.error}')
+        if self.format == 'smi':
+            return self.text.split()[0]
+        from rdkit import Chem
+        supplier = Chem.SDMolSupplier()
+        supplier.SetData(self.text, sanitize=False, removeHs=False)
+        mol = next(iter(supplier), None)
+        if mol is None:
+            raise ValueError(f'RDKit could not read the record {self.reference}')
+        Chem.SanitizeMol(mol)
+        return mol
+
+
+class LibraryReader:
+    """Reads records by reference, with one open file per library. Reading in increasing offsets never rereads data"""
+
+    def __init__(self):
+        self.files = {}
+
+    def read(self, description):
+        """A LibraryRecord for a record reference, any other ligand description is returned as is"""
+        reference = parse_reference(description)
+        if reference is None:
+            return description
+        path, offset = reference
+        try:
+            f = self.files.get(path)
+            if f is None or (offset < f.tell() and path.lower().endswith('.gz')):
+                # a gzip file can only seek backwards by decompressing from the start again
+                if f is not None:
+                    f.close()
+                f = self.files[path] = open_library(path)
+            f.seek(offset)
+            if library_format(path) == 'smi':
+                text = f.readline()
+            else:
+                lines = []
+                for line in f:
+                    lines.append(line)
+                    if line.rstrip() == b'$$$$':
+                        break
+                text = b''.join(lines)
+            return LibraryRecord(library_format(path), text.decode(errors='replace'), description)
+        except (OSError, EOFError) as e:
+            return LibraryRecord(library_format(path), None, description, error=f'{type(e).__name__}: {e}')
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
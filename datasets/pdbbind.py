@@ -12,6 +12,7 @@ import numpy as np
 # from biopandas.pdb import PandasPdb
 from Bio.PDB import PDBParser,MMCIFParser
 import torch
+from rdkit import Chem
 from rdkit.Chem import MolToSmiles, MolFromSmiles, AddHs
 from torch_geometric.data import Dataset, HeteroData
 from torch_geometric.loader import DataLoader, DataListLoader
@@ -20,10 +21,13 @@ from torch.utils.data import WeightedRandomSampler
 from torch_geometric.transforms import BaseTransform
 from tqdm import tqdm
 
+from datasets.library import LibraryReader, LibraryRecord
 from datasets.process_mols import read_molecule, get_rec_graph, generate_conformer, \
     get_lig_graph_with_matching, extract_receptor_structure, parse_receptor, parse_pdb_from_path
 from utils.diffusion_utils import modify_conformer, set_time
-from utils.utils import read_strings_from_txt
+from utils.utils import read_strings_from_txt, time_limit, TimeoutException
+from utils.pool import TimeoutPool, TASK_OK, TASK_ERROR, TASK_TIMEOUT
+from utils.metrics import Stopwatch
 from utils import so3, torus
 
 
@@ -93,12 +97,48 @@ class NoiseTransform(BaseTransform):
         return data
 
 
+def prepare_ligand(par):
+    ligand_description, keep_local_structures, num_threads, seed = par
+    stopwatch = Stopwatch()
+    if isinstance(ligand_description, LibraryRecord):
+        ligand_description = ligand_description.molecule()
+    # an RDKit molecule (from utils/engine.py) is treated like a molecule file
+    mol = MolFromSmiles(ligand_description) if isinstance(ligand_description, str) else None  # check if it is a smiles or a path
+    if mol is not None:
+        mol = AddHs(mol)
+        generate_conformer(mol, num_threads=num_threads, seed=seed)
+    else:
+        if isinstance(ligand_description, Chem.Mol):
+            mol = Chem.Mol(ligand_description)
+        else:
+            mol = read_molecule(ligand_description, remove_hs=False, sanitize=True)
+        if mol is None:
+            raise Exception('RDKit could not read the molecule ', ligand_description)
+        if not keep_local_structures or mol.GetNumConformers() == 0:
+            mol.RemoveAllConformers()
+            mol = AddHs(mol)
+            generate_conformer(mol, num_threads=num_threads, seed=seed)
+    # keep the molecule properties when the molecule is sent back from a worker process
+    Chem.SetDefaultPickleProperties(Chem.PropertyPickleOptions.AllProps)
+    return mol, stopwatch.stop()
+
+
+def run_task(task):
+    # in-process counterpart of TimeoutPool.imap_unordered
+    idx, par = task
+    try:
+        return idx, TASK_OK, prepare_ligand(par)
+    except Exception as e:
+        return idx, TASK_ERROR, f'{type(e).__name__}: {e}'
+
+
 class PDBBind(Dataset):
     def __init__(self, root, transform=None, info=None, cache_path='data/cache', split_path='data/', limit_complexes=0,
                  receptor_radius=30, num_workers=1, c_alpha_max_neighbors=None, popsize=15, maxiter=15,
                  matching=True, keep_original=False, max_lig_size=None, remove_hs=False, num_conformers=1, center_ligand=False, all_atoms=False,
                  atom_radius=5, atom_max_neighbors=None, esm_embeddings_path=None, require_ligand=False, require_receptor=False,
-                 ligands_list=None, protein_path_list=None, ligand_descriptions=None, name_list=None, keep_local_structures=False, use_existing_cache=True):
+                 ligands_list=None, protein_path_list=None, ligand_descriptions=None, name_list=None, keep_local_structures=False, use_existing_cache=True,
+                 num_conformer_workers=1, conformer_timeout=None, conformer_seed=-1, ligand_timeout=None, journal=None, metrics=None):
 
         super(PDBBind, self).__init__(root, transform)
         self.pdbbind_dir = root
@@ -118,6 +158,12 @@ class PDBBind(Dataset):
         self.name_list = name_list
         self.ligand_descriptions = ligand_descriptions
         self.keep_local_structures = keep_local_structures
+        self.num_conformer_workers = num_conformer_workers
+        self.conformer_timeout = conformer_timeout
+        self.conformer_seed = conformer_seed
+        self.ligand_timeout = ligand_timeout
+        self.journal = journal
+        self.metrics = metrics
         if matching or protein_path_list is not None and ligand_descriptions is not None:
             cache_path += '_torsion'
         if all_atoms:
@@ -271,31 +317,38 @@ class PDBBind(Dataset):
         receptors_list = []
         print('Reading molecules and generating local structures with RDKit')
         failed_ligand_indices = []
-        for idx, ligand_description in tqdm(enumerate(self.ligand_descriptions), ascii=True):
-            try:
-                mol = MolFromSmiles(ligand_description)  # check if it is a smiles or a path
-                if mol is not None:
-                    mol = AddHs(mol)
-                    generate_conformer(mol)
-                    ligands_list.append(mol)
-                else:
-                    mol = read_molecule(ligand_description, remove_hs=False, sanitize=True)
-                    if mol is None:
-                        raise Exception('RDKit could not read the molecule ', ligand_description)
-                    if not self.keep_local_structures:
-                        mol.RemoveAllConformers()
-                        mol = AddHs(mol)
-                        generate_conformer(mol)
-                    ligands_list.append(mol)
-            except Exception as e:
-                print('Failed to read molecule ', ligand_description, ' We are skipping it. The reason is the exception: ', e)
-                failed_ligand_indices.append(idx)
+        # conformers are generated in a pool sized to the available cores, every ligand gets conformer_timeout seconds
+        num_processes = max(1, min(self.num_conformer_workers, len(self.ligand_descriptions)))
+        num_threads = max(1, self.num_conformer_workers // num_processes)
+        # records of a ligand library are read in order while the workers take them
+        reader = LibraryReader()
+        tasks = ((reader.read(ligand_description), self.keep_local_structures, num_threads, self.conformer_seed) for ligand_description in self.ligand_descriptions)
+        if num_processes > 1 or self.conformer_timeout:
+            results = TimeoutPool(num_processes, timeout=self.conformer_timeout).imap_unordered(prepare_ligand, tasks)
+        else:
+            results = map(run_task, enumerate(tasks))
+        ligands = {}
+        for idx, status, result in tqdm(results, total=len(self.ligand_descriptions), ascii=True):
+            if status == TASK_OK:
+                ligands[idx], usage = result
+                if self.metrics is not None:
+                    self.metrics.ligand(self.name_list[idx]).add('conformer', usage)
                 continue
-            if '.pdb' in self.protein_path_list[idx]:
-                receptor_pdb = PDBParser(QUIET=True).get_structure('pdb', self.protein_path_list[idx])
-            elif 'cif' in self.protein_path_list[idx]:
-                receptor_pdb = MMCIFParser().get_structure('cif', self.protein_path_list[idx])
-            receptors_list.append(receptor_pdb)
+            print('Failed to read molecule ', self.ligand_descriptions[idx], ' We are skipping it. The reason is: ', result)
+            failed_ligand_indices.append(idx)
+            if self.journal is not None:
+                self.journal.record(self.name_list[idx], 'conformer', status, ligand=self.ligand_descriptions[idx], error=result)
+        reader.close()
+        receptors = {}
+        for idx in sorted(ligands):
+            ligands_list.append(ligands[idx])
+            protein_path = self.protein_path_list[idx]
+            if protein_path not in receptors:
+                if '.pdb' in protein_path:
+                    receptors[protein_path] = PDBParser(QUIET=True).get_structure('pdb', protein_path)
+                elif 'cif' in protein_path:
+                    receptors[protein_path] = MMCIFParser().get_structure('cif', protein_path)
+            receptors_list.append(receptors[protein_path])
         for index in sorted(failed_ligand_indices, reverse=True):
             del self.protein_path_list[index]
             del self.ligand_descriptions[index]
@@ -358,7 +411,19 @@ class PDBBind(Dataset):
         else:
             complex_graphs, rdkit_ligands, receptor_pdbs = [], [], []
             with tqdm(total=len(self.protein_path_list), desc='loading complexes', ascii=True) as pbar:
-                for t in map(self.get_complex, zip(self.name_list, self.protein_path_list, lm_embeddings_chains_all, ligands_list, receptors_list, self.ligand_descriptions)):
+                for par in zip(self.name_list, self.protein_path_list, lm_embeddings_chains_all, ligands_list, receptors_list, self.ligand_descriptions):
+                    stopwatch = Stopwatch()
+                    # the graphs of a single ligand (e.g. a huge torsion tree) get ligand_timeout seconds
+                    try:
+                        with time_limit(self.ligand_timeout or 0):
+                            t = self.get_complex(par)
+                    except TimeoutException:
+                        print(f'Skipping {par[0]} because its graphs took longer than {self.ligand_timeout} seconds')
+                        if self.journal is not None:
+                            self.journal.record(par[0], 'featurisation', TASK_TIMEOUT, ligand=par[5], error=f'no result after {self.ligand_timeout} seconds')
+                        t = [], [], []
+                    if self.metrics is not None:
+                        self.metrics.ligand(par[0]).add('featurisation', stopwatch.stop())
                     complex_graphs.extend(t[0])
                     rdkit_ligands.extend(t[1])
                     receptor_pdbs.extend(t[2])
@@ -415,6 +480,8 @@ class PDBBind(Dataset):
                               c_alpha_max_neighbors=self.c_alpha_max_neighbors, all_atoms=self.all_atoms,
                               atom_radius=self.atom_radius, atom_max_neighbors=self.atom_max_neighbors, remove_hs=self.remove_hs, lm_embeddings=lm_embeddings)
 
+            except TimeoutException:
+                raise
             except Exception as e:
                 print(f'Skipping {name} because of the error:')
                 print(e)
@@ -23,6 +23,7 @@ import torch.nn.functional as F
 
 from datasets.conformer_matching import get_torsion_angles, optimize_rotatable_bonds
 from utils.torsion import get_transformation_mask, get_sidechain_torsion
+from utils.structure_arrays import structure_to_arrays, residue_starts, atom_index_table
 from utils.affine import T
 # from utils.utils import get_align_rotran
 
@@ -164,111 +165,48 @@ def parse_pdb_from_path(path):
 
 
 def extract_receptor_structure(rec, lig=None, lm_embedding_chains=None):
-    if lig is not None:
-        conf = lig.GetConformer()
-        lig_coords = conf.GetPositions()
-    else:
-        lig_coords = np.array([[0,0,0]])
-    min_distances = []
-    coords = []
-    c_alpha_coords = []
-    n_coords = []
-    c_coords = []
-    chis = []
-    chi_masks = []
+    # lig is not needed anymore: the distances to the ligand were only used to pick a chain when none was valid
+    atoms = structure_to_arrays(rec)
+    atom_coords = atoms['coord'].astype(np.float64)
+    starts = residue_starts(atoms)
+    residues = atoms[starts]
+    residue_sizes = np.diff(np.r_[starts, len(atoms)])
+    backbone = atom_index_table(atoms, ['CA', 'N', 'C'])  # [n_residues, 3] atom indices, -1 if missing
+    # only keep residues that are amino acids and not water or some weird molecule that is part of the complex
+    valid_residues = (residues['resname'] != 'HOH') & (backbone >= 0).all(axis=1)
+    valid_atoms = np.repeat(valid_residues, residue_sizes)
+    chis, chi_masks = get_sidechain_torsion().calculate_torsions(atoms)
+
     valid_chain_ids = []
-    lengths = []
-    torsion_worker = get_sidechain_torsion()
-    for i, chain in enumerate(rec):
-        chain_coords = []  # num_residues, num_atoms, 3
-        chain_c_alpha_coords = []
-        chain_n_coords = []
-        chain_c_coords = []
-        chain_chis = []
-        chain_chi_masks = []
-        count = 0
-        invalid_res_ids = []
-        for res_idx, residue in enumerate(chain):
-            if residue.get_resname() == 'HOH':
-                invalid_res_ids.append(residue.get_id())
-                continue
-            residue_coords = []
-            c_alpha, n, c = None, None, None
-            for atom in residue:
-                if atom.name == 'CA':
-                    c_alpha = list(atom.get_vector())
-                if atom.name == 'N':
-                    n = list(atom.get_vector())
-                if atom.name == 'C':
-                    c = list(atom.get_vector())
-                residue_coords.append(list(atom.get_vector()))
-
-            if c_alpha != None and n != None and c != None:
-                # only append residue if it is an amino acid and not some weird molecule that is part of the complex
-                chain_c_alpha_coords.append(c_alpha)
-                chain_n_coords.append(n)
-                chain_c_coords.append(c)
-                chain_coords.append(np.array(residue_coords))
-                chi_list,chi_mask = torsion_worker.calculate_torsion(residue)
-                chain_chis.append(chi_list)
-                chain_chi_masks.append(chi_mask)
-                count += 1
-            else:
-                invalid_res_ids.append(residue.get_id())
-        for res_id in invalid_res_ids:
-            chain.detach_child(res_id)
-        if len(chain_coords) > 0:
-            all_chain_coords = np.concatenate(chain_coords, axis=0)
-            distances = spatial.distance.cdist(lig_coords, all_chain_coords)
-            min_distance = distances.min()
-        else:
-            min_distance = np.inf
-
-        min_distances.append(min_distance)
-        lengths.append(count)
-        coords.append(chain_coords)
-        c_alpha_coords.append(np.array(chain_c_alpha_coords))
-        n_coords.append(np.array(chain_n_coords))
-        c_coords.append(np.array(chain_c_coords))
-        chis.append(np.array(chain_chis))
-        chi_masks.append(np.array(chain_chi_masks))
-        if not count == 0: valid_chain_ids.append(chain.get_id())
-
-    min_distances = np.array(min_distances)
-    if len(valid_chain_ids) == 0:
-        valid_chain_ids.append(np.argmin(min_distances))
-    valid_coords = []
-    valid_c_alpha_coords = []
-    valid_n_coords = []
-    valid_c_coords = []
-    valid_chis = []
-    valid_chi_masks = []
-    valid_lengths = []
     invalid_chain_ids = []
-    valid_lm_embeddings = []
-    for i, chain in enumerate(rec):
-        if chain.get_id() in valid_chain_ids:
-            valid_coords.append(coords[i])
-            valid_c_alpha_coords.append(c_alpha_coords[i])
-            if lm_embedding_chains is not None:
-                if i >= len(lm_embedding_chains):
-                    print(i,lm_embedding_chains)
-                    raise ValueError('Encountered valid chain id that was not present in the LM embeddings')
-                valid_lm_embeddings.append(lm_embedding_chains[i])
-            valid_n_coords.append(n_coords[i])
-            valid_c_coords.append(c_coords[i])
-            valid_chis.append(chis[i])
-            valid_chi_masks.append(chi_masks[i])
-            valid_lengths.append(lengths[i])
+    valid_chain_indices = []
+    for i, chain in enumerate(list(rec)):
+        in_chain = residues['chain_index'] == i
+        for res_id in residues[in_chain & ~valid_residues][['hetfield', 'resseq', 'icode']].tolist():
+            chain.detach_child(res_id)
+        if (in_chain & valid_residues).any():
+            valid_chain_ids.append(chain.get_id())
+            valid_chain_indices.append(i)
         else:
             invalid_chain_ids.append(chain.get_id())
-    coords = [item for sublist in valid_coords for item in sublist]  # list with n_residues arrays: [n_atoms, 3]
+    if len(valid_chain_ids) == 0:
+        raise ValueError('No valid chains (residues with CA, N and C atoms) were found in the receptor')
 
-    c_alpha_coords = np.concatenate(valid_c_alpha_coords, axis=0)  # [n_residues, 3]
-    n_coords = np.concatenate(valid_n_coords, axis=0)  # [n_residues, 3]
-    c_coords = np.concatenate(valid_c_coords, axis=0)  # [n_residues, 3]
-    chis = np.concatenate(valid_chis, axis=0)
-    chi_masks = np.concatenate(valid_chi_masks, axis=0)
+    valid_lm_embeddings = []
+    if lm_embedding_chains is not None:
+        for i in valid_chain_indices:
+            if i >= len(lm_embedding_chains):
+                print(i,lm_embedding_chains)
+                raise ValueError('Encountered valid chain id that was not present in the LM embeddings')
+            valid_lm_embeddings.append(lm_embedding_chains[i])
+
+    # list with n_residues arrays: [n_atoms, 3]
+    coords = np.split(atom_coords[valid_atoms], np.cumsum(residue_sizes[valid_residues])[:-1])
+    c_alpha_coords = atom_coords[backbone[valid_residues, 0]]  # [n_residues, 3]
+    n_coords = atom_coords[backbone[valid_residues, 1]]  # [n_residues, 3]
+    c_coords = atom_coords[backbone[valid_residues, 2]]  # [n_residues, 3]
+    chis = chis[valid_residues]
+    chi_masks = chi_masks[valid_residues]
     lm_embeddings = np.concatenate(valid_lm_embeddings, axis=0) if lm_embedding_chains is not None else None
     for invalid_id in invalid_chain_ids:
         rec.detach_child(invalid_id)
@@ -277,7 +215,7 @@ def extract_receptor_structure(rec, lig=None, lm_embedding_chains=None):
     assert len(c_alpha_coords) == len(c_coords)
     assert len(chis) == len(c_alpha_coords)
     assert len(chi_masks) == len(c_alpha_coords)
-    assert sum(valid_lengths) == len(c_alpha_coords)
+    assert len(coords) == len(c_alpha_coords)
 
     return rec, coords, c_alpha_coords, n_coords, c_coords, chis, chi_masks, lm_embeddings
 
@@ -303,13 +241,26 @@ def get_lig_graph(mol, complex_graph):
     complex_graph['ligand', 'lig_bond', 'ligand'].edge_attr = edge_attr
     return
 
-def generate_conformer(mol):
+def generate_conformer(mol, num_threads=1, seed=-1, max_attempts=50):
     ps = AllChem.ETKDGv2()
-    # id = AllChem.EmbedMolecule(mol, ps)
-    for repeat in range(50):
-        rid = AllChem.EmbedMolecule(mol, ps)
-        if rid == 0:
+    ps.numThreads = num_threads
+    ps.randomSeed = seed
+    # the first attempt almost always works, retries are embedded num_threads at a time and the first conformer
+    # that worked becomes conformer 0
+    rid, attempts = -1, 0
+    while attempts < max_attempts:
+        num_confs = 1 if attempts == 0 else max(num_threads, 1)
+        cids = list(AllChem.EmbedMultipleConfs(mol, numConfs=num_confs, params=ps))
+        attempts += num_confs
+        if len(cids) > 0:
+            conf = Chem.Conformer(mol.GetConformer(cids[0]))
+            conf.SetId(0)
+            mol.RemoveAllConformers()
+            mol.AddConformer(conf, assignId=False)
+            rid = 0
             break
+        if seed != -1:
+            ps.randomSeed = seed + attempts
     if rid == -1:
         print('rdkit coords could not be generated without using random coords. using random coords now.')
         ps.useRandomCoords = True
@@ -317,7 +268,6 @@ def generate_conformer(mol):
         AllChem.MMFFOptimizeMolecule(mol, confId=0)
     # else:
     #    AllChem.MMFFOptimizeMolecule(mol_rdkit, confId=0)
-    # Ã¥Â°ï¿½Ã¨Â¯â€¢Ã§â€�Â¨Ã¥Å â€ºÃ¥Å“ÂºÃ¤Â¼ËœÃ¥Å’â€“Ã¦Å¾â€žÃ¨Â±Â¡ 2023.07.09
     AllChem.MMFFOptimizeMolecule(mol, mmffVariant='MMFF94s', maxIters=500)
 
 
@@ -392,6 +342,51 @@ def get_align_rotran(coords,reference_coords):
     tran = av2 - dot(av1, rot)
     return tran, rot
 
+def get_calpha_neighbors(name, c_alpha_coords, n_coords, c_coords, cutoff, max_neighbor=None):
+    """
+    Residue graph shared by get_calpha_graph and get_fullrec_graph: every residue is connected to all other residues
+    closer than cutoff (in index order), or to its max_neighbor closest ones (in distance order). Returns the src/dst
+    edge lists, the per residue mu_r_norm features [n_residues, 5] and the local frame points [n_residues, 3, 3].
+    """
+    num_residues = len(c_alpha_coords)
+    # neighbour search with a KD-tree instead of the dense distance matrix, the distances of the candidate pairs
+    # are recomputed the same way cdist does so the cutoff is applied to exactly the same values
+    pairs = spa.cKDTree(c_alpha_coords).query_pairs(cutoff * (1 + 1e-6), output_type='ndarray')
+    src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    diff = c_alpha_coords[src] - c_alpha_coords[dst]
+    dist = np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1] + diff[:, 2] * diff[:, 2])
+    within = dist < cutoff
+    src, dst, dist = src[within], dst[within], dist[within]
+
+    counts = np.bincount(src, minlength=num_residues)
+    if (counts == 0).any():
+        print(f'{name}_res{np.flatnonzero(counts == 0)[0]}: The c_alpha_cutoff {cutoff} was too small for one c_alpha such that it had no neighbors. '
+              f'So we connected it to the closest other c_alpha')
+        assert 1==0, 'isolated residue'
+    truncated = counts > max_neighbor if max_neighbor != None else np.zeros(num_residues, dtype=bool)
+    # rows are sorted by neighbour index, or by distance when they have to be cut to max_neighbor
+    order = np.lexsort((dst, np.where(truncated[src], dist, 0.), src))
+    src, dst, dist = src[order], dst[order], dist[order]
+    if truncated.any():
+        row_start = np.r_[0, np.cumsum(counts)[:-1]]
+        keep = np.arange(len(src)) - row_start[src] < max_neighbor
+        src, dst, dist = src[keep], dst[keep], dist[keep]
+    row_start = np.flatnonzero(np.r_[True, src[1:] != src[:-1]])
+
+    # segment softmax over the neighbours of every residue for the five sigmas
+    sigma = np.array([1., 2., 5., 10., 30.])
+    logits = - dist[:, None] ** 2 / sigma  # (edge_num, sigma_num)
+    weights = np.exp(logits - np.maximum.reduceat(logits, row_start)[src])
+    weights = weights / np.add.reduceat(weights, row_start)[src]
+    diff_vecs = c_alpha_coords[src] - c_alpha_coords[dst]  # (edge_num, 3)
+    mean_vec = np.stack([np.add.reduceat(weights * diff_vecs[:, [k]], row_start) for k in range(3)], axis=2)  # (n_residues, sigma_num, 3)
+    denominator = np.add.reduceat(weights * np.linalg.norm(diff_vecs, axis=1)[:, None], row_start)  # (n_residues, sigma_num)
+    mean_norms = np.linalg.norm(mean_vec, axis=2) / denominator
+    lf_3pts = np.stack([n_coords, c_alpha_coords, c_coords], axis=1)
+    return src, dst, mean_norms, lf_3pts
+
+
 def get_calpha_graph(name,rec, af2_rec, c_alpha_coords, n_coords, c_coords, chis, chi_masks, complex_graph, cutoff=20, max_neighbor=None, lm_embeddings=None):
     n_rel_pos = n_coords - c_alpha_coords
     c_rel_pos = c_coords - c_alpha_coords
@@ -400,46 +395,16 @@ def get_calpha_graph(name,rec, af2_rec, c_alpha_coords, n_coords, c_coords, chis
         raise ValueError(f"rec contains only 1 residue!")
 
     # Build the k-NN graph
-    distances = spa.distance.cdist(c_alpha_coords, c_alpha_coords)
-    src_list = []
-    dst_list = []
-    mean_norm_list = []
-    lf_3pts = []
-    for i in range(num_residues):
-        dst = list(np.where(distances[i, :] < cutoff)[0])
-        dst.remove(i)
-        if max_neighbor != None and len(dst) > max_neighbor:
-            dst = list(np.argsort(distances[i, :]))[1: max_neighbor + 1]
-        if len(dst) == 0:
-            dst = list(np.argsort(distances[i, :]))[1:2]  # choose second because first is i itself
-            print(f'{name} : The c_alpha_cutoff {cutoff} was too small for one c_alpha such that it had no neighbors. '
-                  f'So we connected it to the closest other c_alpha')
-            assert 1==0, 'isolated residue'
-        assert i not in dst
-        src = [i] * len(dst)
-        src_list.extend(src)
-        dst_list.extend(dst)
-        valid_dist = list(distances[i, dst])
-        valid_dist_np = distances[i, dst]
-        sigma = np.array([1., 2., 5., 10., 30.]).reshape((-1, 1))
-        weights = softmax(- valid_dist_np.reshape((1, -1)) ** 2 / sigma, axis=1)  # (sigma_num, neigh_num)
-        assert weights[0].sum() > 1 - 1e-2 and weights[0].sum() < 1.01
-        diff_vecs = c_alpha_coords[src, :] - c_alpha_coords[dst, :]  # (neigh_num, 3)
-        mean_vec = weights.dot(diff_vecs)  # (sigma_num, 3)
-        denominator = weights.dot(np.linalg.norm(diff_vecs, axis=1))  # (sigma_num,)
-        mean_vec_ratio_norm = np.linalg.norm(mean_vec, axis=1) / denominator  # (sigma_num,)
-        mean_norm_list.append(mean_vec_ratio_norm)
-        lf_3pts.append(np.array([n_coords[i], c_alpha_coords[i], c_coords[i]]))
-    assert len(src_list) == len(dst_list)
+    src, dst, mean_norms, lf_3pts = get_calpha_neighbors(name, c_alpha_coords, n_coords, c_coords, cutoff, max_neighbor)
 
     node_feat = rec_residue_featurizer(rec)
-    mu_r_norm = torch.from_numpy(np.array(mean_norm_list).astype(np.float32))
+    mu_r_norm = torch.from_numpy(mean_norms.astype(np.float32))
     side_chain_vecs = torch.from_numpy(
         np.concatenate([np.expand_dims(n_rel_pos, axis=1), np.expand_dims(c_rel_pos, axis=1)], axis=1))
 
     complex_graph['receptor'].x = torch.cat([node_feat, torch.tensor(lm_embeddings)], axis=1) if lm_embeddings is not None else node_feat
     complex_graph['receptor'].pos = torch.from_numpy(c_alpha_coords).float()
-    complex_graph['receptor'].lf_3pts = torch.from_numpy(np.array(lf_3pts)).float()
+    complex_graph['receptor'].lf_3pts = torch.from_numpy(lf_3pts).float()
     # complex_graph['receptor'].local_frames = get_local_frames(torch.from_numpy(np.array(lf_3pts)).float())
     complex_graph['receptor'].mu_r_norm = mu_r_norm
     complex_graph['receptor'].chis = torch.from_numpy(chis).float()
@@ -447,7 +412,7 @@ def get_calpha_graph(name,rec, af2_rec, c_alpha_coords, n_coords, c_coords, chis
     complex_graph['receptor'].chi_masks = torch.from_numpy(chi_masks[:,:7]).float()
     complex_graph['receptor'].chi_symmetry_masks = torch.from_numpy(chi_masks[:,7:]).long()
     complex_graph['receptor'].side_chain_vecs = side_chain_vecs.float()
-    complex_graph['receptor', 'rec_contact', 'receptor'].edge_index = torch.from_numpy(np.asarray([src_list, dst_list]))
+    complex_graph['receptor', 'rec_contact', 'receptor'].edge_index = torch.from_numpy(np.asarray([src, dst]))
     if af2_rec is not None:
         assert ((complex_graph['ligand'].pos[None,...] - complex_graph['receptor'].pos[:,None,...]).norm(dim=-1)<15.).sum() > 0, f'{name} ligand is far away from the receptor'
         af2_rec, af2_coords, af2_c_alpha_coords, af2_n_coords, af2_c_coords, af2_chis, af2_chi_masks, af2_lm_embeddings = extract_receptor_structure(af2_rec)
@@ -514,49 +479,20 @@ def get_fullrec_graph(name, rec, rec_coords, c_alpha_coords, n_coords, c_coords,
         raise ValueError(f"rec contains only 1 residue!")
 
     # Build the k-NN graph of residues
-    distances = spa.distance.cdist(c_alpha_coords, c_alpha_coords)
-    src_list = []
-    dst_list = []
-    mean_norm_list = []
-    lf_3pts = []
-    for i in range(num_residues):
-        dst = list(np.where(distances[i, :] < c_alpha_cutoff)[0])
-        dst.remove(i)
-        if c_alpha_max_neighbors != None and len(dst) > c_alpha_max_neighbors:
-            dst = list(np.argsort(distances[i, :]))[1: c_alpha_max_neighbors + 1]
-        if len(dst) == 0:
-            dst = list(np.argsort(distances[i, :]))[1:2]  # choose second because first is i itself
-            print(f'{name}_res{i}: The c_alpha_cutoff {c_alpha_cutoff} was too small for one c_alpha such that it had no neighbors. '
-                  f'So we connected it to the closest other c_alpha')
-            assert 1==0, 'isolated residue'
-        assert i not in dst
-        src = [i] * len(dst)
-        src_list.extend(src)
-        dst_list.extend(dst)
-        valid_dist = list(distances[i, dst])
-        valid_dist_np = distances[i, dst]
-        sigma = np.array([1., 2., 5., 10., 30.]).reshape((-1, 1))
-        weights = softmax(- valid_dist_np.reshape((1, -1)) ** 2 / sigma, axis=1)  # (sigma_num, neigh_num)
-        assert 1 - 1e-2 < weights[0].sum() < 1.01
-        diff_vecs = c_alpha_coords[src, :] - c_alpha_coords[dst, :]  # (neigh_num, 3)
-        mean_vec = weights.dot(diff_vecs)  # (sigma_num, 3)
-        denominator = weights.dot(np.linalg.norm(diff_vecs, axis=1))  # (sigma_num,)
-        mean_vec_ratio_norm = np.linalg.norm(mean_vec, axis=1) / denominator  # (sigma_num,)
-        mean_norm_list.append(mean_vec_ratio_norm)
-        lf_3pts.append(np.array([n_coords[i], c_alpha_coords[i], c_coords[i]]))
-    assert len(src_list) == len(dst_list)
+    src, dst, mean_norms, lf_3pts = get_calpha_neighbors(name, c_alpha_coords, n_coords, c_coords, c_alpha_cutoff,
+                                                         c_alpha_max_neighbors)
 
     node_feat = rec_residue_featurizer(rec)
-    mu_r_norm = torch.from_numpy(np.array(mean_norm_list).astype(np.float32))
+    mu_r_norm = torch.from_numpy(mean_norms.astype(np.float32))
     side_chain_vecs = torch.from_numpy(
         np.concatenate([np.expand_dims(n_rel_pos, axis=1), np.expand_dims(c_rel_pos, axis=1)], axis=1))
 
     complex_graph['receptor'].x = torch.cat([node_feat, torch.tensor(lm_embeddings)], axis=1) if lm_embeddings is not None else node_feat
     complex_graph['receptor'].pos = torch.from_numpy(c_alpha_coords).float()
-    complex_graph['receptor'].lf_3pts = torch.from_numpy(np.array(lf_3pts)).float()
+    complex_graph['receptor'].lf_3pts = torch.from_numpy(lf_3pts).float()
     complex_graph['receptor'].mu_r_norm = mu_r_norm
     complex_graph['receptor'].side_chain_vecs = side_chain_vecs.float()
-    complex_graph['receptor', 'rec_contact', 'receptor'].edge_index = torch.from_numpy(np.asarray([src_list, dst_list]))
+    complex_graph['receptor', 'rec_contact', 'receptor'].edge_index = torch.from_numpy(np.asarray([src, dst]))
 
     src_c_alpha_idx = np.concatenate([np.asarray([i]*len(l)) for i, l in enumerate(rec_coords)])
     atom_feat = torch.from_numpy(np.asarray(rec_atom_featurizer(rec)))
@@ -578,8 +514,8 @@ def get_fullrec_graph(name, rec, rec_coords, c_alpha_coords, n_coords, c_coords,
 
     return
 
-def write_mol_with_coords(mol, new_coords, path, remove_output_hs):
-    w = Chem.SDWriter(path)
+def mol_with_coords(mol, new_coords, remove_output_hs):
+    # sets the coordinates of the conformer of mol in place, the returned molecule also has the hydrogens added or removed
     conf = mol.GetConformer()
     for i in range(mol.GetNumAtoms()):
         x,y,z = new_coords.astype(np.double)[i]
@@ -588,8 +524,11 @@ def write_mol_with_coords(mol, new_coords, path, remove_output_hs):
         mol = Chem.AddHs(mol, addCoords=True)
     else:
         mol = Chem.RemoveHs(mol)
-        
-    w.write(mol)
+    return mol
+
+def write_mol_with_coords(mol, new_coords, path, remove_output_hs):
+    w = Chem.SDWriter(path)
+    w.write(mol_with_coords(mol, new_coords, remove_output_hs))
     w.close()
 
 def read_molecule(molecule_file, sanitize=False, calc_charges=False, remove_hs=False):
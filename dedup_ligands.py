@@ -0,0 +1,49 @@
+import os
+from argparse import ArgumentParser
+from itertools import islice
+from multiprocessing import Pool
+
+from datasets.library import LibraryReader, list_ligands
+from utils.ligand_index import canonical_smiles, copy_results, previous_results, settings_key, write_index
+
+parser = ArgumentParser(description='Finds the duplicate ligands of a library and the ligands that were already docked in earlier runs, and writes the ligand index of a run (see utils/ligand_index.py)')
+parser.add_argument('ligand', type=str, help='Directory of the mol2/sdf ligand files, or a SDF/SMILES library file')
+parser.add_argument('out_dir', type=str, help='Output directory of the run, with the run_settings.json written by inferenceVS.py')
+parser.add_argument('--protein_path', type=str, required=True, help='The (cleaned) receptor of the run')
+parser.add_argument('--reuse', type=str, nargs='*', default=[], help='Output directories of earlier runs to copy results from')
+parser.add_argument('--cores', '-c', type=int, default=1, help='Processes used to read the ligands')
+args = parser.parse_args()
+
+ligands = list_ligands(args.ligand)
+# the records of a library are read in chunks, in order, and parsed by the pool
+reader, smiles_list = LibraryReader(), []
+with Pool(max(1, args.cores)) as pool:
+    entries = iter(ligands)
+    while chunk := list(islice(entries, 10000)):
+        smiles_list += pool.map(canonical_smiles, [reader.read(ligand) for _, ligand in chunk], chunksize=64)
+reader.close()
+
+settings = settings_key(args.out_dir, args.protein_path)
+previous = previous_results(args.reuse, settings)
+
+rows, representatives = [], {}
+reused, unreadable = 0, 0
+for (name, ligand), smiles in zip(ligands, smiles_list):
+    row = {'name': name, 'ligand': ligand, 'canonical_smiles': smiles or '', 'settings': settings,
+           'representative': name, 'source': ''}
+    if smiles is None:
+        # docked as before, inference.py records why it fails
+        unreadable += 1
+    elif smiles in representatives:
+        row['representative'] = representatives[smiles]
+    else:
+        representatives[smiles] = name
+        if smiles in previous and copy_results(previous[smiles][0], previous[smiles][1], args.out_dir, name):
+            row['source'] = os.path.abspath(previous[smiles][0])
+            reused += 1
+    rows.append(row)
+write_index(args.out_dir, rows)
+
+duplicate_count = sum(row['representative'] != row['name'] for row in rows)
+print(f"{len(rows)} ligands: {duplicate_count} duplicates, {reused} docked in earlier runs, "
+      f"{len(rows) - duplicate_count - reused} to dock ({unreadable} could not be read and are docked as they are)")
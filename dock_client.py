@@ -0,0 +1,33 @@
+import os
+import sys
+from argparse import ArgumentParser
+
+from utils.service import DockingClient, DEFAULT_PORT
+
+parser = ArgumentParser(description='Dock ligands with a running server.py')
+parser.add_argument('--server', '-s', type=str, default=f'localhost:{DEFAULT_PORT}', help='host:port of the server, or the path of its Unix socket')
+parser.add_argument('--receptor', '-r', type=str, default=None, help='Receptor .pdb/.cif file, its ESM embeddings have to be in the embeddings directory of the server')
+parser.add_argument('--ligand', '-l', type=str, nargs='+', default=[], help='SMILES strings or ligand files')
+parser.add_argument('--names', type=str, nargs='+', default=None, help='Names of the ligands, defaults to the file names or ligand_<n>')
+parser.add_argument('--out_dir', '-o', type=str, default=None, help='Let the server write the poses and receptors of every ligand to this directory')
+parser.add_argument('--health', action='store_true', default=False, help='Only print the status of the server')
+args = parser.parse_args()
+
+client = DockingClient(args.server)
+if args.health:
+    print(client.health())
+    sys.exit(0)
+if args.receptor is None or not args.ligand:
+    parser.error('--receptor and --ligand are required')
+names = args.names or [os.path.basename(ligand).split('.')[0] if os.path.isfile(ligand) else f'ligand_{i}' for i, ligand in enumerate(args.ligand)]
+if len(names) != len(args.ligand):
+    parser.error('--names needs a name for every ligand')
+
+failed = 0
+for result in client.dock(args.receptor, args.ligand, names=names, out_dir=args.out_dir, poses=False):
+    if result['error'] is not None:
+        failed += 1
+        print(f"{result['name']}: failed, {result['error']}", flush=True)
+    else:
+        print(f"{result['name']}: affinity {result['final_affinity']:.2f}, lddt {result['lddt'][0]:.2f}, clash {result['clash'][0]:.2f}", flush=True)
+sys.exit(1 if failed else 0)
@@ -1,35 +1,16 @@
 import copy
+import glob
 import os
-import torch
 import shutil
+import signal
+import sys
 import warnings
 warnings.filterwarnings("ignore")
 
 import time
 from argparse import ArgumentParser, Namespace, FileType
-from rdkit.Chem import RemoveHs
 from functools import partial
-import numpy as np
-import pandas as pd
-import scipy
-from Bio.PDB import PDBParser
-
-from rdkit import RDLogger
-from rdkit.Chem import MolFromSmiles, AddHs
-from rdkit import Chem
-
-import torch
-from torch_geometric.loader import DataLoader
 
-
-from datasets.process_mols import read_molecule, generate_conformer, write_mol_with_coords
-from datasets.pdbbind import PDBBind
-from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl, get_t_schedule, set_time
-from utils.sampling import randomize_position, sampling
-from utils.utils import get_model
-from utils.visualise import LigandToPDB, modify_pdb, receptor_to_pdb, save_protein
-from utils.clash import compute_side_chain_metrics
-# from utils.relax import openmm_relax
 from tqdm import tqdm
 import datetime
 from contextlib import contextmanager
@@ -42,15 +23,6 @@ import pickle
 import subprocess
 # pool = ThreadPool(8)
 
-@contextmanager
-def Timer(title):
-    'timing function'
-    t0 = datetime.datetime.now()
-    yield
-    print("%s - done in %is"%(title, (datetime.datetime.now() - t0).seconds))
-    return None
-
-RDLogger.DisableLog('rdApp.*')
 import yaml
 parser = ArgumentParser()
 parser.add_argument('--config', type=FileType(mode='r'), default=None)
@@ -70,7 +42,13 @@ parser.add_argument('--confidence_model_dir', type=str, default=None, help='Path
 parser.add_argument('--confidence_ckpt', type=str, default='best_model_epoch75.pt', help='Checkpoint to use for the confidence model')
 
 parser.add_argument('--batch_size', type=int, default=32, help='')
+parser.add_argument('--batch_budget', type=str, default=None, help='Pack the graphs of the reverse diffusion into batches by estimated size (receptor residues, ligand atoms and edges) up to this budget instead of --batch_size graphs. \'auto\' derives the budget from the free GPU memory, or from --memory_limit and the job memory on the CPU')
+parser.add_argument('--memory_limit', type=float, default=None, help='Memory in GB that --batch_budget auto can use on the CPU. Defaults to the memory limit of the job (cgroup) or the available memory')
+parser.add_argument('--compile', action='store_true', default=False, help='On the GPU, run the score model through torch.compile (see models/inference_model.py). The compiled kernels are cached on disk, falls back to the eager model if compilation fails')
+parser.add_argument('--compile_cache', type=str, default=None, help='Directory of the compile cache, defaults to $DYNAMICBIND_COMPILE_CACHE or .compile_cache in the repository')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16', 'int8-dynamic'], help='Numeric precision of the score and confidence models: bf16 or fp16 autocast (fp16 on the GPU only, bf16 on GPUs and on CPUs with AVX512-BF16/AMX), or int8-dynamic quantisation of the linear layers on the CPU. Falls back to fp32 where the precision is not supported. python -m benchmarks.precision reports the speed and the deviation from fp32')
 parser.add_argument('--cache_path', type=str, default='data/cache', help='Folder from where to load/restore cached dataset')
+parser.add_argument('--scratch', type=str, nargs='?', const='', default=None, help='Stage the inputs, the cache and the outputs of this job on node-local storage: this directory, or $SLURM_TMPDIR or $TMPDIR when no directory is given. The outputs are shipped to --out_dir/archives as tar archives (see utils/scratch.py)')
 parser.add_argument('--no_random', action='store_true', default=False, help='Use no randomness in reverse diffusion')
 parser.add_argument('--no_final_step_noise', action='store_true', default=False, help='Use no noise in the final step of the reverse diffusion')
 parser.add_argument('--ode', action='store_true', default=False, help='Use ODE formulation for inference')
@@ -82,20 +60,68 @@ parser.add_argument('--keep_local_structures', action='store_true', default=Fals
 parser.add_argument('--protein_dynamic', action='store_true', default=False, help='Use no noise in the final step of the reverse diffusion')
 parser.add_argument('--relax', action='store_true', default=False, help='Use no noise in the final step of the reverse diffusion')
 parser.add_argument('--use_existing_cache', action='store_true', default=False, help='Use existing cache file, if they exist.')
+parser.add_argument('--conformer_timeout', type=int, default=300, help='Maximum number of seconds to generate the conformer of a single ligand (0 for no limit)')
+parser.add_argument('--ligand_timeout', type=int, default=0, help='Maximum number of seconds the graphs and the reverse diffusion of a single ligand can take (0 for no limit). Ligands that take longer are skipped and recorded in the run journal')
 
 parser.add_argument('--cores', '-c', type=int, default=1, help='How many cores to use.')
+parser.add_argument('--devices', type=str, nargs='+', default=None, help='GPUs to run sampling workers on, e.g. 0 1 2 3, or all for every visible GPU. The workers share the ligands preprocessed by this process and the cores. By default the job runs in a single process on the first GPU, or on the CPU')
+parser.add_argument('--cpu_workers', type=int, default=0, help='Number of sampling workers on the CPU, next to the GPU workers of --devices')
+parser.add_argument('--writers', type=int, default=0, help='Number of processes that write the output structures, score their clashes and rank them, while sampling goes on with the next ligand (see utils/writer.py). By default the outputs are written by the sampling process')
+parser.add_argument('--writer_queue', type=int, default=None, help='Docked ligands that can wait for a writer before sampling pauses, defaults to twice --writers')
 parser.add_argument('--delete_cache', action='store_true', default=False, help='Keep the generated cache')
 parser.add_argument('--remove_output_hs', action='store_true', default=False, help='Don\'t include explicit hydrogens in the output ligands')
 
 args = parser.parse_args()
+if args.batch_budget is not None and args.batch_budget != 'auto' and not (args.batch_budget.isdigit() and int(args.batch_budget) > 0):
+    parser.error('--batch_budget must be a positive integer or auto')
 
 beginTime = time.time()
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# the heavy dependencies are only imported once the arguments are known to be valid, so --help and argument errors
+# return immediately
+import numpy as np
+import pandas as pd
+import scipy
+import torch
+from rdkit import RDLogger
+from rdkit.Chem import RemoveHs
+from torch_geometric.loader import DataLoader
+
+from datasets.process_mols import write_mol_with_coords
+from datasets.pdbbind import PDBBind
+from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl, get_t_schedule
+from utils.sampling import randomize_position, sampling
+from utils.utils import get_model, time_limit, TimeoutException
+from utils.batching import GraphBudget
+from utils.visualise import modify_pdb_from_arrays, save_protein
+from utils.clash import compute_side_chain_metrics
+from utils.journal import RunJournal, journal_path
+from utils.ligand_index import result_paths
+from utils.pool import TASK_OK, TASK_TIMEOUT
+from utils.devices import CPU, run_workers, worker_devices
+from utils.metrics import LigandMetrics, MetricsRecorder, metrics_path
+from utils.scratch import ScratchStage, default_scratch
+from utils.writer import OutputWriter
+from utils.pdb_writer import ReceptorTemplate
+if args.save_visualisation:
+    from utils.trajectory import trajectory_frame, trajectory_path, save_trajectory, save_reference_structures
+# from utils.relax import openmm_relax
+
+RDLogger.DisableLog('rdApp.*')
+
+# one sampling worker per GPU of --devices plus the --cpu_workers, sharing the preprocessed ligands (utils/devices.py)
+workers = worker_devices(args.devices, args.cpu_workers) or None
+# the parent of the workers must not initialise CUDA, they could not use it after the fork
+device = torch.device('cuda' if workers is None and torch.cuda.is_available() else 'cpu')
 
 try:
-    torch.set_num_threads(args.cores)
-    print(f"DynamicBind will run on {device}, and use {args.cores} CPU core(s)")
+    # OpenMP hangs in forked workers once the parent has started its threads, the parent of the workers stays single
+    # threaded (the conformers have their own pool) and every worker gets its share of the cores
+    torch.set_num_threads(args.cores if workers is None else 1)
+    if workers is None:
+        print(f"DynamicBind will run on {device}, and use {args.cores} CPU core(s)")
+    else:
+        print(f"DynamicBind will run {len(workers)} sampling workers ({', '.join('cpu' if w == CPU else f'GPU {w}' for w in workers)}), and use {args.cores} CPU core(s)")
 except:
 
     print("Something went wrong when specifying the requested number of threads, a different amount of resources might be used..")
@@ -107,8 +133,13 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 outputDirList = []
 
+job_name = os.path.splitext(os.path.basename(args.protein_ligand_csv))[0] if args.protein_ligand_csv is not None else 'inference'
+# with --scratch the structures are written to the node and shipped to args.out_dir in archives
+scratch = ScratchStage(args.scratch or default_scratch(), args.out_dir, job_name) if args.scratch is not None else None
+results_dir = scratch.local_out if scratch is not None else args.out_dir
+
 if not args.save_visualisation:
-    outputDirList = [f'{args.out_dir}/molecules/']
+    outputDirList = [f'{results_dir}/molecules/']
     
 def Seed_everything(seed=42):
     random.seed(seed)
@@ -139,7 +170,8 @@ if args.confidence_model_dir is not None:
         confidence_args = Namespace(**yaml.full_load(f))
 
 if args.protein_ligand_csv is not None:
-    df = pd.read_csv(args.protein_ligand_csv, sep=";")
+    # names of library records can be numeric IDs, they stay strings like the file names
+    df = pd.read_csv(args.protein_ligand_csv, sep=";", dtype=str)
 
     if 'crystal_protein_path' not in df.columns:
         df['crystal_protein_path'] = df['protein_path']
@@ -150,6 +182,17 @@ else:
     protein_path_list = [args.protein_path]
     ligand_descriptions = [args.ligand]
 
+journal = RunJournal(journal_path(args.out_dir, job_name), job_name)
+metrics = MetricsRecorder(metrics_path(args.out_dir, job_name), job_name)
+
+if scratch is not None:
+    if score_model_args.esm_embeddings_path is not None:
+        args.esm_embeddings_path = scratch.stage_embeddings(args.esm_embeddings_path, protein_path_list)
+    protein_path_list = [scratch.stage(protein_path) for protein_path in protein_path_list]
+    ligand_descriptions = [scratch.stage(ligand_description) for ligand_description in ligand_descriptions]
+    if not args.use_existing_cache:
+        args.cache_path = scratch.cache_path
+
 test_dataset = PDBBind(transform=None, root='', name_list=name_list, protein_path_list=protein_path_list, ligand_descriptions=ligand_descriptions,
                        receptor_radius=score_model_args.receptor_radius, cache_path=args.cache_path,
                        remove_hs=score_model_args.remove_hs, max_lig_size=None,
@@ -158,32 +201,48 @@ test_dataset = PDBBind(transform=None, root='', name_list=name_list, protein_pat
                        all_atoms=score_model_args.all_atoms, atom_radius=score_model_args.atom_radius,
                        atom_max_neighbors=score_model_args.atom_max_neighbors,
                        esm_embeddings_path= args.esm_embeddings_path if score_model_args.esm_embeddings_path is not None else None,
-                       require_ligand=True,require_receptor=True, num_workers=args.num_workers, keep_local_structures=args.keep_local_structures, use_existing_cache=args.use_existing_cache)
+                       require_ligand=True,require_receptor=True, num_workers=args.num_workers, keep_local_structures=args.keep_local_structures, use_existing_cache=args.use_existing_cache,
+                       num_conformer_workers=args.cores, conformer_timeout=args.conformer_timeout or None, conformer_seed=args.seed, ligand_timeout=args.ligand_timeout, journal=journal, metrics=metrics)
 test_loader = DataLoader(dataset=test_dataset, batch_size=1, shuffle=False)
 
 t_to_sigma = partial(t_to_sigma_compl, args=score_model_args)
 
-model = get_model(score_model_args, device, t_to_sigma=t_to_sigma, no_parallel=True)
-state_dict = torch.load(f'{args.model_dir}/{args.ckpt}', map_location=torch.device('cpu'))
-model.load_state_dict(state_dict, strict=True)
-model = model.to(device)
-model.eval()
+def load_models(device):
+    """The score model and the confidence model (None without --confidence_model_dir) on device"""
+    model = get_model(score_model_args, device, t_to_sigma=t_to_sigma, no_parallel=True)
+    state_dict = torch.load(f'{args.model_dir}/{args.ckpt}', map_location=torch.device('cpu'))
+    model.load_state_dict(state_dict, strict=True)
+    model = model.to(device)
+    model.eval()
+    if args.compile:
+        if score_model_args.all_atoms:
+            print('--compile only supports the residue level score model, running the model eagerly')
+        else:
+            from models.inference_model import InferenceScoreModel
+            model = InferenceScoreModel(model, cache_dir=args.compile_cache)
+    if args.precision != 'fp32':
+        from utils.precision import apply_precision
+        model = apply_precision(model, args.precision, device)
 
-if args.confidence_model_dir is not None:
-    if confidence_args.transfer_weights:
-        with open(f'{confidence_args.original_model_dir}/model_parameters.yml') as f:
-            confidence_model_args = Namespace(**yaml.full_load(f))
-    else:
-        confidence_model_args = confidence_args
-    confidence_model = get_model(confidence_model_args, device, t_to_sigma=t_to_sigma, no_parallel=True, confidence_mode=True)
-    state_dict = torch.load(f'{args.confidence_model_dir}/{args.confidence_ckpt}', map_location=torch.device('cpu'))
-    confidence_model.load_state_dict(state_dict, strict=True)
-    confidence_model = confidence_model.to(device)
-    confidence_model.eval()
-else:
     confidence_model = None
-    confidence_args = None
-    confidence_model_args = None
+    if args.confidence_model_dir is not None:
+        if confidence_args.transfer_weights:
+            with open(f'{confidence_args.original_model_dir}/model_parameters.yml') as f:
+                confidence_model_args = Namespace(**yaml.full_load(f))
+        else:
+            confidence_model_args = confidence_args
+        confidence_model = get_model(confidence_model_args, device, t_to_sigma=t_to_sigma, no_parallel=True, confidence_mode=True)
+        state_dict = torch.load(f'{args.confidence_model_dir}/{args.confidence_ckpt}', map_location=torch.device('cpu'))
+        confidence_model.load_state_dict(state_dict, strict=True)
+        confidence_model = confidence_model.to(device)
+        confidence_model.eval()
+        if args.precision != 'fp32':
+            confidence_model = apply_precision(confidence_model, args.precision, device)
+    return model, confidence_model
+
+# with several sampling workers every worker loads the models on its own device
+if workers is None:
+    model, confidence_model = load_models(device)
 
 tr_schedule = get_t_schedule(inference_steps=args.inference_steps)
 rot_schedule = tr_schedule
@@ -199,54 +258,48 @@ print('Size of test dataset: ', len(test_dataset))
 
 affinity_pred = {}
 all_complete_affinity = []
+# with --batch_budget auto the budget is calibrated on the first complex and then lowered whenever a batch runs out of memory
+graph_budget = GraphBudget(int(args.batch_budget), score_model_args) if args.batch_budget not in (None, 'auto') else None
 
 def predict_one_complex(affinity_pred, df, orig_complex_graph, model, tr_schedule, rot_schedule, tor_schedule, res_tr_schedule, res_rot_schedule, res_chi_schedule,
                     t_to_sigma, N, score_model_args, args, device, ):
+    global graph_budget
 
     data_list = [copy.deepcopy(orig_complex_graph) for _ in range(N)]
     randomize_position(data_list, score_model_args.no_torsion, args.no_random,score_model_args.tr_sigma_max,score_model_args.rot_sigma_max, score_model_args.tor_sigma_max,score_model_args.res_tr_sigma_max,score_model_args.res_rot_sigma_max)
-    data_list_randomized = copy.deepcopy(data_list)
+    data_list_randomized = [trajectory_frame(complex_graph) for complex_graph in data_list] if args.save_visualisation else None
     pdb = None
 
-    lig = orig_complex_graph.mol[0]
-    receptor_pdb = orig_complex_graph.rec_pdb[0]
-    pdb_or_cif = receptor_pdb.get_full_id()[0]
-    if score_model_args.remove_hs: lig = RemoveHs(lig)
+    ligand_metrics = metrics.ligand(orig_complex_graph.name[0])
     visualization_list = None
 
     start_time = time.time()
     confidence = None
     steps = args.actual_steps if args.actual_steps is not None else args.inference_steps
     final_data_list, data_list_step, all_lddt_pred, all_affinity_pred = [],[[] for _ in range(steps)],[],[]
-    for i in range(int(np.ceil(len(data_list)/args.batch_size))):
+    if args.batch_budget == 'auto' and graph_budget is None:
+        graph_budget = GraphBudget.calibrate(model, data_list[0], score_model_args, device,
+                                             memory_limit=args.memory_limit * 2 ** 30 if args.memory_limit else None)
+    # with a budget all the samples go through sampling() together and are batched by size there
+    chunk_size = len(data_list) if graph_budget is not None else args.batch_size
+    for i in range(int(np.ceil(len(data_list)/chunk_size))):
         # print(i, len(data_list), args.batch_size, int(np.ceil(len(data_list)/args.batch_size)))
         try:
-            outputs = sampling(data_list=data_list[i*args.batch_size:(i+1)*args.batch_size], model=model,
+            outputs = sampling(data_list=data_list[i*chunk_size:(i+1)*chunk_size], model=model,
                                 inference_steps=steps,
                                 tr_schedule=tr_schedule, rot_schedule=rot_schedule, tor_schedule=tor_schedule, res_tr_schedule=res_tr_schedule, res_rot_schedule=res_rot_schedule, res_chi_schedule=res_chi_schedule,
                                 device=device, t_to_sigma=t_to_sigma, model_args=score_model_args, no_random=args.no_random,
-                                ode=args.ode, visualization_list=visualization_list, batch_size=args.batch_size, no_final_step_noise=args.no_final_step_noise, protein_dynamic=args.protein_dynamic)
+                                ode=args.ode, visualization_list=visualization_list, batch_size=args.batch_size, no_final_step_noise=args.no_final_step_noise,
+                                return_per_step=args.save_visualisation, protein_dynamic=args.protein_dynamic, metrics=ligand_metrics,
+                                batch_budget=graph_budget)
             final_data_list.extend(outputs[0])
-            for si in range(steps):
-                for i,a in enumerate(outputs[1][si]):
-                    del a['mol']
-                    del a['rec_pdb']
-                    a['ligand'].pop('x')
-                    a['ligand'].pop('edge_mask')
-                    a['ligand'].pop('mask_rotate')
-                    a['ligand'].pop('batch')
-                    a['receptor'].pop('x')
-                    a['receptor'].pop('mu_r_norm')
-                    a['receptor'].pop('chis')
-                    a['receptor'].pop('side_chain_vecs')
-                    a['receptor'].pop('chi_symmetry_masks')
-                    a['receptor'].pop('batch')
-                    del a[('ligand', 'lig_bond', 'ligand')]
-                    del a[('receptor', 'rec_contact', 'receptor')]
+            for si in range(len(outputs[1])):
                 data_list_step[si].extend(outputs[1][si])
 
             all_lddt_pred.append(outputs[2])
             all_affinity_pred.append(outputs[3])
+        except TimeoutException:
+            raise
         except Exception as e:
             # raise e
             print(e)
@@ -255,30 +308,45 @@ def predict_one_complex(affinity_pred, df, orig_complex_graph, model, tr_schedul
     all_lddt_pred = torch.cat(all_lddt_pred)
     all_affinity_pred = torch.cat(all_affinity_pred)
     ligand_pos = np.asarray([complex_graph['ligand'].pos.cpu().numpy() + orig_complex_graph.original_center.cpu().numpy() for complex_graph in final_data_list])
-    final_receptor_pdbs = []
 
     # with Timer('modify pdb'):
     #     final_receptor_pdbs = pool.map(modify_pdb, zip([copy.deepcopy(receptor_pdb) for _ in range(len(data_list))], data_list))
     run_times.append(time.time() - start_time)
 
-    true_idx = final_data_list[0]["name"][0].replace("/","-").split("_")[-1]
-    if args.save_visualisation:
-        write_dir = f'{args.out_dir}/complexes/{orig_complex_graph.name[0]}/'
-        outputDirList.append(write_dir)
-    else:
-        write_dir = f'{args.out_dir}/molecules/'
-        
-    os.makedirs(write_dir, exist_ok=True)
-    row = df.loc[df['name']==data_list[0]["name"][0]]
-    protein_path = row['protein_path'].values[0]
-    ligand_path = row['ligand'].values[0]
-    
     all_lddt_pred = all_lddt_pred.view(-1).cpu().numpy()
     
     all_affinity_pred = all_affinity_pred.view(-1).cpu().numpy()
     final_affinity_pred = np.minimum((all_affinity_pred*all_lddt_pred).sum() / (all_lddt_pred.sum()+1e-12),15.)
 
     affinity_pred[orig_complex_graph.name[0]] = final_affinity_pred
+    names_list.append(orig_complex_graph.name[0])
+
+    # everything the output structures are built from as numpy arrays, small enough to hand over to a writer (--writers)
+    sampled = {'name': orig_complex_graph.name[0], 'ligand_pos': ligand_pos, 'lddt': all_lddt_pred, 'affinity': all_affinity_pred,
+               'receptors': [(complex_graph['receptor'].lf_3pts.cpu().numpy(), complex_graph['receptor'].acc_pred_chis.cpu().numpy())
+                             for complex_graph in final_data_list] if args.protein_dynamic else None,
+               'trajectories': [[data_list_randomized[order]] + [data_list[order] for data_list in data_list_step]
+                                for order in range(len(final_data_list))] if args.save_visualisation else None}
+    return affinity_pred, sampled
+
+def write_complex(sampled, lig, receptor_pdb, complex_graph, ligand_metrics):
+    """Writes the sampled ligands and receptors of a complex and ranks them by confidence and clashes. complex_graph
+    provides the step independent receptor data. Runs in an output writer with --writers"""
+    name = sampled['name']
+    ligand_pos, all_lddt_pred, all_affinity_pred = sampled['ligand_pos'], sampled['lddt'], sampled['affinity']
+    pdb_or_cif = receptor_pdb.get_full_id()[0]
+    if score_model_args.remove_hs: lig = RemoveHs(lig)
+    chi_masks = complex_graph['receptor'].chi_masks.cpu().numpy()[:,[0,2,4,5,6]]
+    # the PDB records are rendered once and every sample only fills in its coordinates (utils/pdb_writer.py)
+    template = ReceptorTemplate(receptor_pdb) if pdb_or_cif == 'pdb' else None
+
+    if args.save_visualisation:
+        write_dir = f'{results_dir}/complexes/{name}/'
+        outputDirList.append(write_dir)
+    else:
+        write_dir = f'{results_dir}/molecules/'
+        
+    os.makedirs(write_dir, exist_ok=True)
 
     ligandFiles = []
     pdbFiles = []
@@ -289,26 +357,36 @@ def predict_one_complex(affinity_pred, df, orig_complex_graph, model, tr_schedul
             prefix = ""
         else:
             prefix = "VS_DB_"    
-        ligandFile = os.path.join(write_dir, f'{prefix}{orig_complex_graph.name[0]}_step1_rank{rank+1}_ligand_lddt{all_lddt_pred[order]:.2f}_affinity{all_affinity_pred[order]:.2f}.sdf')
+        ligandFile = os.path.join(write_dir, f'{prefix}{name}_step1_rank{rank+1}_ligand_lddt{all_lddt_pred[order]:.2f}_affinity{all_affinity_pred[order]:.2f}.sdf')
 
-        mol_pred.SetProp("_Name", str(orig_complex_graph.name[0]))
+        mol_pred.SetProp("_Name", str(name))
         mol_pred.SetProp("lddt", f"{all_lddt_pred[order]:.2f}")
         mol_pred.SetProp("affinity", f"{all_affinity_pred[order]:.2f}")
         
-        write_mol_with_coords(mol_pred, ligand_pos[order], ligandFile, args.remove_output_hs)
-        new_receptor_pdb = copy.deepcopy(receptor_pdb)
-        if args.protein_dynamic:
-            modify_pdb(new_receptor_pdb,final_data_list[order])
-
-        pdbFile = os.path.join(write_dir, f'{prefix}{orig_complex_graph.name[0]}_step1_rank{rank+1}_receptor_lddt{all_lddt_pred[order]:.2f}_affinity{all_affinity_pred[order]:.2f}.{pdb_or_cif}')
-        save_protein(new_receptor_pdb,pdbFile)
+        with ligand_metrics.stage('write_outputs'):
+            write_mol_with_coords(mol_pred, ligand_pos[order], ligandFile, args.remove_output_hs)
+            # the template changes the receptor in place and resets it after every sample
+            new_receptor_pdb = receptor_pdb if template is not None else copy.deepcopy(receptor_pdb)
+            pdbFile = os.path.join(write_dir, f'{prefix}{name}_step1_rank{rank+1}_receptor_lddt{all_lddt_pred[order]:.2f}_affinity{all_affinity_pred[order]:.2f}.{pdb_or_cif}')
+            try:
+                if args.protein_dynamic:
+                    lf_3pts, acc_pred_chis = sampled['receptors'][order]
+                    modify_pdb_from_arrays(new_receptor_pdb, lf_3pts, acc_pred_chis, chi_masks, complex_graph.original_center)
+                if template is not None:
+                    template.save(pdbFile)
+                else:
+                    save_protein(new_receptor_pdb,pdbFile)
+            finally:
+                if template is not None:
+                    template.reset()
         pdbFiles.append(pdbFile)
             
         ligandFiles.append(ligandFile)
-        clash_scores.append(compute_side_chain_metrics(pdbFile, ligandFile, verbose=False))
+        with ligand_metrics.stage('clash_scoring'):
+            clash_scores.append(compute_side_chain_metrics(pdbFile, ligandFile, verbose=False))
 
     re_order = np.argsort(scipy.stats.rankdata(-all_lddt_pred) + scipy.stats.rankdata(clash_scores)/2.)#np.argsort(all_lddt_pred)[::-1]
-    complete_affinity = pd.DataFrame({'name':orig_complex_graph.name[0],'rank':np.arange(len(all_lddt_pred))+1,'lddt':all_lddt_pred[re_order],'affinity':all_affinity_pred[re_order]})
+    complete_affinity = pd.DataFrame({'name':name,'rank':np.arange(len(all_lddt_pred))+1,'lddt':all_lddt_pred[re_order],'affinity':all_affinity_pred[re_order]})
 
     for rank, order in enumerate(re_order):
 
@@ -323,29 +401,148 @@ def predict_one_complex(affinity_pred, df, orig_complex_graph, model, tr_schedul
                     
 
     if args.save_visualisation:
-        for rank, order in enumerate(re_order[:args.savings_per_complex]):
-            visualization_list = [(lig, receptor_pdb)]
-            for data_list in [data_list_randomized]+data_list_step:
-                visualization_list.append(data_list[order])
-            with open(os.path.join(write_dir, f'rank{rank+1}_reverseprocess_data_list.pkl'), 'wb') as f:
-                pickle.dump(visualization_list, f)
-         
-
-    names_list.append(orig_complex_graph.name[0])
-    return affinity_pred, complete_affinity
-
-for idx, orig_complex_graph in tqdm(enumerate(test_loader), ascii=True, total=len(test_loader)):
-    # if idx not in [54, 123, 141, 157, 165, 251]:continue
+        with ligand_metrics.stage('trajectory'):
+            save_reference_structures(write_dir, lig, receptor_pdb, pdb_or_cif)
+            for rank, order in enumerate(re_order[:args.savings_per_complex]):
+                save_trajectory(trajectory_path(write_dir, rank+1), sampled['trajectories'][order], complex_graph)
+
+    return complete_affinity
+
+if scratch is not None:
+    # Slurm sends SIGTERM at the time limit and on scancel, exiting through the finally block below ships the outputs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+def dock_complex(idx, orig_complex_graph, model, device):
+    """Docks one complex of the dataset and records the outcome, returns TASK_OK, TASK_TIMEOUT or 'failed'. With
+    --writers TASK_OK means the outputs were handed over to a writer, which records the rest"""
+    global affinity_pred
+    name = orig_complex_graph.name[0]
     try:
-        affinity_pred, complete_affinity = predict_one_complex(affinity_pred, df, orig_complex_graph, model, 
-                                tr_schedule, rot_schedule, tor_schedule, res_tr_schedule, res_rot_schedule, res_chi_schedule,
-                                t_to_sigma, N, score_model_args, args, device)
+        with time_limit(args.ligand_timeout):
+            affinity_pred, sampled = predict_one_complex(affinity_pred, df, orig_complex_graph, model, 
+                                    tr_schedule, rot_schedule, tor_schedule, res_tr_schedule, res_rot_schedule, res_chi_schedule,
+                                    t_to_sigma, N, score_model_args, args, device)
+            if writer is None:
+                complete_affinity = write_complex(sampled, orig_complex_graph.mol[0], orig_complex_graph.rec_pdb[0], orig_complex_graph, metrics.ligand(name))
+    except TimeoutException:
+        print(f"Timed out on {name} after {args.ligand_timeout} seconds, skipping it")
+        journal.record(name, 'sampling', TASK_TIMEOUT, ligand=df.loc[df['name'] == name, 'ligand'].values[0], error=f'no result after {args.ligand_timeout} seconds')
+        metrics.write(name, TASK_TIMEOUT)
+        # the outputs that were already written for it are incomplete, the files are only renamed from step1_rank at the end
+        for path in result_paths(results_dir, name) + glob.glob(os.path.join(results_dir, 'molecules', f'VS_DB_{glob.escape(name)}_step1_rank*')):
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        return TASK_TIMEOUT
     except Exception as e:
 
         print("Failed on", orig_complex_graph["name"], ":\n", e)
-        failures += 1
-        continue
+        metrics.write(name, 'failed', error=f'{type(e).__name__}: {e}')
+        return 'failed'
+    if writer is not None:
+        # outside of the time limit, this waits while the writers are behind
+        writer.submit(name, (idx, sampled, metrics.ligands.pop(name, None)))
+        return TASK_OK
+    metrics.write(name, samples=N, steps=args.actual_steps if args.actual_steps is not None else args.inference_steps)
     all_complete_affinity.append(complete_affinity)
+    return TASK_OK
+
+
+def write_index(task):
+    # runs in an output writer, which has the ligands and receptors of the dataset from the fork
+    idx, sampled, ligand_metrics = task
+    name = sampled['name']
+    metrics.ligands[name] = ligand_metrics or LigandMetrics(name)
+    try:
+        complete_affinity = write_complex(sampled, test_dataset.rdkit_ligands[idx], test_dataset.receptor_pdbs[idx],
+                                          test_dataset.complex_graphs[idx], metrics.ligands[name])
+    except Exception as e:
+        metrics.write(name, 'failed', error=f'{type(e).__name__}: {e}')
+        raise
+    metrics.write(name, samples=N, steps=args.actual_steps if args.actual_steps is not None else args.inference_steps)
+    return complete_affinity
+
+
+def finish_writing(results):
+    """Books the ligands the writers are done with, returns how many of them failed"""
+    failed = 0
+    for name, status, result in results:
+        written.add(name)
+        if status != TASK_OK:
+            # the writer wrote the metrics line of the ligand
+            print("Failed on", name, ":\n", result)
+            failed += 1
+            continue
+        all_complete_affinity.append(result)
+        if args.save_visualisation:
+            outputDirList.append(f'{results_dir}/complexes/{name}/')
+        if scratch is not None:
+            scratch.commit(result_paths(results_dir, name))
+    return failed
+
+
+def init_worker(gpu):
+    # runs in the forked worker, after CUDA_VISIBLE_DEVICES was set to its GPU
+    worker_device = torch.device('cpu' if gpu == CPU else 'cuda')
+    torch.set_num_threads(max(1, args.cores // len(workers)))
+    return load_models(worker_device)[0], worker_device
+
+
+def dock_index(state, idx):
+    worker_model, worker_device = state
+    orig_complex_graph = test_loader.collate_fn([test_dataset[idx]])
+    return orig_complex_graph.name[0], dock_complex(idx, orig_complex_graph, worker_model, worker_device)
+
+
+# the writers are forked with the preprocessed ligands and receptors (utils/writer.py). They never touch the GPU and
+# run on a single thread: OpenMP hangs in forked processes once the parent has started its threads
+writer = OutputWriter(args.writers, write_index, init=lambda: torch.set_num_threads(1),
+                      max_pending=args.writer_queue) if args.writers > 0 else None
+# ligands handed over to the writers, and the ones they are done with
+writing, written = set(), set()
+try:
+    if workers is None:
+        for idx, orig_complex_graph in tqdm(enumerate(test_loader), ascii=True, total=len(test_loader)):
+            # if idx not in [54, 123, 141, 157, 165, 251]:continue
+            if dock_complex(idx, orig_complex_graph, model, device) != TASK_OK:
+                failures += 1
+            elif writer is not None:
+                writing.add(orig_complex_graph.name[0])
+                failures += finish_writing(writer.finished())
+            elif scratch is not None:
+                scratch.commit()
+    else:
+        for idx, status, result in tqdm(run_workers(workers, init_worker, dock_index, range(len(test_dataset))), ascii=True, total=len(test_dataset)):
+            if status != TASK_OK:
+                # the worker died on it
+                name = test_dataset[idx].name
+                print("Failed on", name, ":\n", result)
+                metrics.write(name, 'failed', error=result)
+                failures += 1
+                continue
+            name, status = result
+            # the worker wrote the metrics line of the ligand
+            metrics.discard(name)
+            if status != TASK_OK:
+                failures += 1
+                continue
+            if writer is not None:
+                writing.add(name)
+                failures += finish_writing(writer.finished())
+                continue
+            if args.save_visualisation:
+                outputDirList.append(f'{results_dir}/complexes/{name}/')
+            if scratch is not None:
+                scratch.commit(result_paths(results_dir, name))
+    if writer is not None:
+        failures += finish_writing(writer.close())
+        for name in writing - written:
+            # its writer died on it
+            print("Failed on", name, ": the output writer exited")
+            metrics.write(name, 'failed', error='the output writer exited')
+            failures += 1
+finally:
+    if writer is not None:
+        writer.terminate()
+    if scratch is not None:
+        scratch.sync()
 
 
 
@@ -353,6 +550,9 @@ for idx, orig_complex_graph in tqdm(enumerate(test_loader), ascii=True, total=le
 #affinity_pred_df.to_csv(f'{args.out_dir}/affinity_prediction.csv',index=False)
 #pd.concat(all_complete_affinity).to_csv(f'{args.out_dir}/complete_affinity_prediction.csv',index=False)
 
+# ligands that were featurised but never docked, e.g. because the graph could not be built
+metrics.write_remaining('skipped')
+
 if args.delete_cache == True:
 	print(f"Removing cache directory at {test_dataset.full_cache_path}")
 	shutil.rmtree(test_dataset.full_cache_path)
@@ -375,3 +575,8 @@ if args.relax and args.save_visualisation:
 	subprocess.run(f"python3 -u relax_final.py --samples_per_complex {args.samples_per_complex} --num_workers {args.cores} {gpu_arg} --input_paths {' '.join(outputDirList)}", shell=True)
 	print(f"Finished relaxing the structures afer {time.time()-relaxTime:.2f} seconds")
 	
+
+if scratch is not None:
+	# ships what was written after the last sync (the relaxed structures) and frees the node-local storage
+	scratch.close()
+	print(f"The structures are archived in {args.out_dir}/archives, unpack them with python -m utils.scratch {args.out_dir}")
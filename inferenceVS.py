@@ -21,23 +21,41 @@ from argparse import ArgumentParser
 parser = ArgumentParser()
   
 parser.add_argument('--protein_path', '-r', '-p', required=True, type=str, default='', help='Path to the protein/receptor .pdb file')
-parser.add_argument('--ligand', '-l', required=True, type=str, default='', help='The path to the directory of (separate) mol2/sdf ligand files')
+parser.add_argument('--ligand', '-l', required=True, type=str, default='', help='The path to the directory of (separate) mol2/sdf ligand files, or a multi-molecule .sdf or .smi library file (optionally gzipped)')
 parser.add_argument('--out_dir', '-out', '-o', required=True,type=str, default='', help='Directory where the output structures will be saved to')
 parser.add_argument('--jobs', '-j', required=True, type=int, default=1, help='Number of jobs to use')
 parser.add_argument('--time', '-t', '-tj', required=False, default="", help='Amount of time each job can run')
 parser.add_argument('--queue', '-qu', type=str, default="", help='On which node to launch the jobs. The default value is the default queue for the user. Might need to be specified if there is no default queue configured')
 parser.add_argument('--mem', '-m', type=str, default="4G", help='How much memory to use for each job. The default value is `4GB')
 parser.add_argument('--gpu', '-gpu', '-GPU', '--GPU', action="store_true", default=False, help='Use GPU resources. This will accelerate docking calculations if a compatible GPU is available')
-parser.add_argument('--cores', '-c', type=int, default=None, help='How many cores to use for each job. The default value is 1 when used with the GPU option enabled, otherwise it defaults to 4 cores')
+parser.add_argument('--cores', '-c', type=int, default=None, help='How many cores to use for each job. The default value is 1 when used with the GPU option enabled, otherwise it defaults to 4 cores. With --no_slurm it defaults to all the cores of the machine')
+parser.add_argument('--gpus_per_job', type=int, default=1, help='How many GPUs each job requests with the GPU option. A job runs one sampling worker per GPU on its share of the ligands. With --no_slurm every GPU of the machine is used. The default value is 1')
+parser.add_argument('--cpu_workers', type=int, default=0, help='Number of extra sampling workers on the CPU in each job, next to the GPU workers (or next to each other without the GPU option). The cores of the job are divided among the workers')
+parser.add_argument('--writers', type=int, default=0, help='Number of processes in each job that write the output structures and score their clashes while the next compound is docked. Useful when the GPU waits for the output writing. The default value is 0 (written by the docking process)')
 parser.add_argument('--seed', type=int, default=42, help='Which seed to use')
 parser.add_argument('--samples_per_complex', '--num_outputs', '-n', type=int, default=1, help='How many structures to output per compound. The default value is 1')
 parser.add_argument('--save_visualisation', action='store_true', default=False, help='Save a pdb file with all of the steps of the reverse diffusion')
 parser.add_argument('--rigid_protein', action='store_true', default=False, help='Keep the protein structure rigid')
-parser.add_argument('--relax', action='store_true', default=False, help='Relax the final structures')
+parser.add_argument('--relax', action='store_true', default=False, help='Relax the final structures. This is scheduled as a separate CPU-only stage and requires --save_visualisation')
+parser.add_argument('--relax_cores', type=int, default=4, help='How many CPU cores each relaxation task uses. The default value is 4')
+parser.add_argument('--relax_mem', type=str, default=None, help='How much memory each relaxation task uses. Defaults to the value of --mem')
+parser.add_argument('--relax_time', default="", help='Amount of time each relaxation task can run')
+parser.add_argument('--relax_array_limit', type=int, default=None, help='Maximum number of relaxation tasks per job array that can run simultaneously')
 parser.add_argument('--no_final_step_noise', action='store_true', default=False, help='Use no noise in the final step of the reverse diffusion')
 parser.add_argument('--model', default="ema_inference_epoch314_model.pt", help='Which model to use', choices=["ema_inference_epoch314_model.pt","pro_ema_inference_epoch138_model.pt"])
 
 parser.add_argument('--remove_hs', action='store_true', default=False, help='Remove the hydrogens in the final output structures')
+parser.add_argument('--conformer_timeout', type=int, default=300, help='Maximum number of seconds RDKit can spend generating the conformer of a single ligand. Ligands that take longer are skipped and recorded in the run journal. The default value is 300')
+parser.add_argument('--ligand_timeout', type=int, default=0, help='Maximum number of seconds building the graphs and running the reverse diffusion of a single ligand can take. Ligands that take longer are skipped and recorded in the run journal, so the job moves on to the next ligand. The default value is 0 (no limit)')
+parser.add_argument('--batch_budget', type=str, default=None, help='Batch the samples of the reverse diffusion by estimated graph size up to this budget instead of a fixed number of samples per batch. Use auto to derive it from the free GPU memory (or from --mem on the CPU). Batches that run out of memory are split either way')
+parser.add_argument('--compile', action='store_true', default=False, help='Compile the score model with torch.compile on GPU jobs. The compiled kernels are cached in .compile_cache (or $DYNAMICBIND_COMPILE_CACHE), so only the first job on a node pays the compilation')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16', 'int8-dynamic'], help='Numeric precision of the models in the jobs, see inference.py --help')
+parser.add_argument('--scratch', type=str, nargs='?', const='', default=None, help='Let every job stage its inputs, cache and outputs on node-local storage: this directory, or $SLURM_TMPDIR or $TMPDIR of the job when no directory is given. The results are shipped back as one archive per sync and unpacked by the summary job')
+parser.add_argument('--no_dedup', action='store_true', default=False, help='Dock every ligand file, also when several files hold the same compound. By default every compound (by canonical SMILES) is docked once and the summary lists its results under all of its names')
+parser.add_argument('--reuse_results', type=str, nargs='+', default=[], help='Output directories of earlier runs: compounds that were docked there with the same receptor and settings are copied instead of docked again')
+parser.add_argument('--preflight', type=str, default='parse', choices=['none', 'parse', 'embed'], help='Check the ligands before submitting the jobs: parse reads and sanitises them and applies --max_lig_size and --allowed_elements, embed also generates their conformers (slower, within --conformer_timeout). Ligands that fail are not submitted and are listed in preflight_rejects.csv. The default value is parse')
+parser.add_argument('--max_lig_size', type=int, default=None, help='Skip ligands with more heavy atoms than this. No limit by default')
+parser.add_argument('--allowed_elements', type=str, nargs='+', default=None, help='Skip ligands with atoms of other elements, e.g. H C N O S P F Cl Br I. All elements are allowed by default')
 parser.add_argument('--keep_local_structures', action='store_true', default=False, help='Keeps the local structure when specifying an input with 3D coordinates instead of generating them with RDKit')
 parser.add_argument('--keep_cache', action='store_true', default=False, help='Keep the Cache directories after finishing the calculations (Not recommended)')
 parser.add_argument('--no_clean', action='store_true', default=False, help='by default, the input protein file will be cleaned')
@@ -47,6 +65,11 @@ parser.add_argument('--no_summary', action='store_true', default=False, help='Do
 
 args = parser.parse_args()
 
+## --ligand is a directory of ligand files, or a library file that is indexed by record (see datasets/library.py)
+from datasets.library import library_format, list_ligands
+if not os.path.isdir(args.ligand) and (not os.path.isfile(args.ligand) or library_format(args.ligand) is None):
+	sys.exit(f"{args.ligand} is neither a directory of ligand files nor a .sdf/.smi library (optionally .gz)")
+
 ## Check if Singularity image is present and ask to download it
 if not os.path.exists("singularity/DynamicBindHPC.sif"):
 	print("The Singularity image doesn't seem to be present..")
@@ -73,7 +96,10 @@ if not os.path.exists("workdir/big_score_model_sanyueqi_with_time/ema_inference_
 		
 ## Determine the amount of cores if not defined by the user
 if args.cores is None:
-	if args.gpu:
+	if args.no_slurm:
+		## Without Slurm the run has the whole machine
+		args.cores = os.cpu_count() or 4
+	elif args.gpu:
 		args.cores = 1
 	else:
 		args.cores = 4
@@ -88,6 +114,24 @@ if args.time == "":
 	timeArg = ""
 else:
 	timeArg = f" --time {args.time} "
+
+## Relaxation only works on the complexes directories written by --save_visualisation
+if args.relax and not args.save_visualisation:
+	print("--relax requires --save_visualisation, the final structures will not be relaxed")
+	args.relax = False
+
+if args.relax_mem is None:
+	args.relax_mem = args.mem
+
+if args.relax_time == "":
+	relaxTimeArg = ""
+else:
+	relaxTimeArg = f" --time {args.relax_time} "
+
+relaxArrayLimit = ""
+if args.relax_array_limit is not None:
+	relaxArrayLimit = f"%{args.relax_array_limit}"
+relaxJobIDs = []
 	
 outputPath, outputDirName = os.path.split(args.out_dir)
 
@@ -144,7 +188,29 @@ if len(embeddingPathList) == 0:
 if not args.no_slurm:
 	print("Launching jobs..")	
 
-ligandPaths = glob.glob(f"{args.ligand}/*.sdf") + glob.glob(f"{args.ligand}/*.mol2")
+## Dock every compound once: duplicates and compounds from earlier runs get their results in the summary
+## The input structures are docked as they are with --keep_local_structures, so equal SMILES are not duplicates there
+if args.no_dedup or args.keep_local_structures:
+	ligandEntries = list_ligands(args.ligand)
+else:
+	from utils.ligand_index import ligands_to_dock, write_run_settings
+	write_run_settings(outputDir, args)
+	reuseArg = f"--reuse {' '.join(args.reuse_results)}" if args.reuse_results else ""
+	subprocess.run(f"singularity exec --bind $PWD singularity/DynamicBindHPC.sif python dedup_ligands.py {args.ligand} {outputDir} --protein_path {args.protein_path} {reuseArg} -c {args.cores}", shell=True)
+	ligandEntries = ligands_to_dock(outputDir)
+
+## Check the ligands before submitting them, so no job time is spent on ligands that cannot be docked or are filtered out
+if args.preflight != "none" and len(ligandEntries) > 0:
+	from utils.preflight import rejected_names
+	fromIndexArg = "" if args.no_dedup or args.keep_local_structures else "--from_index"
+	maxLigSizeArg = f"--max_lig_size {args.max_lig_size}" if args.max_lig_size is not None else ""
+	elementsArg = f"--allowed_elements {' '.join(args.allowed_elements)}" if args.allowed_elements else ""
+	keepLocalArg = "--keep_local_structures" if args.keep_local_structures else ""
+	subprocess.run(f"singularity exec --bind $PWD singularity/DynamicBindHPC.sif python preflight_ligands.py {args.ligand} {outputDir} {fromIndexArg} --level {args.preflight} {maxLigSizeArg} {elementsArg} {keepLocalArg} --seed {args.seed} --conformer_timeout {args.conformer_timeout} -c {args.cores}", shell=True)
+	rejectedNames = rejected_names(outputDir)
+	ligandEntries = [entry for entry in ligandEntries if entry[0] not in rejectedNames]
+	if len(rejectedNames) > 0:
+		print(f"{len(rejectedNames)} ligands are not docked, see {outputDir}/preflight_rejects.csv")
 
 ## Code to distribute the query ligands among the amount of jobs 
 def split(a, n):
@@ -154,7 +220,7 @@ def split(a, n):
     k, m = divmod(len(a), n)
     return (a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n))
 
-ligandPathsSplit = list(split(ligandPaths, args.jobs))
+ligandPathsSplit = list(split(ligandEntries, args.jobs))
 
 queueArgument = ""
 if not args.queue == "":
@@ -178,10 +244,6 @@ if not args.rigid_protein:
 else:
 	rigid_protein_arg = ""
 
-relax_arg = ""
-if args.relax:
-	relax_arg = "--relax"
-	
 visualisationArgument = ""
 if args.save_visualisation:
 	visualisationArgument = f"--save_visualisation --savings_per_complex {args.samples_per_complex}"
@@ -190,28 +252,46 @@ if not args.no_final_step_noise:
 	finalStepNoiseArg = "--no_final_step_noise"
 else:
 	finalStepNoiseArg = ""
+
+## Every GPU of the job (or of the machine without Slurm) gets a sampling worker, see utils/devices.py
+devicesArg = "--devices all" if args.gpu and (args.no_slurm or args.gpus_per_job > 1) else ""
+if args.cpu_workers > 0:
+	devicesArg += f" --cpu_workers {args.cpu_workers}"
+## the outputs of a compound are written by other processes while the next compound is docked, see utils/writer.py
+writersArg = f"--writers {args.writers}" if args.writers > 0 else ""
+batchBudgetArg = f"--batch_budget {args.batch_budget}" if args.batch_budget else ""
+compileArg = "--compile" if args.compile else ""
+precisionArg = f"--precision {args.precision}" if args.precision != "fp32" else ""
+scratchArg = "" if args.scratch is None else f"--scratch {args.scratch}".strip()
+unpackArg = f"--unpack_archives {outputDir}" if args.scratch is not None else ""
 	
 for i, jobLigands in enumerate(ligandPathsSplit):
 	csvFilePath = f"{outputDir}/csvs/job_csv_{str(i+1)}.csv"
 	with open(csvFilePath, 'w') as jobCSV:
 		jobCSV.write("name;protein_path;ligand\n")
-		for jobLigand in jobLigands:
-			complexName = os.path.basename(jobLigand).split('.')[0]
+		for complexName, jobLigand in jobLigands:
 			jobCSV.write(f"{complexName};{args.protein_path};{jobLigand}\n")
 
 	jobCSV.close()
 
+	## One line per complex, each relaxation array task picks the line matching its task id
+	if args.relax:
+		relaxListPath = f"{outputDir}/csvs/relax_job_{str(i+1)}.txt"
+		with open(relaxListPath, 'w') as relaxList:
+			for complexName, _ in jobLigands:
+				relaxList.write(f"{outputDir}/complexes/{complexName}/\n")
+
 	if not args.no_slurm:
 		## Execute command using singularity and sbatch wrap giving the csv as an input, and passing the input variables as well
 		if args.gpu == True:
-			jobCMD = f'sbatch --wrap="singularity exec --nv --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} {relax_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --gres=gpu:1 --job-name=DynamicBindHPC -c {str(args.cores)} {timeArg} {queueArgument}'
+			jobCMD = f'sbatch --wrap="singularity exec --nv --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model} --conformer_timeout {args.conformer_timeout} --ligand_timeout {args.ligand_timeout} {devicesArg} {writersArg} {batchBudgetArg} {compileArg} {precisionArg} {scratchArg}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --gres=gpu:{args.gpus_per_job} --job-name=DynamicBindHPC -c {str(args.cores)} {timeArg} {queueArgument}'
 		else:
-			jobCMD = f'sbatch --wrap="singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} {relax_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --job-name=DynamicBindHPC -c {str(args.cores)} {timeArg} {queueArgument}'
+			jobCMD = f'sbatch --wrap="singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model} --conformer_timeout {args.conformer_timeout} --ligand_timeout {args.ligand_timeout} {devicesArg} {writersArg} {batchBudgetArg} {compileArg} {precisionArg} {scratchArg}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --job-name=DynamicBindHPC -c {str(args.cores)} {timeArg} {queueArgument}'
 	else:
 		if args.gpu == True:
-			jobCMD = f'singularity exec --nv --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} {relax_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model} 2>&1 | tee {outputDir}/jobs_out/job_1.out'
+			jobCMD = f'singularity exec --nv --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model} --conformer_timeout {args.conformer_timeout} --ligand_timeout {args.ligand_timeout} {devicesArg} {writersArg} {batchBudgetArg} {compileArg} {precisionArg} {scratchArg} 2>&1 | tee {outputDir}/jobs_out/job_1.out'
 		else:
-			jobCMD = f'singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} {relax_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model} 2>&1 | tee {outputDir}/jobs_out/job_1.out'
+			jobCMD = f'singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.samples_per_complex} {remove_hs} {rigid_protein_arg} --out_dir {outputDir} {visualisationArgument} {keep_original_struct} {keep_cache} {finalStepNoiseArg} -c {str(args.cores)} --seed {args.seed} --ckpt {args.model} --conformer_timeout {args.conformer_timeout} --ligand_timeout {args.ligand_timeout} {devicesArg} {writersArg} {batchBudgetArg} {compileArg} {precisionArg} {scratchArg} 2>&1 | tee {outputDir}/jobs_out/job_1.out'
 		
 	with open(f"{outputDir}/jobs/job_{str(i+1)}.sh", "w") as jobfile:
 		jobfile.write("#!/usr/bin/env bash\n")
@@ -224,12 +304,34 @@ for i, jobLigands in enumerate(ligandPathsSplit):
 		print(jobOutput.stdout.strip())
 		jobIDs.append(jobOutput.stdout.strip().split()[-1])
 
+	## Schedule the relaxation of this chunk as a CPU-only job array that starts as soon as the docking job ends
+	if args.relax:
+		if args.no_slurm:
+			relaxCMD = f'singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u relax_final.py --samples_per_complex {args.samples_per_complex} --num_workers {str(args.cores)} --input_list {relaxListPath} {unpackArg} 2>&1 | tee {outputDir}/jobs_out/relax_job_1.out'
+		else:
+			relaxCMD = f'sbatch --wrap="singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u relax_final.py --samples_per_complex {args.samples_per_complex} --num_workers {str(args.relax_cores)} --input_list {relaxListPath} {unpackArg}" --array=0-{len(jobLigands)-1}{relaxArrayLimit} --dependency=afterany:{jobIDs[-1]} --mem {args.relax_mem} --output={outputDir}/jobs_out/relax_job_{str(i+1)}_%A_%a.out --job-name=RelaxDynamicBindHPC -c {str(args.relax_cores)} {relaxTimeArg} {queueArgument}'
+
+		with open(f"{outputDir}/jobs/relax_job_{str(i+1)}.sh", "w") as jobfile:
+			jobfile.write("#!/usr/bin/env bash\n")
+			jobfile.write(relaxCMD)
+
+		if args.no_slurm:
+			print("\nRelaxing structures..")
+			subprocess.run(relaxCMD, shell=True)
+		else:
+			relaxOutput = subprocess.run(relaxCMD, shell=True, capture_output=True, text=True)
+			print(relaxOutput.stdout.strip())
+			relaxJobIDs.append(relaxOutput.stdout.strip().split()[-1])
+
 if not args.no_summary:
-	# Run summarize_results.py
-	if args.no_slurm:
+	# Run summarize_results.py, directly when there was nothing left to dock
+	if args.no_slurm or len(jobIDs) == 0:
 		subprocess.run(f'singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u summarize_results.py {outputDir}', shell=True)
 	else:
-		jobCMD = f'sbatch --wrap="singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u summarize_results.py {outputDir}" --mem {args.mem} --output={outputDir}/jobs_out/summarize_results_%j.out --job-name=PostProcessDynamicBindHPC {queueArgument} --dependency=afterok:{",".join(jobIDs)}'
+		summaryDependency = f'--dependency=afterok:{":".join(jobIDs)}'
+		if len(relaxJobIDs) > 0:
+			summaryDependency += f',afterany:{":".join(relaxJobIDs)}'
+		jobCMD = f'sbatch --wrap="singularity exec --bind $PWD singularity/DynamicBindHPC.sif python3 -u summarize_results.py {outputDir}" --mem {args.mem} --output={outputDir}/jobs_out/summarize_results_%j.out --job-name=PostProcessDynamicBindHPC {queueArgument} {summaryDependency}'
 		
 		with open(f"{outputDir}/jobs/job_summarize_results.sh", "w") as jobfile:
 			jobfile.write("#!/usr/bin/env bash\n")
@@ -238,9 +340,9 @@ if not args.no_summary:
 		print("Launching post-processing job")	
 		subprocess.run(jobCMD, shell=True)
 		
-		print(f"Finished launching {len(jobIDs)}+1 jobs in total")
+		print(f"Finished launching {len(jobIDs)+len(relaxJobIDs)}+1 jobs in total")
 
-else:
-	print(f"Finished launching {len(jobIDs)} jobs in total")
+elif not args.no_slurm:
+	print(f"Finished launching {len(jobIDs)+len(relaxJobIDs)} jobs in total")
 	
 	
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+    Inference-only wrapper of models/score_model.py's TensorProductScoreModel with a compiled numeric core.
+
+    The forward pass is split in two: the data dependent graph construction (the radius graphs of torch_cluster, the
+    bond graph of the rotatable bonds and the sizes that depend on them) runs eagerly, and everything after it (the
+    distance and time embeddings, spherical harmonics, tensor product convolutions and output heads) is a function of
+    plain tensors compiled with torch.compile(dynamic=True), so that one compiled graph serves every batch size.
+    The outputs are the ones of model(data), benchmarks/compiled_model.py checks them against the eager model.
+
+    The core is only compiled on the GPU. On the CPU it runs eagerly unless compile_on_cpu is set: inductor's CPU
+    kernels for the per edge tensor products and the index_add scatters measured several times slower than eager.
+    Compiled kernels are cached on disk ($DYNAMICBIND_COMPILE_CACHE, by default .compile_cache in the repository),
+    so later jobs skip the code generation (tracing the model still happens in every process). If compilation fails
+    the wrapper warns once and runs the same core eagerly.
+"""
+import os
+
+import torch
+from e3nn import o3
+from torch.nn import functional as F
+from torch_cluster import radius, radius_graph
+
+from models.score_model import TensorProductScoreModel
+
+package_folder_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+COMPILE_CACHE_ENV = 'DYNAMICBIND_COMPILE_CACHE'
+
+
+def compile_cache_dir():
+    return os.environ.get(COMPILE_CACHE_ENV) or os.path.join(package_folder_path, '.compile_cache')
+
+
+def _scatter_mean(src, index, dim_size):
+    # torch_scatter's scatter(reduce='mean') with native ops, which torch.compile can trace
+    out = torch.zeros((dim_size,) + src.shape[1:], dtype=src.dtype, device=src.device).index_add_(0, index, src)
+    count = torch.zeros(dim_size, dtype=src.dtype, device=src.device).index_add_(0, index, torch.ones_like(src[:, 0]))
+    return out / count.clamp(min=1).unsqueeze(1)
+
+
+def _conv(layer, node_attr, edge_index, edge_attr, edge_sh, out_nodes=None):
+    # TensorProductConvLayer.forward
+    edge_src, edge_dst = edge_index
+    tp = layer.tp(node_attr[edge_dst], edge_sh, layer.fc(edge_attr))
+    out = _scatter_mean(tp, edge_src, out_nodes or node_attr.shape[0])
+    if layer.residual:
+        out = out + F.pad(node_attr, (0, out.shape[-1] - node_attr.shape[-1]))
+    if layer.batch_norm:
+        out = layer.batch_norm(out)
+    return out
+
+
+class InferenceScoreModel(torch.nn.Module):
+    def __init__(self, model, compile=True, cache_dir=None, compile_on_cpu=False):
+        super().__init__()
+        if type(model) is not TensorProductScoreModel:
+            raise ValueError(f'InferenceScoreModel only wraps models.score_model.TensorProductScoreModel, not {type(model).__name__}')
+        self.model = model.eval()
+        # the degrees of the spherical harmonics as plain ints, torch.compile cannot guard on e3nn's Irreps
+        self.sh_ls = [ir.l for _, ir in model.sh_irreps]
+        self.compiled = False
+        self.core = self.numeric_core
+        if compile and (model.device.type == 'cuda' or compile_on_cpu):
+            cache_dir = cache_dir or compile_cache_dir()
+            os.makedirs(cache_dir, exist_ok=True)
+            # inductor reads its cache location from the environment when it compiles
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+            os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+            self.core = torch.compile(self.numeric_core, dynamic=True)
+            self.compiled = True
+
+    def train(self, mode=True):
+        if mode:
+            raise RuntimeError('InferenceScoreModel is inference only, train the wrapped model instead')
+        return super().train(mode)
+
+    def forward(self, data):
+        inputs = self.build_graphs(data)
+        with torch.no_grad():
+            if self.compiled:
+                try:
+                    return self.core(**inputs)
+                except Exception as e:
+                    from utils.batching import is_out_of_memory
+                    if is_out_of_memory(e):
+                        raise
+                    print(f'Compiling the score model failed, running it eagerly instead: {type(e).__name__}: {e}')
+                    self.core, self.compiled = self.numeric_core, False
+            return self.numeric_core(**inputs)
+
+    def build_graphs(self, data):
+        """Edge indices and sizes of the batch, everything data dependent the numeric core needs"""
+        model = self.model
+        lig, rec = data['ligand'], data['receptor']
+        times = [data.complex_t[noise_type] for noise_type in ['tr', 'rot', 'tor', 'res_tr', 'res_rot', 'res_chi']]
+
+        radius_edges = radius_graph(lig.pos, model.lig_max_radius, lig.batch)[[1, 0]]
+        lig_edge_index = torch.cat([data['ligand', 'ligand'].edge_index, radius_edges], 1).long()
+        rec_edge_index = radius_graph(rec.pos, model.rec_max_radius, rec.batch, max_num_neighbors=model.c_alpha_max_neighbors)[[1, 0]]
+
+        if model.dynamic_max_cross:
+            tr_sigma = times[0] if model.confidence_mode else model.t_to_sigma(*times)[0]
+            cross_cutoff = torch.maximum(torch.tensor(20).float().to(tr_sigma.device), (tr_sigma * 3 + 12).unsqueeze(1))
+            cross_edge_index = radius(rec.pos / cross_cutoff[rec.batch], lig.pos / cross_cutoff[lig.batch], 1,
+                                      rec.batch, lig.batch, max_num_neighbors=10000)
+        else:
+            cross_edge_index = radius(rec.pos, lig.pos, model.cross_max_distance, rec.batch, lig.batch, max_num_neighbors=10000)
+        if len(torch.unique(lig.batch[cross_edge_index[0]])) < data.num_graphs:
+            raise RuntimeError('no cross edge found')
+
+        tor_bonds = tor_edge_index = None
+        if not model.confidence_mode and not model.finetune and not model.no_torsion and lig.edge_mask.sum() > 0:
+            tor_bonds = data['ligand', 'ligand'].edge_index[:, lig.edge_mask].long()
+            bond_pos = (lig.pos[tor_bonds[0]] + lig.pos[tor_bonds[1]]) / 2
+            tor_edge_index = radius(lig.pos, bond_pos, model.lig_max_radius, batch_x=lig.batch, batch_y=lig.batch[tor_bonds[0]])
+
+        return dict(times=times, lig_x=lig.x, lig_pos=lig.pos, lig_batch=lig.batch, lig_node_t=lig.node_t['tr'],
+                    lig_edge_index=lig_edge_index, lig_bond_attr=data['ligand', 'ligand'].edge_attr,
+                    rec_x=rec.x, rec_pos=rec.pos, rec_chis=rec.chis, rec_chi_masks=rec.chi_masks, rec_lf_3pts=rec.lf_3pts,
+                    rec_node_t=rec.node_t['tr'], rec_edge_index=rec_edge_index, cross_edge_index=cross_edge_index,
+                    num_graphs=data.num_graphs, tor_bonds=tor_bonds, tor_edge_index=tor_edge_index)
+
+    def numeric_core(self, times, lig_x, lig_pos, lig_batch, lig_node_t, lig_edge_index, lig_bond_attr, rec_x, rec_pos,
+                     rec_chis, rec_chi_masks, rec_lf_3pts, rec_node_t, rec_edge_index, cross_edge_index, num_graphs,
+                     tor_bonds=None, tor_edge_index=None, eps=1e-12):
+        """TensorProductScoreModel.forward after the graph construction"""
+        model = self.model
+        ns = model.ns
+        if not model.confidence_mode:
+            tr_sigma, rot_sigma, tor_sigma, res_tr_sigma, res_rot_sigma, res_chi_sigma = model.t_to_sigma(*times)
+        else:
+            tr_sigma, rot_sigma, tor_sigma, res_tr_sigma, res_rot_sigma, res_chi_sigma = times
+
+        # ligand graph
+        lig_sigma_emb = model.timestep_emb_func(lig_node_t)
+        lig_edge_attr = torch.cat([lig_bond_attr, torch.zeros(lig_edge_index.shape[1] - lig_bond_attr.shape[0], model.in_lig_edge_features, device=lig_x.device)], 0)
+        lig_edge_attr = torch.cat([lig_edge_attr, lig_sigma_emb[lig_edge_index[0]]], 1)
+        lig_src, lig_dst = lig_edge_index
+        lig_edge_vec = lig_pos[lig_dst] - lig_pos[lig_src]
+        lig_edge_attr = torch.cat([lig_edge_attr, model.lig_distance_expansion(lig_edge_vec.norm(dim=-1))], 1)
+        lig_edge_sh = o3.spherical_harmonics(self.sh_ls, lig_edge_vec, normalize=True, normalization='component')
+        lig_node_attr = model.lig_node_embedding(torch.cat([lig_x, lig_sigma_emb], 1))
+        lig_edge_attr = model.lig_edge_embedding(lig_edge_attr)
+
+        # receptor graph
+        rec_sigma_emb = model.timestep_emb_func(rec_node_t)
+        rec_node_attr = torch.cat([rec_x, rec_chis.sin() * rec_chi_masks, rec_chis.cos() * rec_chi_masks, rec_sigma_emb], 1)
+        rec_src, rec_dst = rec_edge_index
+        rec_edge_vec = rec_pos[rec_dst] - rec_pos[rec_src]
+        rec_edge_attr = torch.cat([rec_sigma_emb[rec_src], model.rec_distance_expansion(rec_edge_vec.norm(dim=-1))], 1)
+        rec_edge_sh = o3.spherical_harmonics(self.sh_ls, rec_edge_vec, normalize=True, normalization='component')
+        rec_node_attr = model.rec_node_embedding(rec_node_attr)
+        rec_edge_attr = model.rec_edge_embedding(rec_edge_attr)
+
+        # cross graph
+        cross_lig, cross_rec = cross_edge_index
+        cross_edge_vec = rec_pos[cross_rec] - lig_pos[cross_lig]
+        cross_edge_attr = torch.cat([lig_sigma_emb[cross_lig], model.cross_distance_expansion(cross_edge_vec.norm(dim=-1))], 1)
+        cross_edge_sh = o3.spherical_harmonics(self.sh_ls, cross_edge_vec, normalize=True, normalization='component')
+        cross_edge_attr = model.cross_edge_embedding(cross_edge_attr)
+
+        n_vec = rec_lf_3pts[:, 0] - rec_lf_3pts[:, 1]
+        n_norm_vec = n_vec / (n_vec.norm(dim=-1, keepdim=True) + eps)
+        c_vec = rec_lf_3pts[:, 2] - rec_lf_3pts[:, 1]
+        c_norm_vec = c_vec / (c_vec.norm(dim=-1, keepdim=True) + eps)
+        for l in range(len(model.lig_conv_layers)):
+            lig_edge_attr_ = torch.cat([lig_edge_attr, lig_node_attr[lig_src, :ns], lig_node_attr[lig_dst, :ns]], -1)
+            lig_intra_update = _conv(model.lig_conv_layers[l], lig_node_attr, lig_edge_index, lig_edge_attr_, lig_edge_sh)
+
+            rec_input = torch.cat([rec_node_attr, n_norm_vec, c_norm_vec], dim=-1) if l == 0 else rec_node_attr
+            rec_to_lig_edge_attr_ = torch.cat([cross_edge_attr, lig_node_attr[cross_lig, :ns], rec_node_attr[cross_rec, :ns]], -1)
+            lig_inter_update = _conv(model.rec_to_lig_conv_layers[l], rec_input, cross_edge_index, rec_to_lig_edge_attr_,
+                                     cross_edge_sh, out_nodes=lig_node_attr.shape[0])
+
+            rec_edge_attr_ = torch.cat([rec_edge_attr, rec_node_attr[rec_src, :ns], rec_node_attr[rec_dst, :ns]], -1)
+            rec_intra_update = _conv(model.rec_conv_layers[l], rec_input, rec_edge_index, rec_edge_attr_, rec_edge_sh)
+            lig_to_rec_edge_attr_ = torch.cat([cross_edge_attr, lig_node_attr[cross_lig, :ns], rec_node_attr[cross_rec, :ns]], -1)
+            rec_inter_update = _conv(model.lig_to_rec_conv_layers[l], lig_node_attr, torch.flip(cross_edge_index, dims=[0]),
+                                     lig_to_rec_edge_attr_, cross_edge_sh, out_nodes=rec_node_attr.shape[0])
+
+            lig_node_attr = F.pad(lig_node_attr, (0, lig_intra_update.shape[-1] - lig_node_attr.shape[-1]))
+            lig_node_attr = lig_node_attr + lig_intra_update + lig_inter_update
+            rec_node_attr = F.pad(rec_node_attr, (0, rec_intra_update.shape[-1] - rec_node_attr.shape[-1]))
+            rec_node_attr = rec_node_attr + rec_intra_update + rec_inter_update
+
+        if model.confidence_mode:
+            scalar_lig_attr = torch.cat([lig_node_attr[:, :ns], lig_node_attr[:, -ns:]], dim=1) if model.num_conv_layers >= 3 else lig_node_attr[:, :ns]
+            return model.confidence_predictor(_scatter_mean(scalar_lig_attr, lig_batch, num_graphs)).squeeze(dim=-1)
+
+        # translational and rotational scores, from the convolution of the ligand atoms around their center
+        center_pos = torch.zeros((num_graphs, 3), device=lig_x.device).index_add_(0, lig_batch, lig_pos)
+        center_pos = center_pos / torch.zeros(num_graphs, device=lig_x.device).index_add_(0, lig_batch, torch.ones_like(lig_node_t)).unsqueeze(1)
+        center_edge_index = torch.stack([lig_batch, torch.arange(len(lig_batch), device=lig_x.device)])
+        center_edge_vec = lig_pos - center_pos[lig_batch]
+        center_edge_attr = torch.cat([model.center_distance_expansion(center_edge_vec.norm(dim=-1)), lig_sigma_emb], 1)
+        center_edge_sh = o3.spherical_harmonics(self.sh_ls, center_edge_vec, normalize=True, normalization='component')
+        center_edge_attr = torch.cat([model.center_edge_embedding(center_edge_attr), lig_node_attr[:, :ns]], -1)
+        global_pred = _conv(model.final_conv, lig_node_attr, center_edge_index, center_edge_attr, center_edge_sh, out_nodes=num_graphs)
+
+        lddt_pred = model.lddt_final_layer(global_pred[:, :ns])
+        affinity_pred = torch.clamp(model.affinity_final_layer(global_pred[:, ns:2 * ns]) / (lddt_pred + eps), min=0.0, max=15.0)
+        if model.finetune:
+            return affinity_pred
+
+        tr_pred = global_pred[:, 2 * ns:2 * ns + 3] + global_pred[:, 2 * ns + 3:2 * ns + 6]
+        rot_pred = global_pred[:, 2 * ns + 6:2 * ns + 9] + global_pred[:, 2 * ns + 9:]
+        graph_sigma_emb = model.timestep_emb_func(times[0])
+        tr_norm = torch.linalg.vector_norm(tr_pred, dim=1).unsqueeze(1)
+        tr_pred = tr_pred / (tr_norm + eps) * model.tr_final_layer(torch.cat([tr_norm, graph_sigma_emb], dim=1))
+        rot_norm = torch.linalg.vector_norm(rot_pred, dim=1).unsqueeze(1)
+        rot_pred = rot_pred / (rot_norm + eps) * model.rot_final_layer(torch.cat([rot_norm, graph_sigma_emb], dim=1))
+
+        # per residue scores
+        nv = model.nv
+        res_tr_pred = rec_node_attr[:, ns:ns + nv * 3].view(rec_node_attr.shape[0], -1, 3).mean(1)
+        res_rot_pred = rec_node_attr[:, ns + nv * 3:ns + 2 * nv * 3].view(rec_node_attr.shape[0], -1, 3).mean(1)
+        res_chi_pred = torch.cat([rec_node_attr[:, :ns], rec_node_attr[:, -ns:]], dim=-1)
+        res_sigma_emb = model.timestep_emb_func(times[3])
+        res_tr_norm = torch.linalg.vector_norm(res_tr_pred, dim=1).unsqueeze(1)
+        res_tr_pred = res_tr_pred / (res_tr_norm + eps) * model.res_tr_final_layer(torch.cat([res_tr_norm, res_sigma_emb], dim=1))
+        res_rot_norm = torch.linalg.vector_norm(res_rot_pred, dim=1).unsqueeze(1)
+        res_rot_pred = res_rot_pred / (res_rot_norm + eps) * model.res_rot_final_layer(torch.cat([res_rot_norm, res_sigma_emb], dim=1))
+        res_chi_pred = model.res_chi_final_layer(res_chi_pred)
+
+        if model.scale_by_sigma:
+            tr_pred = tr_pred * tr_sigma.unsqueeze(1)
+
+        if tor_bonds is None:
+            return lddt_pred, affinity_pred, tr_pred, rot_pred, torch.empty(0, device=model.device), res_tr_pred, res_rot_pred, res_chi_pred
+
+        # torsional scores, from the convolution of the atoms around the center of every rotatable bond
+        bond_pos = (lig_pos[tor_bonds[0]] + lig_pos[tor_bonds[1]]) / 2
+        tor_edge_vec = lig_pos[tor_edge_index[1]] - bond_pos[tor_edge_index[0]]
+        tor_edge_attr = model.final_edge_embedding(model.lig_distance_expansion(tor_edge_vec.norm(dim=-1)))
+        tor_edge_sh = o3.spherical_harmonics(self.sh_ls, tor_edge_vec, normalize=True, normalization='component')
+        tor_bond_vec = lig_pos[tor_bonds[1]] - lig_pos[tor_bonds[0]]
+        tor_bond_attr = lig_node_attr[tor_bonds[0]] + lig_node_attr[tor_bonds[1]]
+        tor_bonds_sh = o3.spherical_harmonics("2e", tor_bond_vec, normalize=True, normalization='component')
+        tor_edge_sh = model.final_tp_tor(tor_edge_sh, tor_bonds_sh[tor_edge_index[0]])
+        tor_edge_attr = torch.cat([tor_edge_attr, lig_node_attr[tor_edge_index[1], :ns], tor_bond_attr[tor_edge_index[0], :ns]], -1)
+        tor_pred = _conv(model.tor_bond_conv, lig_node_attr, tor_edge_index, tor_edge_attr, tor_edge_sh, out_nodes=tor_bonds.shape[1])
+        tor_pred = model.tor_final_layer(tor_pred).squeeze(1)
+        return lddt_pred, affinity_pred, tr_pred, rot_pred, tor_pred, res_tr_pred, res_rot_pred, res_chi_pred
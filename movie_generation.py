@@ -24,11 +24,11 @@ parser.add_argument('--rank', type=str, default="1", help='specify the sample to
              (the samples are sorted by their confidence, with rank 1 being considered the best prediction by the model, rank 40 the worst), \
              could give multiple. for example 1+2+3')
 parser.add_argument('--device', type=int, default=0, help='CUDA_VISIBLE_DEVICES')
-parser.add_argument('--inference_steps', type=int, default=20, help='num of coordinate updates. (movie frames)')
+parser.add_argument('--inference_steps', type=int, default=None, help='num of coordinate updates. (movie frames) Defaults to the number of steps in the trajectory file')
 parser.add_argument('--remove_hs', action='store_true', default=False, help='Remove the hydrogens in the final output structures')
 parser.add_argument('--debug', action='store_true', default=False, help='Be more verbose about the commands that are executed')
 parser.add_argument('--gpu', action='store_true', default=False, help='Accelerate movie generation by using a GPU')
-parser.add_argument('--num_workers', default=4, help='How many CPU cores to use. Putting a negative number enables usage of all cores')
+parser.add_argument('--num_workers', type=int, default=4, help='How many CPU cores to use. Putting a negative number enables usage of all cores')
 
 args = parser.parse_args()
 
@@ -53,24 +53,10 @@ else:
     gpu_arg = ""
 
 
-## Getting the poses from the pkl file
-for rank in args.rank.split("+"):
-    cmd = f"singularity exec {gpu_arg_singularity} --bind $PWD singularity/DynamicBindHPC.sif python3 -u {script_folder}/save_reverseprocess.py --pklFile {args.prediction_result_path}/rank{rank}_reverseprocess_data_list.pkl {remove_hs_arg}"
-    print(f"Extracting poses from pkl ({args.prediction_result_path}/rank{rank}_reverseprocess_data_list.pkl)")
-    if args.debug:
-        print(cmd)
-    do(cmd)
-
-## Check if relaxed final ligand is present, if not first run relax final on final ligand-protein complex before running relax_vis.py
-if not "_relaxed.sdf" in os.listdir(args.prediction_result_path):
-    cmd = f"singularity exec {gpu_arg_singularity} --bind $PWD singularity/DynamicBindHPC.sif python3 -u relax_final.py --num_workers {args.num_workers} {gpu_arg} --input_paths {args.prediction_result_path}"
-    print("performing relaxation of final frame")
-    if args.debug:
-        print(cmd)
-    do(cmd)
-    
-## Add singularity to command
-cmd = f"singularity exec {gpu_arg_singularity} --bind $PWD singularity/DynamicBindHPC.sif python3 -u {script_folder}/relax_vis.py --rank {args.rank} --prediction_result_path {args.prediction_result_path} --inference_steps {args.inference_steps}"
+## Rebuild, relax and collect all frames in a single process (relax_vis.py also relaxes the final frame if relax_final.py hasn't run yet)
+cmd = f"singularity exec {gpu_arg_singularity} --bind $PWD singularity/DynamicBindHPC.sif python3 -u {script_folder}/relax_vis.py --rank {args.rank} --prediction_result_path {args.prediction_result_path} --num_workers {args.num_workers} {gpu_arg} {remove_hs_arg}"
+if args.inference_steps is not None:
+    cmd += f" --inference_steps {args.inference_steps}"
 print("Processing movie frames..")
 if args.debug:
     print(cmd)
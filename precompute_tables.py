@@ -0,0 +1,19 @@
+import os
+import time
+from argparse import ArgumentParser
+
+from utils import lookup_tables
+
+parser = ArgumentParser(description='Compute the SO(3) and torus lookup tables once, e.g. into a shared directory that every job reads through $DYNAMICBIND_TABLES_DIR')
+parser.add_argument('--out_dir', type=str, default=None, help='Directory for the tables (default: $DYNAMICBIND_TABLES_DIR, or the repository folder)')
+args = parser.parse_args()
+
+if args.out_dir is not None:
+    os.environ[lookup_tables.TABLES_DIR_ENV] = os.path.abspath(args.out_dir)
+
+from utils import so3, torus
+
+for module in (so3, torus):
+    start = time.time()
+    tables = module.load_tables()
+    print(f"{module.__name__}: {', '.join(f'{name} {table.shape}' for name, table in tables.items())} ({time.time() - start:.1f}s)")
@@ -0,0 +1,48 @@
+from argparse import ArgumentParser
+from collections import Counter
+
+from tqdm import tqdm
+
+from datasets.library import LibraryReader, list_ligands
+from utils.ligand_index import ligands_to_dock
+from utils.pool import TimeoutPool, TASK_ERROR, TASK_OK, TASK_TIMEOUT
+from utils.preflight import PREFLIGHT_LEVELS, REJECTED, check_ligand, write_rejects
+
+parser = ArgumentParser(description='Checks the ligands of a run before the jobs are submitted and writes the ligands that would fail to preflight_rejects.csv in the output directory (see utils/preflight.py)')
+parser.add_argument('ligand', type=str, help='Directory of the mol2/sdf ligand files, or a SDF/SMILES library file')
+parser.add_argument('out_dir', type=str, help='Output directory of the run')
+parser.add_argument('--from_index', action='store_true', default=False, help='Only check the ligands that are docked according to the ligand index of out_dir (written by dedup_ligands.py)')
+parser.add_argument('--level', type=str, default='parse', choices=PREFLIGHT_LEVELS[1:], help='parse: read, sanitise and filter the ligands, embed: generate their conformers as well')
+parser.add_argument('--max_lig_size', type=int, default=None, help='Reject ligands with more heavy atoms')
+parser.add_argument('--allowed_elements', type=str, nargs='+', default=None, help='Reject ligands with atoms of other elements (hydrogens are checked as well)')
+parser.add_argument('--keep_local_structures', action='store_true', default=False, help='Only embed ligands without coordinates, like inference.py --keep_local_structures')
+parser.add_argument('--seed', type=int, default=42, help='Seed of the conformer generation')
+parser.add_argument('--conformer_timeout', type=int, default=300, help='Seconds a single ligand can take, slower ligands are rejected')
+parser.add_argument('--cores', '-c', type=int, default=1, help='Processes used to check the ligands')
+args = parser.parse_args()
+
+ligands = ligands_to_dock(args.out_dir) if args.from_index else list_ligands(args.ligand)
+allowed_elements = [element.capitalize() for element in args.allowed_elements] if args.allowed_elements else None
+
+# the records of a library are read in order while the workers take them
+reader = LibraryReader()
+tasks = ((reader.read(ligand), args.level, args.max_lig_size, allowed_elements, args.keep_local_structures, args.seed)
+         for _, ligand in ligands)
+results = TimeoutPool(args.cores, timeout=args.conformer_timeout or None).imap_unordered(check_ligand, tasks)
+rejects = []
+for idx, status, result in tqdm(results, total=len(ligands), ascii=True):
+    name, ligand = ligands[idx]
+    heavy_atoms, reason = result if status == TASK_OK else ('', result)
+    if status == TASK_OK and not reason:
+        continue
+    rejects.append({'name': name, 'ligand': ligand, 'status': REJECTED if status == TASK_OK else status,
+                    'heavy_atoms': heavy_atoms, 'reason': reason})
+reader.close()
+
+# in input order, like the job csvs
+order = {name: i for i, (name, _) in enumerate(ligands)}
+write_rejects(args.out_dir, sorted(rejects, key=lambda row: order[row['name']]))
+
+counts = Counter(row['status'] for row in rejects)
+print(f"{len(ligands) - len(rejects)} of {len(ligands)} ligands passed the pre-flight checks "
+      f"({counts[REJECTED]} filtered out, {counts[TASK_ERROR]} unreadable, {counts[TASK_TIMEOUT]} timed out)")
@@ -8,11 +8,14 @@ This script checks for failed molecules that did not successfully dock during a
 It scans the output directory for missing `.sdf` files (screen mode) or missing complex directories (complex mode),
 and allows users to relaunch failed jobs.
 
+Options of inference.py given after the run directory are added to the relaunched jobs, so ligands that timed
+out can be retried with relaxed settings.
+
 Usage:
-    python relaunchFailedCompounds.py <DynamicBindHPC_run_directory>
+    python relaunchFailedCompounds.py <DynamicBindHPC_run_directory> [inference.py options]
 
 Example:
-    python relaunchFailedCompounds.py VS_DB_.../
+    python relaunchFailedCompounds.py VS_DB_.../ --conformer_timeout 1200 --ligand_timeout 3600
 
 Author:
     Jochem Nelen (jnelen@ucam.edu)
@@ -24,7 +27,10 @@ import re
 import shutil
 import subprocess
 import sys
-from typing import List, Dict
+from typing import List, Dict, Tuple
+
+from utils.journal import read_journal
+from utils.scratch import unpack_archives
 
 
 def split_list(items: List[str], num_splits: int) -> List[List[str]]:
@@ -57,7 +63,7 @@ def get_all_molecules(input_dir: str) -> Dict[str, str]:
         input_dir (str): Path to the DynamicBindHPC run directory.
 
     Returns:
-        Dict[str, str]: A dictionary where keys are molecule names and values are their paths.
+        Dict[str, str]: A dictionary where keys are molecule names and values are their paths (or library records).
     """
     path_dict = {}
     csv_files = glob.glob(f"{input_dir}/csvs/*.csv")
@@ -111,6 +117,45 @@ def get_finished_items(input_dir: str) -> List[str]:
         )
 
 
+def get_timed_out_items(input_dir: str) -> Dict[str, str]:
+    """
+    Reads the run journals to find the molecules that were skipped because they ran out of time.
+
+    Args:
+        input_dir (str): Path to the DynamicBindHPC run directory.
+
+    Returns:
+        Dict[str, str]: A dictionary where keys are molecule names and values are the stage that timed out.
+    """
+    timed_out = {}
+    for path in glob.glob(f"{input_dir}/jobs_out/journal_*.jsonl"):
+        for entry in read_journal(path):
+            if entry.get("status") == "timeout":
+                timed_out[entry["name"]] = entry["stage"]
+    return timed_out
+
+
+def add_job_options(job_cmd: str, options: List[str]) -> str:
+    """
+    Appends options to the inference.py command of a job, later options override the original ones.
+
+    Args:
+        job_cmd (str): The sbatch or singularity command of an original job.
+        options (List[str]): The inference.py options to add.
+
+    Returns:
+        str: The job command with the options added.
+    """
+    if not options:
+        return job_cmd
+    return re.sub(
+        r"(inference\.py[^\"|]*?)\s*(\"|2>&1)",
+        lambda match: f"{match.group(1)} {' '.join(options)} {match.group(2)}",
+        job_cmd,
+        count=1,
+    )
+
+
 def clean_output_directory(redo_dir: str) -> None:
     """Checks if the redo directory exists and prompts the user for cleanup."""
     if os.path.isdir(redo_dir):
@@ -143,9 +188,9 @@ def create_redo_directory(redo_dir: str) -> None:
 
 
 def relaunch_jobs(
-    input_dir: str, ligand_paths_split: List[List[str]], redo_dir: str
+    input_dir: str, ligand_paths_split: List[List[Tuple[str, str]]], redo_dir: str, options: List[str] = ()
 ) -> None:
-    """Relaunches failed docking jobs using the original job settings."""
+    """Relaunches failed docking jobs using the original job settings, with `options` added to inference.py."""
     job_paths = glob.glob(f"{input_dir}/jobs/job_*.sh")
 
     if not job_paths:
@@ -161,8 +206,8 @@ def relaunch_jobs(
 
         with open(csv_file_path, "w") as job_csv:
             job_csv.write("name;protein_path;ligand\n")
-            for ligand in job_ligands:
-                complex_name = os.path.basename(ligand).split(".")[0]
+            # the names come from the original csvs, library records have no file name to derive them from
+            for complex_name, ligand in job_ligands:
                 job_csv.write(f"{complex_name};{protein_path};{ligand}\n")
 
         job_cmd = re.sub(
@@ -175,6 +220,7 @@ def relaunch_jobs(
             rf"\1{csv_file_path}\2",
             job_cmd,
         )
+        job_cmd = add_job_options(job_cmd, list(options))
 
         job_file_path = f"{redo_dir}/jobs/redo_job_{i+1}.sh"
         with open(job_file_path, "w") as job_file:
@@ -190,9 +236,12 @@ def main() -> None:
         sys.exit("You must provide a DynamicBindHPC run directory as an argument.")
 
     input_path = sys.argv[1]
+    options = sys.argv[2:]
     if not os.path.isdir(input_path):
         sys.exit("The input path is not a valid directory.")
 
+    # outputs of jobs that ran with --scratch are still in their archives
+    unpack_archives(input_path)
     path_dict = get_all_molecules(input_path)
     finished_list = get_finished_items(input_path)
 
@@ -212,6 +261,17 @@ def main() -> None:
         f"Failed to process: {failed_count}/{total_count} ({(failed_count / total_count) * 100:.1f}%)"
     )
 
+    timed_out = get_timed_out_items(input_path)
+    timed_out_count = sum(name in path_dict for name in timed_out)
+    if timed_out_count > 0:
+        print(
+            f"Timed out: {timed_out_count}/{failed_count} of the failed compounds (see the journals in jobs_out/)"
+        )
+        if not options:
+            print(
+                "Add inference.py options after the run directory to retry them with relaxed settings, e.g. --conformer_timeout 1200 --ligand_timeout 3600"
+            )
+
     if failed_count == 0:
         print("All compounds processed successfully! No jobs to relaunch.")
         return
@@ -228,12 +288,12 @@ def main() -> None:
         else:
             print("Invalid input. Please enter a positive integer greater than 0.")
 
-    ligand_paths_split = split_list(list(path_dict.values()), job_number)
+    ligand_paths_split = split_list(list(path_dict.items()), job_number)
     redo_directory = f"{input_path}/redo/"
     clean_output_directory(redo_directory)
     create_redo_directory(redo_directory)
 
-    relaunch_jobs(input_path, ligand_paths_split, redo_directory)
+    relaunch_jobs(input_path, ligand_paths_split, redo_directory, options)
 
 
 if __name__ == "__main__":
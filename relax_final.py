@@ -1,6 +1,6 @@
 from argparse import ArgumentParser, Namespace, FileType
 from Bio.PDB import PDBParser,PDBIO
-import os,copy
+import os,sys,copy
 import numpy as np
 
 from multiprocessing import Pool
@@ -25,12 +25,13 @@ import glob
 parser = ArgumentParser()
 
 parser.add_argument('--results_path', type=str, default='results/user_inference', help='Directory where the outputs will be written to')
-parser.add_argument('--input_paths', nargs='+', help='The exact input paths you want to be processed')
+parser.add_argument('--input_paths', nargs='+', default=[], help='The exact input paths you want to be processed')
+parser.add_argument('--input_list', type=str, default=None, help='Text file with one input path per line. Can be used instead of --input_paths')
+parser.add_argument('--array_index', type=int, default=os.environ.get('SLURM_ARRAY_TASK_ID'), help='Only process the input path on this (0-based) line of --input_list. Defaults to the Slurm array task id when running as a job array')
 parser.add_argument('--num_workers', type=int, default=20, help='Number of workers for creating the dataset')
 parser.add_argument('--samples_per_complex', type=int, default=1, help='Number of samples to generate')
 parser.add_argument('--gpu', action='store_true', default=False, help='Use a GPU for the relaxing process')
-
-args = parser.parse_args()
+parser.add_argument('--unpack_archives', type=str, default=None, help='Output directory of a --scratch run, its result archives are unpacked before relaxing')
 
 from rdkit.Chem.rdmolfiles import MolToPDBBlock, MolToPDBFile
 import rdkit.Chem
@@ -490,8 +491,8 @@ def run_relax(x):
             os.system(f"rm {relaxed_complexFile}")
             os.system(f"rm {relaxed_ligandFile}")
             rank = os.path.basename(pdbFile).split('_')[0]
-            # print(f"rm {os.path.dirname(pdbFile)}/{rank}_reverseprocess_data_list.pkl")
-            os.system(f"rm {os.path.dirname(pdbFile)}/{rank}_reverseprocess_data_list.pkl")
+            # print(f"rm {os.path.dirname(pdbFile)}/{rank}_reverseprocess.npz")
+            os.system(f"rm {os.path.dirname(pdbFile)}/{rank}_reverseprocess.npz")
         os.system(f"rm {fixed_pdbFile}")
         return 0
     except Exception as e:
@@ -499,14 +500,51 @@ def run_relax(x):
         os.system(f"rm {pdbFile}")
         os.system(f"rm {ligandFile}")
         rank = os.path.basename(pdbFile).split('_')[0]
-        os.system(f"rm {os.path.dirname(pdbFile)}/{rank}_reverseprocess_data_list.pkl")
+        os.system(f"rm {os.path.dirname(pdbFile)}/{rank}_reverseprocess.npz")
         return 1
 
+def relax_task(write_dir, file_paths, rank, ref_proteinFile, ref_ligandFile, idx, use_gpu):
+    # the run_relax arguments for the final structures of one rank, None if they are not there
+    try:
+        ligand_file_name = [path for path in file_paths if f'rank{rank}_ligand_lddt' in path][0]
+        protein_file_name = [path for path in file_paths if f'rank{rank}_receptor_lddt' in path][0]
+    except:
+        return None
+    pdb_or_cif = protein_file_name[-3:]
+    pdbFile = os.path.join(write_dir, protein_file_name)
+    ligandFile = os.path.join(write_dir, ligand_file_name)
+    fixed_pdbFile = os.path.join(write_dir, f'fixed_{idx}.{pdb_or_cif}')
+    relaxed_proteinFile = os.path.join(write_dir, protein_file_name.replace(f'.{pdb_or_cif}',f'_relaxed.{pdb_or_cif}'))
+    gap_mask = "none"
+    stiffness, ligand_stiffness = 1000, 3000
+    relaxed_complexFile = relaxed_proteinFile.replace("_receptor_", "_complex_")
+    relaxed_ligandFile = os.path.join(write_dir, ligand_file_name.replace('.sdf','_relaxed.sdf'))
+    return (ref_proteinFile, ref_ligandFile, pdbFile, ligandFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, ligand_stiffness, relaxed_complexFile, relaxed_ligandFile, use_gpu)
+
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     input_ = []
     idx = 0
 
+    if args.unpack_archives is not None:
+        from utils.scratch import unpack_archives
+        unpack_archives(args.unpack_archives)
+
+    if args.input_list is not None:
+        with open(args.input_list) as f:
+            list_paths = [line.strip() for line in f if line.strip() != '']
+        if args.array_index is not None:
+            list_paths = list_paths[args.array_index:args.array_index+1]
+        args.input_paths = args.input_paths + list_paths
+        # complexes that failed during docking don't have an output directory
+        missing_paths = [path for path in args.input_paths if not os.path.isdir(path)]
+        for path in missing_paths:
+            print(f"Skipping {path}, the directory doesn't exist")
+        args.input_paths = [path for path in args.input_paths if os.path.isdir(path)]
+        if len(args.input_paths) == 0:
+            sys.exit(0)
+
     if len(args.input_paths) < 1:
         results_path_containments = sorted(os.listdir(args.results_path))
         results_path_containments = [x for x in results_path_containments if x != 'affinity_prediction.csv']
@@ -534,22 +572,9 @@ if __name__ == '__main__':
         except:
             ref_ligandFile = ''
         for rank in range(args.samples_per_complex):
-            try:
-                ligand_file_name = [path for path in file_paths if f'rank{rank+1}_ligand_lddt' in path][0]
-                protein_file_name = [path for path in file_paths if f'rank{rank+1}_receptor_lddt' in path][0]
-            except:
+            x = relax_task(write_dir, file_paths, rank+1, ref_proteinFile, ref_ligandFile, idx, args.gpu)
+            if x is None:
                 continue
-            pdb_or_cif = protein_file_name[-3:]
-            pdbFile = os.path.join(write_dir, protein_file_name)
-            ligandFile = os.path.join(write_dir, ligand_file_name)
-            fixed_pdbFile = os.path.join(write_dir, f'fixed_{idx}.{pdb_or_cif}')
-            relaxed_proteinFile = os.path.join(write_dir, protein_file_name.replace(f'.{pdb_or_cif}',f'_relaxed.{pdb_or_cif}'))
-            gap_mask = "none"
-            stiffness, ligand_stiffness = 1000, 3000
-            relaxed_complexFile = relaxed_proteinFile.replace("_receptor_", "_complex_")
-            relaxed_ligandFile = os.path.join(write_dir, ligand_file_name.replace('.sdf','_relaxed.sdf'))
-            use_gpu = args.gpu
-            x = (ref_proteinFile, ref_ligandFile, pdbFile, ligandFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, ligand_stiffness, relaxed_complexFile, relaxed_ligandFile, use_gpu)
             input_.append(x)
             idx += 1
     # print(input_)
@@ -565,14 +590,14 @@ if __name__ == '__main__':
         # if int(rp.split('_')[0][5:]) > 20:continue
         write_dir = os.path.join(args.results_path, rp)
         file_paths = sorted(os.listdir(write_dir))
-        orig_rank = [int(fn.split('_')[0][4:]) for fn in file_paths if 'reverseprocess_data_list.pkl' in fn]
+        orig_rank = [int(fn.split('_')[0][4:]) for fn in file_paths if fn.endswith('_reverseprocess.npz')]
         for i,rank in enumerate(sorted(orig_rank)):
             ligand_file_name = [path for path in file_paths if f'rank{rank}_ligand_lddt' in path and 'relaxed' not in path][0]
             protein_file_name = [path for path in file_paths if f'rank{rank}_receptor_lddt' in path and 'relaxed' not in path][0]
             relaxed_ligand_file_name = [path for path in file_paths if f'rank{rank}_ligand_lddt' in path and 'relaxed' in path][0]
             relaxed_protein_file_name = [path for path in file_paths if f'rank{rank}_receptor_lddt' in path and 'relaxed' in path][0]
             relaxed_complex_file_name = relaxed_protein_file_name.replace("_receptor_", "_complex_")
-            data_file_name = f'rank{rank}_reverseprocess_data_list.pkl'
+            data_file_name = f'rank{rank}_reverseprocess.npz'
             new_ligand_file_name = ligand_file_name.replace(f'rank{rank}',f'rank{i+1}')
             new_protein_file_name = protein_file_name.replace(f'rank{rank}',f'rank{i+1}')
             new_relaxed_ligand_file_name = relaxed_ligand_file_name.replace(f'rank{rank}',f'rank{i+1}')
@@ -2,8 +2,15 @@ from argparse import ArgumentParser, Namespace, FileType
 from Bio.PDB import PDBParser,MMCIFParser
 from Bio.PDB import PDBIO, MMCIFIO, Select
 import os,copy
+import glob
+import shutil
+import tempfile
 from tqdm import tqdm
 from utils.relax import openmm_relax, openmm_relax_protein_only
+from utils.pool import TimeoutPool, TASK_OK
+from utils.trajectory import trajectory_path, load_trajectory, load_reference_structures
+from utils.visualise import modify_pdb_from_arrays
+from relax_final import relax_task, run_relax
 
 from rdkit.Chem.rdmolfiles import MolToPDBBlock, MolToPDBFile
 import rdkit.Chem
@@ -84,83 +91,110 @@ def save_protein(s, proteinFile, ca_only=False):
     return None
 
 
-def single_sample_movie(file_names, write_dir, rank, inference_steps, ):
-    for step in tqdm(range(inference_steps+1), ascii=True):
-        ligandFile = os.path.join(write_dir, [fn for fn in file_names if f'rank{rank}_ligand_step{step+1}.' in fn][0])
-        pdbFile = os.path.join(write_dir, [fn for fn in file_names if f'rank{rank}_receptor_step{step+1}.' in fn][0])
-        if step == 0:
-            lig = rdkit.Chem.SDMolSupplier(ligandFile, sanitize=False, removeHs=False)[0]
-            relaxed_ligand = LigandToPDB(lig)
-            lig_pos = lig.GetConformer().GetPositions()
-            relaxed_ligand.add(lig_pos, 1, 0)
-
-            pdb_or_cif = pdbFile[-3:]
-            if pdb_or_cif == 'pdb':
-                parser = PDBParser()
-            elif pdb_or_cif == 'cif':
-                parser = MMCIFParser()
+def ligand_frame(lig, coords, remove_hs):
+    # same conversion as write_mol_with_coords, without the round trip through an sdf file
+    mol = copy.deepcopy(lig)
+    conf = mol.GetConformer()
+    for i in range(mol.GetNumAtoms()):
+        x, y, z = coords.astype(np.double)[i]
+        conf.SetAtomPosition(i, Geometry.Point3D(x, y, z))
+    if not remove_hs:
+        mol = rdkit.Chem.AddHs(mol, addCoords=True)
+    else:
+        mol = rdkit.Chem.RemoveHs(mol, sanitize=False)
+    return mol
+
+
+def relax_frames(task):
+    """
+    Rebuild and relax a contiguous chunk of receptor frames. Every frame is warm-started from the relaxed previous
+    frame of the chunk, which is close to it, so the minimisation converges in fewer iterations.
+    """
+    write_dir, tmp_dir, rank, steps, use_gpu = task
+    trajectory = load_trajectory(trajectory_path(write_dir, rank))
+    _, receptor_pdb, pdb_or_cif = load_reference_structures(write_dir)
+    fixed_pdbFile = os.path.join(tmp_dir, f'fixed_{steps[0]}.{pdb_or_cif}')
+    gap_mask = "none"
+    stiffness = 1000
+    relaxed_proteinFiles = []
+    init_positions = None
+    for step in steps:
+        pdbFile = os.path.join(tmp_dir, f'rank{rank}_receptor_step{step+1}.{pdb_or_cif}')
+        relaxed_proteinFile = os.path.join(tmp_dir, f'rank{rank}_receptor_step{step+1}_relaxed.{pdb_or_cif}')
+        new_receptor_pdb = copy.deepcopy(receptor_pdb)
+        modify_pdb_from_arrays(new_receptor_pdb, trajectory['lf_3pts'][step], trajectory['acc_pred_chis'][step],
+                               trajectory['chi_masks'], trajectory['original_center'])
+        save_protein(new_receptor_pdb, pdbFile)
+        try:
+            retry = 0
+            ret = openmm_relax_protein_only((pdbFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, use_gpu), init_positions=init_positions)
+            while ret['efinal'] > 0 and retry < 5:
+                ret = openmm_relax_protein_only((relaxed_proteinFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, use_gpu))
+                print(ret)
+                retry += 1
+            init_positions = ret['pos']
+        except Exception as e:
+            print(e, "relax fail, use original instead")
+            shutil.copyfile(pdbFile, relaxed_proteinFile)
+            init_positions = None
+        relaxed_proteinFiles.append(relaxed_proteinFile)
+    return relaxed_proteinFiles
+
+
+def relaxed_final_receptor(write_dir, rank, use_gpu):
+    # the final frame is the relaxed final prediction of relax_final.py, relax it first if that hasn't happened yet
+    file_names = sorted(os.listdir(write_dir))
+    relaxed = [fn for fn in file_names if f'rank{rank}_receptor_lddt' in fn and 'relaxed' in fn]
+    if not relaxed:
+        ref_proteinFiles = glob.glob(f'{write_dir}/../../*pdb')
+        x = relax_task(write_dir, file_names, rank, ref_proteinFiles[0], '', 0, use_gpu) if ref_proteinFiles else None
+        if x is not None:
+            print("performing relaxation of final frame")
+            run_relax(x)
+        relaxed = [fn for fn in sorted(os.listdir(write_dir)) if f'rank{rank}_receptor_lddt' in fn and 'relaxed' in fn]
+    return os.path.join(write_dir, relaxed[0]) if relaxed else None
+
+
+def single_sample_movie(write_dir, rank, num_workers, use_gpu, remove_hs, inference_steps=None):
+    trajectory = load_trajectory(trajectory_path(write_dir, rank))
+    lig, receptor_pdb, pdb_or_cif = load_reference_structures(write_dir)
+    if inference_steps is None:
+        inference_steps = len(trajectory['ligand_pos']) - 1
+    parser = MMCIFParser(QUIET=True) if pdb_or_cif == 'cif' else PDBParser(QUIET=True)
+
+    relaxed_ligand = LigandToPDB(lig)
+    for step in range(inference_steps+1):
+        relaxed_ligand.add(ligand_frame(lig, trajectory['ligand_pos'][step] + trajectory['original_center'], remove_hs), 1, step)
+
+    # the first frame is kept as it is, the intermediate frames are relaxed in parallel in contiguous chunks
+    relaxed_protein = modify_pdb_from_arrays(copy.deepcopy(receptor_pdb), trajectory['lf_3pts'][0], trajectory['acc_pred_chis'][0],
+                                             trajectory['chi_masks'], trajectory['original_center'])
+    tmp_dir = tempfile.mkdtemp(prefix=f'rank{rank}_frames_', dir=write_dir)
+    try:
+        steps = np.arange(1, max(inference_steps-1, 1))
+        chunks = [chunk.tolist() for chunk in np.array_split(steps, min(num_workers, len(steps))) if len(chunk)] if len(steps) else []
+        relaxed_proteinFiles = {}
+        pool = TimeoutPool(len(chunks))
+        for index, status, result in tqdm(pool.imap_unordered(relax_frames, [(write_dir, tmp_dir, rank, chunk, use_gpu) for chunk in chunks]), total=len(chunks), ascii=True):
+            if status != TASK_OK:
+                raise RuntimeError(f'relaxing frames {chunks[index]} failed: {result}')
+            relaxed_proteinFiles.update(zip(chunks[index], result))
+
+        final_proteinFile = relaxed_final_receptor(write_dir, rank, use_gpu)
+        for step in range(1, inference_steps+1):
+            if step < inference_steps-1:
+                s = parser.get_structure(pdb_or_cif, relaxed_proteinFiles[step])[0]
+            elif final_proteinFile is not None:
+                s = parser.get_structure(pdb_or_cif, final_proteinFile)[0]
             else:
-                raise 'protein is not pdb or cif'
-            relaxed_protein = parser.get_structure(pdb_or_cif, pdbFile)
-            continue
-        fixed_pdbFile = os.path.join(write_dir, f'fixed.{pdb_or_cif}')
-        relaxed_proteinFile = os.path.join(write_dir, f'rank{rank}_receptor_step{step+1}_relaxed.{pdb_or_cif}')
-        gap_mask = "none"
-        stiffness = 1000
-        ligand_stiffness = 3000
-        relaxed_complexFile = "none"
-        use_gpu = True if torch.cuda.is_available() else False
-        
-        if step < inference_steps-1:
-            relaxed_ligandFile = ligandFile
-            try:
-                retry = 0
-                ret = openmm_relax_protein_only((pdbFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, use_gpu))
-                while ret['efinal'] > 0 and retry < 5:
-                    # if ret['einit'] > 0 and ret['efinal'] / ret['einit'] < 0.1:
-                    #     break
-                    ret = openmm_relax_protein_only((relaxed_proteinFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, use_gpu))
-                    print(ret)
-
-                    retry += 1
-                # print(ret['einit'],ret['efinal'])
-            except Exception as e:
-                print(e, "relax fail, use original instead")
-                _ = os.system(f"cp {pdbFile} {relaxed_proteinFile}")
-
-        else:
-            relaxed_ligandFile = os.path.join(write_dir, [fn for fn in file_names if f'rank{rank}_ligand_lddt' in fn and 'relaxed' in fn][0])
-            relaxed_proteinFile = os.path.join(write_dir, [fn for fn in file_names if f'rank{rank}_receptor_lddt' in fn and 'relaxed' in fn][0])
-            relaxed_ligandFile = ligandFile
-            
-            # try:
-            #     retry = 0
-            #     ret = openmm_relax((pdbFile, ligandFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, ligand_stiffness, relaxed_complexFile, relaxed_ligandFile, use_gpu))
-            #     while ret['efinal'] > 0 and retry < 5:
-            #         # print(ret['einit'],ret['efinal'])
-            #         # if ret['einit'] > 0 and ret['efinal'] / ret['einit'] < 0.001:
-            #         #     break
-            #         ret = openmm_relax((relaxed_proteinFile, ligandFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, ligand_stiffness, relaxed_complexFile, relaxed_ligandFile, use_gpu))
-            #         retry += 1
-            #     # print(ret['einit'],ret['efinal'])
-            #     # if ret['efinal'] > 0:
-            #     #     ret = openmm_relax_protein_only((pdbFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, use_gpu))
-            #     #     print(ret['einit'],ret['efinal'])
-            #     #     ret = openmm_relax((relaxed_proteinFile, ligandFile, fixed_pdbFile, relaxed_proteinFile, gap_mask, stiffness, ligand_stiffness, relaxed_complexFile, relaxed_ligandFile, use_gpu))
-            #     #     print(ret['einit'],ret['efinal'])
-            # except Exception as e:
-            #     print(e, "relax fail, use original instead")
-            #     _ = os.system(f"cp {pdbFile} {relaxed_proteinFile}")
-            #     _ = os.system(f"cp {ligandFile} {relaxed_ligandFile}")
-
-        lig = rdkit.Chem.SDMolSupplier(relaxed_ligandFile, sanitize=False, removeHs=False)[0]
-        lig_pos = lig.GetConformer().GetPositions()
-        relaxed_ligand.add(lig_pos, 1, step)
-
-        s = parser.get_structure(pdb_or_cif, relaxed_proteinFile)[0]
-        s.id = step
-        s.serial_num = step + 1
-        relaxed_protein.add(s)
+                print("no relaxed final structure, using the predicted one instead")
+                s = modify_pdb_from_arrays(copy.deepcopy(receptor_pdb), trajectory['lf_3pts'][step], trajectory['acc_pred_chis'][step],
+                                           trajectory['chi_masks'], trajectory['original_center'])[0]
+            s.id = step
+            s.serial_num = step + 1
+            relaxed_protein.add(s)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
     vis_ligandFile = os.path.join(write_dir, f'rank{rank}_ligand_reverseprocess_relaxed.pdb')
     relaxed_ligand.write(vis_ligandFile)
     save_protein(relaxed_protein,os.path.join(write_dir, f'rank{rank}_receptor_reverseprocess_relaxed.{pdb_or_cif}'))
@@ -174,28 +208,28 @@ parser.add_argument('--rank', type=str, default="", help='specify the sample to
              could give multiple. for example 1+2+3')
 parser.add_argument('--prediction_result_path', type=str, default='results/test/index0_idx_0', help='informative name used to name result folder')
 
-parser.add_argument('--inference_steps', type=int, default=20, help='num of coordinate updates. (movie frames)')
+parser.add_argument('--inference_steps', type=int, default=None, help='num of coordinate updates. (movie frames) Defaults to the number of steps in the trajectory file')
 parser.add_argument('--results_path', type=str, default='results/user_inference', help='Directory where the outputs will be written to')
-parser.add_argument('--num_workers', type=int, default=1, help='Number of workers for creating the dataset')
+parser.add_argument('--num_workers', type=int, default=1, help='Number of processes used to relax the movie frames')
 parser.add_argument('--samples_per_complex', type=int, default=1, help='Number of samples to generate')
+parser.add_argument('--gpu', action='store_true', default=False, help='Use a GPU for the relaxing process')
+parser.add_argument('--remove_hs', action='store_true', default=False, help='Remove the hydrogens in the ligand frames')
 
 args = parser.parse_args()
 
 if args.rank != "":
     write_dir = args.prediction_result_path
-    file_names = os.listdir(write_dir)
     for rank in args.rank.split("+"):
-        single_sample_movie(file_names, write_dir, rank, args.inference_steps)
+        single_sample_movie(write_dir, rank, args.num_workers, args.gpu, args.remove_hs, args.inference_steps)
 else:
     results_path_containments = os.listdir(args.results_path)
     results_path_containments = [x for x in results_path_containments if x != 'affinity_prediction.csv']
 
     def relax(write_dir):
-        file_names = os.listdir(write_dir)
         for rank in range(args.samples_per_complex):
-            single_sample_movie(file_names, write_dir, rank+1, args.inference_steps)
+            single_sample_movie(write_dir, rank+1, args.num_workers, args.gpu, args.remove_hs, args.inference_steps)
     for rp in tqdm(results_path_containments):
         if not rp.startswith('index'):
             continue
         write_dir = os.path.join(args.results_path, rp)
-        relax(write_dir)
\ No newline at end of file
+        relax(write_dir)
@@ -20,7 +20,9 @@ from rdkit import RDLogger
 from rdkit.Chem import MolFromSmiles, AddHs
 
 from datasets.process_mols import read_molecule, generate_conformer, write_mol_with_coords
-from utils.visualise import LigandToPDB, modify_pdb, receptor_to_pdb, save_protein
+from utils.visualise import LigandToPDB, modify_pdb, modify_pdb_from_arrays, receptor_to_pdb, save_protein
+from utils.pdb_writer import ReceptorTemplate
+from utils.trajectory import trajectory_path, load_trajectory, load_reference_structures
 # from utils.relax import openmm_relax
 from tqdm import tqdm
 import datetime
@@ -29,7 +31,6 @@ from contextlib import contextmanager
 from multiprocessing import Pool as ThreadPool
 
 import random
-import pickle
 
 
 
@@ -47,38 +48,42 @@ parser = ArgumentParser()
 parser.add_argument('--results_path', type=str, default='results/user_inference', help='Directory where the outputs will be written to')
 parser.add_argument('--num_workers', type=int, default=1, help='Number of workers for creating the dataset')
 parser.add_argument('--samples_per_complex', type=int, default=1, help='Number of samples to generate')
-parser.add_argument('--pklFile', type=str, default="", help='specify the pkl files.')
+parser.add_argument('--trajectory', type=str, default="", help='specify the rank<n>_reverseprocess.npz trajectory file.')
 parser.add_argument('--remove_hs', action='store_true', default=False, help='Remove the hydrogens in the final output structures')
 
-def single_sample_save(pklFile):
-    write_dir = os.path.dirname(pklFile)
-    fn = os.path.basename(pklFile)
+def single_sample_save(trajectoryFile):
+    write_dir = os.path.dirname(trajectoryFile)
+    fn = os.path.basename(trajectoryFile)
     rank = fn.split('_')[0]
-    with open(os.path.join(write_dir,fn),'rb') as f:
-        data_step = pickle.load(f)
-    lig, receptor_pdb = data_step[0]
-    pdb_or_cif = receptor_pdb.get_full_id()[0]
-    for idx, data in enumerate(data_step[1:]):
+    trajectory = load_trajectory(trajectoryFile)
+    lig, receptor_pdb, pdb_or_cif = load_reference_structures(write_dir)
+    # every frame only fills in its coordinates (utils/pdb_writer.py)
+    template = ReceptorTemplate(receptor_pdb) if pdb_or_cif == 'pdb' else None
+    for idx in range(len(trajectory['ligand_pos'])):
         mol_pred = copy.deepcopy(lig)
         ligandFile = os.path.join(write_dir, f'{rank}_ligand_step{idx+1}.sdf')
-        write_mol_with_coords(mol_pred, (data['ligand'].pos + data.original_center).numpy(), ligandFile, args.remove_hs)
-        new_receptor_pdb = copy.deepcopy(receptor_pdb)
-        modify_pdb(new_receptor_pdb,data)
+        write_mol_with_coords(mol_pred, trajectory['ligand_pos'][idx] + trajectory['original_center'], ligandFile, args.remove_hs)
+        new_receptor_pdb = receptor_pdb if template is not None else copy.deepcopy(receptor_pdb)
+        modify_pdb_from_arrays(new_receptor_pdb, trajectory['lf_3pts'][idx], trajectory['acc_pred_chis'][idx],
+                               trajectory['chi_masks'], trajectory['original_center'])
         pdbFile = os.path.join(write_dir, f'{rank}_receptor_step{idx+1}.{pdb_or_cif}')
-        save_protein(new_receptor_pdb,pdbFile)
+        if template is not None:
+            template.save(pdbFile)
+            template.reset()
+        else:
+            save_protein(new_receptor_pdb,pdbFile)
 
 
 def save(write_dir):
     # file_paths = sorted(os.listdir(write_dir))
     # for fn in file_paths:
     for i in range(args.samples_per_complex):
-        fn = f'rank{i+1}_reverseprocess_data_list.pkl'
-        single_sample_save(os.path.join(write_dir,fn))
+        single_sample_save(trajectory_path(write_dir, i+1))
 
 
 args = parser.parse_args()
-if args.pklFile != "":
-    single_sample_save(args.pklFile)
+if args.trajectory != "":
+    single_sample_save(args.trajectory)
 else:
     results_path_containments = os.listdir(args.results_path)
     results_path_containments = [x for x in results_path_containments if x != 'affinity_prediction.csv']
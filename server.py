@@ -0,0 +1,61 @@
+import os
+import signal
+import sys
+import warnings
+warnings.filterwarnings("ignore")
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description='Docking server: keeps the model and the receptors loaded and docks the ligands of concurrent requests together (see utils/service.py). Query it with dock_client.py')
+parser.add_argument('--port', type=int, default=8765, help='Port on 127.0.0.1 to listen on')
+parser.add_argument('--socket', type=str, default=None, help='Listen on this Unix socket instead of a port')
+parser.add_argument('--receptor', '-r', type=str, nargs='*', default=[], help='Receptors to featurise before the server starts')
+parser.add_argument('--model_dir', type=str, default='workdir/big_score_model_sanyueqi_with_time', help='Path to folder with trained score model and hyperparameters')
+parser.add_argument('--ckpt', type=str, default='ema_inference_epoch314_model.pt', help='Checkpoint to use for the score model')
+parser.add_argument('--esm_embeddings_path', type=str, default='data/esm2_output', help='Directory with the ESM embeddings of the receptors (see proteinEmbedding.py)')
+parser.add_argument('--samples_per_complex', '-n', type=int, default=10, help='Number of samples per ligand')
+parser.add_argument('--inference_steps', type=int, default=20, help='Number of denoising steps')
+parser.add_argument('--batch_size', type=int, default=32, help='Maximum number of samples in a batch of the reverse diffusion')
+parser.add_argument('--batch_budget', type=str, default=None, help='Batch the samples by estimated graph size instead, see inference.py')
+parser.add_argument('--ligands_per_batch', type=int, default=None, help='Maximum number of ligands docked together, defaults to batch_size // samples_per_complex')
+parser.add_argument('--batch_wait', type=float, default=0.1, help='Seconds to wait for more ligands before an idle server starts docking')
+parser.add_argument('--rigid_protein', action='store_true', default=False, help='Keep the receptor rigid')
+parser.add_argument('--conformer_timeout', type=int, default=300, help='Maximum number of seconds to generate the conformer of a single ligand (0 for no limit)')
+parser.add_argument('--compile', action='store_true', default=False, help='On the GPU, run the score model through torch.compile')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16', 'int8-dynamic'], help='Numeric precision of the score model, see inference.py')
+parser.add_argument('--cores', '-c', type=int, default=1, help='How many cores to use')
+parser.add_argument('--seed', type=int, default=None, help='Seed of the conformers and the reverse diffusion')
+args = parser.parse_args()
+if args.batch_budget is not None and args.batch_budget != 'auto' and not (args.batch_budget.isdigit() and int(args.batch_budget) > 0):
+    parser.error('--batch_budget must be a positive integer or auto')
+
+import torch
+from rdkit import RDLogger
+
+from utils.engine import DynamicBindEngine
+from utils.service import DockingService, make_server
+
+RDLogger.DisableLog('rdApp.*')
+torch.set_num_threads(args.cores)
+
+engine = DynamicBindEngine(model_dir=args.model_dir, ckpt=args.ckpt, samples_per_complex=args.samples_per_complex,
+                           inference_steps=args.inference_steps, batch_size=args.batch_size,
+                           batch_budget=args.batch_budget, ligands_per_batch=args.ligands_per_batch,
+                           protein_dynamic=not args.rigid_protein, esm_embeddings_path=args.esm_embeddings_path,
+                           num_conformer_workers=args.cores, conformer_timeout=args.conformer_timeout or None,
+                           seed=args.seed, compile=args.compile, precision=args.precision)
+for receptor in args.receptor:
+    print(f'Featurised {receptor}: {engine.load_receptor(os.path.abspath(receptor)).num_residues} residues')
+
+server = make_server(DockingService(engine, batch_wait=args.batch_wait), port=args.port, socket_path=args.socket)
+# scancel and a Slurm time limit send SIGTERM, exit through the finally below
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+print(f"DynamicBind server on {engine.device} listening on {args.socket or f'127.0.0.1:{args.port}'}, "
+      f"{engine.samples_per_complex} samples and up to {engine.ligands_per_batch} ligands per batch", flush=True)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    if args.socket is not None and os.path.exists(args.socket):
+        os.remove(args.socket)
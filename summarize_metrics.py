@@ -0,0 +1,40 @@
+import glob
+import json
+import os
+from argparse import ArgumentParser
+
+from utils.metrics import read_metrics, summarize
+
+parser = ArgumentParser(description='Per stage timing percentiles over the metrics_<job>.jsonl files of a run')
+parser.add_argument('paths', nargs='+', help='metrics .jsonl files, or output directories of inferenceVS.py (all jobs_out/metrics_*.jsonl files are used)')
+parser.add_argument('--status', type=str, default=None, help='Only use the ligands with this status (ok, failed, skipped)')
+parser.add_argument('--json', action='store_true', default=False, help='Print the summary as JSON instead of a table')
+args = parser.parse_args()
+
+files = []
+for path in args.paths:
+    if os.path.isdir(path):
+        files.extend(sorted(glob.glob(os.path.join(path, 'jobs_out', 'metrics_*.jsonl')) + glob.glob(os.path.join(path, 'metrics_*.jsonl'))))
+    else:
+        files.append(path)
+
+entries = read_metrics(files)
+if args.status is not None:
+    entries = [entry for entry in entries if entry['status'] == args.status]
+summary = summarize(entries)
+
+if args.json:
+    print(json.dumps(summary, indent=2))
+else:
+    statuses = {}
+    for entry in entries:
+        statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+    print(f"{len(entries)} ligands from {len(files)} file(s): " + ", ".join(f"{n} {status}" for status, n in sorted(statuses.items())))
+
+    def fmt(value, spec='.2f'):
+        return '-' if value is None else format(value, spec)
+
+    print(f"{'stage':<16}{'ligands':>8}{'share':>8}{'p50 s':>10}{'p90 s':>10}{'p99 s':>10}{'max s':>10}{'cpu/wall':>10}{'rss MB':>10}{'gpu MB':>10}")
+    for stage, s in sorted(summary.items(), key=lambda item: -item[1]['total_wall']):
+        print(f"{stage:<16}{s['ligands']:>8}{s['share']:>8.1%}{fmt(s['p50']):>10}{fmt(s['p90']):>10}{fmt(s['p99']):>10}"
+              f"{fmt(s['max']):>10}{fmt(s['cpu_per_wall']):>10}{fmt(s['rss_peak_mb'], '.0f'):>10}{fmt(s['gpu_peak_mb'], '.0f'):>10}")
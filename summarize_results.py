@@ -3,12 +3,18 @@ import glob
 import os
 import sys
 
+from utils.ligand_index import duplicates
+from utils.scratch import unpack_archives
+
 # input should be the main VS_DB directory
 
 args = sys.argv
 
 inputDir = args[1]
 
+# Unpack the result archives of jobs that ran with --scratch
+unpack_archives(inputDir)
+
 # Get all relevant File Paths (different cases if visualization is saved or not)
 if os.path.isdir(f"{inputDir}/complexes"):	
 	filePaths = glob.glob(f"{inputDir}/complexes/*/*_lddt*_affinity*.sdf")
@@ -24,6 +30,12 @@ for filePath in filePaths:
 	affinityScore = filePath.split("_affinity")[-1].split(".sdf")[0]
 	finalData.append([fileName,lddtScore,affinityScore,filePath])
 
+# Ligands that were not docked because they duplicate another ligand get the results of that ligand
+duplicatesOf = {}
+for name, representative in duplicates(inputDir).items():
+	duplicatesOf.setdefault(representative, []).append(name)
+finalData += [[name] + row[1:] for row in finalData for name in duplicatesOf.get(row[0], [])]
+
 # Sort the finalData based on the affinityScore
 finalData = sorted(finalData, key=lambda x:(x[2], x[1]),reverse=True)
 
@@ -0,0 +1,164 @@
+"""
+    Batching of the complex graphs of the reverse diffusion by size instead of by count.
+
+    The cost of a graph is an estimate of the number of nodes and edges the score model works on: receptor residues,
+    ligand atoms, the receptor radius graph, the ligand radius graph and the ligand-receptor cross edges within the
+    cross distance cutoff. Graphs are packed in order into batches whose total cost stays under a budget, which is
+    either given or derived from the free GPU memory (or the memory limit of the job on the CPU). A batch that still
+    runs out of memory is split in two and retried, and the budget is lowered for the following batches.
+"""
+import math
+import os
+from collections import deque
+
+import torch
+from torch_geometric.data import Batch
+
+RESIDUE_DENSITY = 0.0074  # C-alpha atoms per cubic angstrom in a folded protein
+REC_NEIGHBORS = 24  # max_num_neighbors of the receptor radius graph of the score model
+LIG_NEIGHBORS = 24  # upper estimate of the ligand atoms within the 5 angstrom ligand radius
+ATOM_NEIGHBORS = 8
+
+
+def cross_cutoff(model_args):
+    """Largest ligand-receptor distance with a cross edge, reached at the start of the reverse diffusion"""
+    if getattr(model_args, 'dynamic_max_cross', False):
+        return max(20., 3 * model_args.tr_sigma_max + 12)
+    return model_args.cross_max_distance
+
+
+def graph_cost(complex_graph, model_args):
+    n_rec = complex_graph['receptor'].num_nodes
+    n_lig = complex_graph['ligand'].num_nodes
+    cutoff = cross_cutoff(model_args)
+    cross_edges = n_lig * min(n_rec, math.ceil(RESIDUE_DENSITY * 4 / 3 * math.pi * cutoff ** 3))
+    lig_edges = n_lig * min(n_lig - 1, LIG_NEIGHBORS) + complex_graph['ligand', 'ligand'].edge_index.shape[1]
+    cost = n_rec * (1 + REC_NEIGHBORS) + n_lig + lig_edges + cross_edges
+    if 'atom' in complex_graph.node_types:
+        cost += complex_graph['atom'].num_nodes * (1 + getattr(model_args, 'atom_max_neighbors', ATOM_NEIGHBORS))
+    return cost
+
+
+def is_out_of_memory(error):
+    return isinstance(error, MemoryError) or (isinstance(error, RuntimeError) and
+                                              ('out of memory' in str(error) or "can't allocate memory" in str(error)))
+
+
+def available_memory(device, memory_limit=None):
+    """Bytes that a batch can use: the free GPU memory, or the memory limit (or cgroup limit) of the job minus what the
+    process already uses, or the available system memory"""
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        # memory held by the caching allocator but not in use is also available to the next batch
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    candidates = []
+    if memory_limit is not None:
+        candidates.append(memory_limit - rss)
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_file) as f, open(usage_file) as g:
+                limit = f.read().strip()
+                if limit != 'max' and int(limit) < 2 ** 60:
+                    candidates.append(int(limit) - int(g.read()))
+            break
+        except (OSError, ValueError):
+            continue
+    with open('/proc/meminfo') as f:
+        meminfo = dict(line.split(':', 1) for line in f)
+    candidates.append(int(meminfo['MemAvailable'].split()[0]) * 1024)
+    return max(min(candidates), 0)
+
+
+def estimated_bytes_per_unit(model):
+    """Activation bytes per edge of the widest tensor product convolution: the per edge weights, inputs, hidden
+    features and messages in float32, twice for the intermediate copies"""
+    widths = [layer.tp.weight_numel + layer.tp.irreps_in1.dim + layer.tp.irreps_in2.dim + layer.tp.irreps_out.dim
+              + layer.fc[0].out_features
+              for layer in model.modules() if hasattr(layer, 'tp') and hasattr(layer, 'fc')]
+    return 4 * 2 * max(widths, default=1024)
+
+
+class GraphBudget:
+    """Maximum total graph_cost of a batch"""
+
+    def __init__(self, budget, model_args, max_graphs=None):
+        self.budget = int(budget)
+        self.model_args = model_args
+        self.max_graphs = max_graphs
+
+    @classmethod
+    def calibrate(cls, model, complex_graph, model_args, device, memory_limit=None, fraction=0.8, max_graphs=None):
+        """
+        Budget that fills `fraction` of the available memory. On the GPU the memory per cost unit is measured with a
+        forward pass of complex_graph, on the CPU it is estimated from the widths of the convolution layers.
+        """
+        from utils.diffusion_utils import set_time
+        bytes_per_unit = estimated_bytes_per_unit(model)
+        if device.type == 'cuda':
+            batch = Batch.from_data_list([complex_graph]).to(device)
+            set_time(batch, 1, 1, 1, 1, 1, 1, 1, model_args.all_atoms, device)
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+            with torch.no_grad():
+                model(batch)
+            torch.cuda.synchronize(device)
+            bytes_per_unit = max((torch.cuda.max_memory_allocated(device) - base) / graph_cost(complex_graph, model_args), 1)
+            del batch
+        budget = cls(fraction * available_memory(device, memory_limit) / bytes_per_unit, model_args, max_graphs)
+        print(f'Batch budget of {budget.budget} units ({bytes_per_unit:.0f} bytes per unit)')
+        return budget
+
+    def batches(self, data_list):
+        """Consecutive index lists of data_list, each with at least one graph and within the budget otherwise"""
+        batches, current, total = [], [], 0
+        for i, complex_graph in enumerate(data_list):
+            cost = graph_cost(complex_graph, self.model_args)
+            if current and (total + cost > self.budget or len(current) == self.max_graphs):
+                batches.append(current)
+                current, total = [], 0
+            current.append(i)
+            total += cost
+        if current:
+            batches.append(current)
+        return batches
+
+    def shrink(self, data_list, indices):
+        """Called when the graphs at indices ran out of memory together"""
+        self.budget = max(1, min(self.budget, sum(graph_cost(data_list[i], self.model_args) for i in indices) // 2))
+
+
+def batched_forward(data_list, forward, device, batch_size=32, budget=None):
+    """
+    Yields (batch, outputs) for consecutive batches of data_list, in order, where forward(batch) runs the model on a
+    batch already moved to device. Batches are batch_size graphs, or packed up to the budget if one is given. A batch
+    that runs out of memory is split in two and retried, only a single graph that does not fit raises the error.
+    """
+    pending = deque(budget.batches(data_list) if budget is not None else
+                    [list(range(i, min(i + batch_size, len(data_list)))) for i in range(0, len(data_list), batch_size)])
+    while pending:
+        indices = pending.popleft()
+        out_of_memory = False
+        try:
+            batch = Batch.from_data_list([data_list[i] for i in indices]).to(device)
+            outputs = forward(batch)
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e) or len(indices) == 1:
+                raise
+            out_of_memory = True
+        if out_of_memory:
+            # outside of the except block so that the tensors of the failed batch are released
+            batch = outputs = None
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+            if budget is not None:
+                budget.shrink(data_list, indices)
+            print(f'Out of memory on a batch of {len(indices)} graphs, splitting it')
+            half = len(indices) // 2
+            pending.extendleft([indices[half:], indices[:half]])
+            continue
+        yield batch, outputs
@@ -1,7 +1,8 @@
 from rdkit import Chem
-from Bio.PDB import PDBParser, MMCIFParser
 import numpy as np
 from scipy.spatial.distance import cdist
+
+from utils.structure_arrays import read_structure_arrays
 # based on TCS score in AlphaFill.
 def compute_clash_score(dis, base_vdw_dis, neighbor_mask=None, clash_thr=4):
     mask = dis < clash_thr
@@ -21,13 +22,13 @@ vdw_radii_table.update({"B":1.92, "C":1.70, "N":1.55, "O":1.52, "F":1.47, "S":1.
                    "Se":1.90, "Si":2.1, "Te":2.06,
                    "Fe":2.0, "V":2.0, "Pt":2.1, "As":2.0, "Ru":2.1, "Ir":2.1 })
 def compute_side_chain_metrics(pdbFile, ligandFile, vdw_radii_table=vdw_radii_table, verbose=True):
-    parser = MMCIFParser(QUIET=True) if pdbFile[-4:] == ".cif" else PDBParser(QUIET=True)
-    s = parser.get_structure(pdbFile, pdbFile)
-    mol = Chem.MolFromMolFile(ligandFile)
+    return side_chain_metrics(read_structure_arrays(pdbFile), Chem.MolFromMolFile(ligandFile), vdw_radii_table, verbose)
+
+def side_chain_metrics(atoms, mol, vdw_radii_table=vdw_radii_table, verbose=True):
+    # atoms are the structure arrays of the receptor (utils/structure_arrays.py), mol the ligand with one conformer
     # compute clash.
-    all_atoms = list(s.get_atoms())
-    all_heavy_atoms = [atom for atom in all_atoms if atom.element != 'H']
-    atom_coords = np.array([atom.coord for atom in all_heavy_atoms])
+    all_heavy_atoms = atoms[atoms['element'] != 'H']
+    atom_coords = all_heavy_atoms['coord']
 
     mol_atoms = list(mol.GetAtoms())
     mol_atoms = [a.GetSymbol() for a in mol_atoms]
@@ -35,7 +36,7 @@ def compute_side_chain_metrics(pdbFile, ligandFile, vdw_radii_table=vdw_radii_ta
     c = mol.GetConformer()
     mol_atom_coords = c.GetPositions()
 
-    p_atoms_vdw = np.array([vdw_radii_table[a.element] for a in all_heavy_atoms])
+    p_atoms_vdw = np.array([vdw_radii_table[element] for element in all_heavy_atoms['element'].tolist()])
     c_atoms_vdw = np.array([vdw_radii_table[a] for a in mol_atoms])
     dis = cdist(atom_coords, mol_atom_coords)
     base_vdw_dis = p_atoms_vdw.reshape(-1, 1) + c_atoms_vdw.reshape(1, -1)
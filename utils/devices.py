@@ -0,0 +1,120 @@
+"""
+    Several sampling workers in one job (inference.py --devices / --cpu_workers): the parent process preprocesses the
+    ligands once, then forks one worker per GPU plus the requested CPU workers. The workers inherit the dataset and
+    the receptors, and the parent hands every worker the next dataset index as soon as it is done with the previous
+    one, so a faster device simply docks more ligands.
+
+    CUDA that was initialised before a fork cannot be used in the child, so the parent never touches the GPU: the
+    GPUs are found without torch, and every worker selects its GPU through CUDA_VISIBLE_DEVICES before torch
+    initialises CUDA in it.
+"""
+import itertools
+import multiprocessing
+import os
+import subprocess
+from multiprocessing.connection import wait
+
+from utils.pool import TASK_OK, TASK_ERROR
+
+# a worker that runs on the CPU
+CPU = 'cpu'
+_END = object()
+
+
+def visible_gpus():
+    """Ids of the GPUs this process can use, from CUDA_VISIBLE_DEVICES (set by Slurm) or nvidia-smi"""
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        return [gpu.strip() for gpu in visible.split(',') if gpu.strip() and not gpu.strip().startswith('-')]
+    try:
+        output = subprocess.run(['nvidia-smi', '--query-gpu=index', '--format=csv,noheader'], capture_output=True,
+                                text=True, timeout=60).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def worker_devices(devices, cpu_workers=0):
+    """One entry per worker: the GPU ids of devices ('all' for every visible GPU), then CPU for every CPU worker"""
+    gpus = []
+    for device in devices or []:
+        for gpu in (visible_gpus() if device == 'all' else str(device).split(',')):
+            if gpu and gpu not in gpus:
+                gpus.append(gpu)
+    return gpus + [CPU] * cpu_workers
+
+
+def _worker(conn, device, init, work):
+    # a CPU worker sees no GPU at all
+    os.environ['CUDA_VISIBLE_DEVICES'] = '' if device == CPU else device
+    state = init(device)
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        try:
+            result = (item, TASK_OK, work(state, item))
+        except Exception as e:
+            result = (item, TASK_ERROR, f'{type(e).__name__}: {e}')
+        conn.send(result)
+    conn.close()
+
+
+def run_workers(devices, init, work, items):
+    """
+    Runs work(state, item) for every item in forked workers, one per entry of devices (see worker_devices), where
+    state = init(device) is set up once per worker. Every worker gets the next item as soon as it is done with the
+    previous one. Yields (item, status, result) tuples as the items finish, with the statuses of utils/pool.py. The
+    item a worker was busy with when it died, and the items that are left when no worker is alive anymore, are
+    yielded as errors.
+    """
+    context = multiprocessing.get_context('fork')
+    pending = iter(items)
+    processes, busy = [], {}  # conn -> (process, device, item)
+    completed = False
+
+    def dispatch(conn, process, device):
+        nonlocal pending
+        item = next(pending, _END)
+        try:
+            conn.send(None if item is _END else item)
+        except OSError:
+            # the worker died before it could take the item, another one gets it
+            if item is not _END:
+                pending = itertools.chain([item], pending)
+            return
+        if item is not _END:
+            busy[conn] = (process, device, item)
+
+    try:
+        for device in devices:
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, args=(child_conn, device, init, work), daemon=True)
+            process.start()
+            child_conn.close()
+            processes.append((parent_conn, process))
+            dispatch(parent_conn, process, device)
+
+        while busy:
+            for conn in wait(list(busy)):
+                process, device, item = busy.pop(conn)
+                try:
+                    result = conn.recv()
+                except (EOFError, OSError):
+                    # out of memory, a driver error, ... the worker is gone, the others go on
+                    process.join()
+                    print(f'The sampling worker on {device} exited with code {process.exitcode}')
+                    yield item, TASK_ERROR, f'worker exited with code {process.exitcode}'
+                    continue
+                yield result
+                dispatch(conn, process, device)
+        completed = True
+        for item in pending:
+            yield item, TASK_ERROR, 'no worker left to run it'
+    finally:
+        for conn, process in processes:
+            # the workers were all told to stop once the items ran out, otherwise they are still waiting for one
+            if not completed:
+                process.kill()
+            process.join()
+            conn.close()
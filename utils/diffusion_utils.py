@@ -3,7 +3,6 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
-from scipy.stats import beta
 
 from utils.geometry import axis_angle_to_matrix, rigid_transform_Kabsch_3D_torch
 from utils.torsion import modify_conformer_torsion_angles
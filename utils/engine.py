@@ -0,0 +1,344 @@
+"""
+    In-process docking. DynamicBindEngine loads the score model once and docks RDKit molecules, SMILES strings or
+    molecule files against a receptor, without the CSV, cache pickle and output file round trips of inference.py. It
+    uses the same featurisation (datasets/pdbbind.py), reverse diffusion (utils/sampling.py) and ranking as
+    inference.py, with the defaults of the inferenceVS.py jobs (flexible receptor, no noise in the final step).
+
+        engine = DynamicBindEngine(samples_per_complex=10)
+        receptor = engine.load_receptor('data/1qg8_cleaned.pdb')
+        for result in engine.dock_stream(receptor, ['COc(cc1)ccc1C#N', mol], names=['nitrile', 'mol']):
+            print(result.name, result.final_affinity, result.lddt[0])
+
+    The receptor is featurised once and reused for every ligand. The ligands of a call are docked in groups of
+    ligands_per_batch: the samples of all the ligands in a group share the batches of the reverse diffusion, and the
+    results of a group are yielded as soon as it is done. write_result() writes the poses in the layout of
+    inference.py when files are needed.
+"""
+import copy
+import glob
+import os
+from argparse import Namespace
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import torch
+import yaml
+from rdkit import Chem
+from rdkit.Chem import RemoveHs
+from scipy.stats import rankdata
+from torch_geometric.data import Batch, HeteroData
+
+from datasets.pdbbind import prepare_ligand, run_task
+from datasets.process_mols import extract_receptor_structure, get_lig_graph_with_matching, get_rec_graph, \
+    mol_with_coords, parse_pdb_from_path
+from utils.batching import GraphBudget
+from utils.clash import side_chain_metrics
+from utils.diffusion_utils import get_t_schedule, t_to_sigma as t_to_sigma_compl
+from utils.pool import TimeoutPool, TASK_OK, TASK_ERROR
+from utils.sampling import randomize_position, sampling
+from utils.structure_arrays import structure_to_arrays
+from utils.utils import get_model
+from utils.visualise import modify_pdb, save_protein
+
+MAX_AFFINITY = 15.
+
+
+class Receptor:
+    """A featurised receptor: the receptor part of the complex graph, centred on the receptor, and its structure"""
+
+    def __init__(self, name, graph, structure):
+        self.name = name
+        self.graph = graph
+        self.structure = structure
+        self.format = 'cif' if structure.get_full_id()[0] == 'cif' else 'pdb'
+
+    @property
+    def num_residues(self):
+        return self.graph['receptor'].num_nodes
+
+
+class DockingResult:
+    """
+    Poses of one ligand, ordered by rank as in inference.py (lddt, then clash score). positions are the ligand
+    coordinates in the frame of the input receptor. receptors are the receptor structures of the poses, only when the
+    receptor is flexible. error is set, and all the arrays are None, when the ligand could not be docked.
+    """
+
+    def __init__(self, name, mol=None, positions=None, lddt=None, affinity=None, clash=None, receptors=None, error=None):
+        self.name = name
+        self.mol = mol
+        self.positions = positions
+        self.lddt = lddt
+        self.affinity = affinity
+        self.clash = clash
+        self.receptors = receptors
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def final_affinity(self):
+        """Affinity of the ligand: the affinities of the poses weighted by their lddt, as in inference.py"""
+        if not self.ok:
+            return None
+        return float(np.minimum((self.affinity * self.lddt).sum() / (self.lddt.sum() + 1e-12), MAX_AFFINITY))
+
+    def poses(self, remove_hs=False):
+        """An RDKit molecule per pose, with the name, lddt and affinity as properties"""
+        poses = []
+        for rank in range(len(self.positions)):
+            pose = mol_with_coords(Chem.Mol(self.mol), self.positions[rank], remove_hs)
+            pose.SetProp('_Name', str(self.name))
+            pose.SetProp('lddt', f'{self.lddt[rank]:.2f}')
+            pose.SetProp('affinity', f'{self.affinity[rank]:.2f}')
+            poses.append(pose)
+        return poses
+
+    def __repr__(self):
+        if not self.ok:
+            return f'DockingResult({self.name!r}, error={self.error!r})'
+        return f'DockingResult({self.name!r}, poses={len(self.positions)}, affinity={self.final_affinity:.2f})'
+
+
+def default_name(ligand, index):
+    if isinstance(ligand, Chem.Mol) and ligand.HasProp('_Name') and ligand.GetProp('_Name'):
+        return ligand.GetProp('_Name')
+    if isinstance(ligand, str) and os.path.isfile(ligand):
+        return os.path.basename(ligand).split('.')[0]
+    return f'ligand_{index}'
+
+
+class DynamicBindEngine:
+    def __init__(self, model_dir='workdir/big_score_model_sanyueqi_with_time', ckpt='ema_inference_epoch314_model.pt',
+                 device=None, samples_per_complex=10, inference_steps=20, actual_steps=None, batch_size=32,
+                 batch_budget=None, ligands_per_batch=None, protein_dynamic=True, no_final_step_noise=True, ode=False,
+                 no_random=False, keep_local_structures=False, esm_embeddings_path='data/esm2_output',
+                 num_conformer_workers=1, conformer_timeout=None, seed=None, compile=False, precision='fp32',
+                 model=None, model_args=None):
+        """
+        model and model_args can be given instead of model_dir and ckpt, for a model that is already loaded.
+        batch_budget is a graph size budget (see utils/batching.py) or 'auto', ligands_per_batch defaults to as many
+        ligands as fit in batch_size samples.
+        """
+        self.device = torch.device(device) if device is not None else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.samples_per_complex = samples_per_complex
+        self.inference_steps = inference_steps
+        self.actual_steps = actual_steps if actual_steps is not None else inference_steps
+        self.batch_size = batch_size
+        self.ligands_per_batch = ligands_per_batch or max(1, batch_size // samples_per_complex)
+        self.protein_dynamic = protein_dynamic
+        self.no_final_step_noise = no_final_step_noise
+        self.ode = ode
+        self.no_random = no_random
+        self.keep_local_structures = keep_local_structures
+        self.esm_embeddings_path = esm_embeddings_path
+        self.num_conformer_workers = num_conformer_workers
+        self.conformer_timeout = conformer_timeout
+        self.seed = seed
+        if seed is not None:
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+
+        if model_args is None:
+            with open(os.path.join(model_dir, 'model_parameters.yml')) as f:
+                model_args = Namespace(**yaml.full_load(f))
+        self.model_args = model_args
+        self.t_to_sigma = partial(t_to_sigma_compl, args=model_args)
+        if model is None:
+            model = get_model(model_args, self.device, t_to_sigma=self.t_to_sigma, no_parallel=True)
+            state_dict = torch.load(os.path.join(model_dir, ckpt), map_location=torch.device('cpu'))
+            model.load_state_dict(state_dict, strict=True)
+        model = model.to(self.device)
+        model.eval()
+        if compile and not model_args.all_atoms:
+            from models.inference_model import InferenceScoreModel
+            model = InferenceScoreModel(model)
+        if precision != 'fp32':
+            from utils.precision import apply_precision
+            model = apply_precision(model, precision, self.device)
+        self.model = model
+        self.schedule = get_t_schedule(inference_steps=inference_steps)
+        self.batch_budget = batch_budget
+        self.graph_budget = GraphBudget(int(batch_budget), model_args) if batch_budget not in (None, 'auto') else None
+        self.receptors = {}
+
+    def load_receptor(self, receptor, name=None, lm_embeddings=None):
+        """
+        Featurises a receptor: a .pdb/.cif path or a Biopython structure or model. Paths are featurised once and then
+        served from memory. The ESM embeddings are read from esm_embeddings_path as in inference.py (by the file name,
+        or by name for a structure) unless lm_embeddings, a list of per chain embeddings, is given.
+        """
+        if isinstance(receptor, Receptor):
+            return receptor
+        key = None
+        if isinstance(receptor, str):
+            key = (os.path.abspath(receptor), name)
+            if key in self.receptors:
+                return self.receptors[key]
+            name = name or os.path.basename(receptor)
+            model = parse_pdb_from_path(receptor)
+        else:
+            if name is None:
+                raise ValueError('A receptor structure needs a name')
+            model = receptor[0] if receptor.level == 'S' else receptor
+        if lm_embeddings is None and self.model_args.esm_embeddings_path is not None:
+            embeddings_paths = sorted(glob.glob(os.path.join(self.esm_embeddings_path, name) + '*'))
+            if len(embeddings_paths) == 0:
+                raise ValueError(f'No ESM embeddings for {name} in {self.esm_embeddings_path}, generate them with proteinEmbedding.py')
+            lm_embeddings = [torch.load(path)['representations'][33] for path in embeddings_paths]
+
+        graph = HeteroData()
+        rec, rec_coords, c_alpha_coords, n_coords, c_coords, chis, chi_masks, lm_embeddings = \
+            extract_receptor_structure(copy.deepcopy(model), None, lm_embedding_chains=lm_embeddings)
+        if lm_embeddings is not None and len(c_alpha_coords) != len(lm_embeddings):
+            raise ValueError(f'The ESM embeddings of {name} have {len(lm_embeddings)} residues, the receptor has {len(c_alpha_coords)}')
+        args = self.model_args
+        get_rec_graph(name, rec, None, rec_coords, c_alpha_coords, n_coords, c_coords, chis, chi_masks, graph,
+                      rec_radius=args.receptor_radius, c_alpha_max_neighbors=args.c_alpha_max_neighbors,
+                      all_atoms=args.all_atoms, atom_radius=args.atom_radius, atom_max_neighbors=args.atom_max_neighbors,
+                      remove_hs=args.remove_hs, lm_embeddings=lm_embeddings)
+        protein_center = torch.mean(graph['receptor'].pos, dim=0, keepdim=True)
+        graph['receptor'].pos -= protein_center
+        graph['receptor'].lf_3pts -= protein_center[None, ...]
+        if args.all_atoms:
+            graph['atom'].pos -= protein_center
+        graph.original_center = protein_center
+        result = Receptor(name, graph, rec)
+        if key is not None:
+            self.receptors[key] = result
+        return result
+
+    def prepare_ligands(self, ligands):
+        """(molecule with a conformer, None) or (None, error) for every ligand, in order"""
+        tasks = [(ligand, self.keep_local_structures, 1, self.seed if self.seed is not None else -1) for ligand in ligands]
+        if self.num_conformer_workers > 1 or self.conformer_timeout:
+            results = TimeoutPool(min(self.num_conformer_workers, len(tasks)), timeout=self.conformer_timeout).imap_unordered(prepare_ligand, tasks)
+        else:
+            results = map(run_task, enumerate(tasks))
+        prepared = [None] * len(tasks)
+        for idx, status, result in results:
+            prepared[idx] = (result[0], None) if status == TASK_OK else (None, result if status == TASK_ERROR else
+                                                                             f'conformer generation timed out after {self.conformer_timeout} s')
+        return prepared
+
+    def complex_graph(self, receptor, mol, name):
+        """The complex graph of mol and the receptor, batched like the items of the DataLoader in inference.py"""
+        graph = copy.deepcopy(receptor.graph)
+        graph.name = name
+        get_lig_graph_with_matching(mol, graph, self.model_args.matching_popsize, self.model_args.matching_maxiter,
+                                    False, False, 1, remove_hs=self.model_args.remove_hs)
+        graph['ligand'].pos -= graph['ligand'].pos.mean(0, keepdim=True)
+        return Batch.from_data_list([graph])
+
+    def dock(self, receptor, ligands, names=None, out_dir=None):
+        """DockingResults of all ligands, in order"""
+        return list(self.dock_stream(receptor, ligands, names, out_dir))
+
+    def dock_stream(self, receptor, ligands, names=None, out_dir=None):
+        """
+        Yields a DockingResult per ligand, in order, as soon as the group of ligands_per_batch ligands it belongs to
+        is docked. ligands can be any iterable (also a generator) of RDKit molecules, SMILES or molecule files. With
+        out_dir the poses are also written there, see write_result.
+        """
+        receptor = self.load_receptor(receptor)
+        ligands, names = iter(ligands), iter(names) if names is not None else None
+        index = 0
+        while True:
+            group = list(islice(ligands, self.ligands_per_batch))
+            if not group:
+                return
+            group_names = [next(names) if names is not None else default_name(ligand, index + i) for i, ligand in enumerate(group)]
+            index += len(group)
+            for result in self.dock_group(receptor, group, group_names):
+                if out_dir is not None and result.ok:
+                    self.write_result(result, out_dir)
+                yield result
+
+    def dock_group(self, receptor, ligands, names):
+        results, samples = [None] * len(ligands), {}
+        for i, (name, (mol, error)) in enumerate(zip(names, self.prepare_ligands(ligands))):
+            if error is not None:
+                results[i] = DockingResult(name, error=error)
+                continue
+            try:
+                orig_complex_graph = self.complex_graph(receptor, mol, name)
+            except Exception as e:
+                results[i] = DockingResult(name, error=f'{type(e).__name__}: {e}')
+                continue
+            data_list = [copy.deepcopy(orig_complex_graph) for _ in range(self.samples_per_complex)]
+            randomize_position(data_list, self.model_args.no_torsion, self.no_random, self.model_args.tr_sigma_max,
+                               self.model_args.rot_sigma_max, self.model_args.tor_sigma_max,
+                               self.model_args.res_tr_sigma_max, self.model_args.res_rot_sigma_max)
+            samples[i] = (RemoveHs(mol) if self.model_args.remove_hs else mol, data_list)
+
+        # the reverse diffusion of the whole group fails when one ligand fails, then every ligand is retried on its own
+        groups = [list(samples)] if len(samples) > 1 else []
+        groups += [[i] for i in samples]
+        for group in groups:
+            if any(results[i] is not None for i in group):
+                continue
+            try:
+                final_data_list, lddt, affinity = self.sample([graph for i in group for graph in samples[i][1]])
+            except Exception as e:
+                if len(group) == 1:
+                    results[group[0]] = DockingResult(names[group[0]], error=f'{type(e).__name__}: {e}')
+                continue
+            for j, i in enumerate(group):
+                part = slice(j * self.samples_per_complex, (j + 1) * self.samples_per_complex)
+                results[i] = self.rank(receptor, names[i], samples[i][0], final_data_list[part], lddt[part], affinity[part])
+        return results
+
+    def sample(self, data_list):
+        if self.batch_budget == 'auto' and self.graph_budget is None:
+            self.graph_budget = GraphBudget.calibrate(self.model, data_list[0], self.model_args, self.device)
+        final_data_list, _, lddt, affinity = sampling(
+            data_list=data_list, model=self.model, inference_steps=self.actual_steps, tr_schedule=self.schedule,
+            rot_schedule=self.schedule, tor_schedule=self.schedule, res_tr_schedule=self.schedule,
+            res_rot_schedule=self.schedule, res_chi_schedule=self.schedule, device=self.device,
+            t_to_sigma=self.t_to_sigma, model_args=self.model_args, no_random=self.no_random, ode=self.ode,
+            batch_size=self.batch_size, no_final_step_noise=self.no_final_step_noise,
+            protein_dynamic=self.protein_dynamic, batch_budget=self.graph_budget)
+        return final_data_list, lddt.view(-1).cpu().numpy(), affinity.view(-1).cpu().numpy()
+
+    def rank(self, receptor, name, mol, final_data_list, lddt, affinity):
+        """Ranks the poses of a ligand by lddt and clash score, as inference.py"""
+        positions = np.asarray([complex_graph['ligand'].pos.cpu().numpy() + complex_graph.original_center.cpu().numpy()
+                                for complex_graph in final_data_list])
+        receptors, clash = [], []
+        rigid_atoms = structure_to_arrays(receptor.structure) if not self.protein_dynamic else None
+        for complex_graph, pose in zip(final_data_list, positions):
+            structure = receptor.structure
+            if self.protein_dynamic:
+                structure = modify_pdb(copy.deepcopy(receptor.structure), complex_graph)
+                receptors.append(structure)
+            atoms = rigid_atoms if rigid_atoms is not None else structure_to_arrays(structure)
+            clash.append(side_chain_metrics(atoms, mol_with_coords(Chem.Mol(mol), pose, True), verbose=False))
+        clash = np.asarray(clash)
+        order = np.argsort(rankdata(-lddt) + rankdata(clash) / 2.)
+        return DockingResult(name, mol, positions[order], lddt[order], affinity[order], clash[order],
+                             [receptors[i] for i in order] if self.protein_dynamic else None)
+
+    def write_result(self, result, out_dir, receptors=False, remove_hs=False):
+        """
+        Writes the poses as VS_DB_<name>_rank<rank>_ligand_lddt<lddt>_affinity<affinity>.sdf files like inference.py,
+        which summarize_results.py reads from the molecules directory. receptors also writes the receptor of every pose.
+        Returns the paths of the ligand files.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for rank, pose in enumerate(result.poses(remove_hs)):
+            scores = f'lddt{result.lddt[rank]:.2f}_affinity{result.affinity[rank]:.2f}'
+            path = os.path.join(out_dir, f'VS_DB_{result.name}_rank{rank + 1}_ligand_{scores}.sdf')
+            writer = Chem.SDWriter(path)
+            writer.write(pose)
+            writer.close()
+            paths.append(path)
+            if receptors and result.receptors is not None:
+                save_protein(result.receptors[rank], os.path.join(out_dir, f'VS_DB_{result.name}_rank{rank + 1}_receptor_{scores}.{self.receptor_format(result)}'))
+        return paths
+
+    def receptor_format(self, result):
+        return 'cif' if result.receptors[0].get_full_id()[0] == 'cif' else 'pdb'
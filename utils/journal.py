@@ -0,0 +1,37 @@
+"""
+    Run journal: an append-only JSON lines file per job that records what happened to individual ligands
+    (failures, timeouts, ...), so problems can be found without digging through the Slurm output files.
+"""
+import json
+import os
+import socket
+import time
+
+
+def journal_path(out_dir, job_name):
+    return os.path.join(out_dir, 'jobs_out', f'journal_{job_name}.jsonl')
+
+
+class RunJournal:
+    def __init__(self, path, job_name=None):
+        self.path = path
+        self.job_name = job_name if job_name is not None else os.path.splitext(os.path.basename(path))[0]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def record(self, name, stage, status, **info):
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'job': self.job_name, 'host': socket.gethostname(),
+                 'slurm_job_id': os.environ.get('SLURM_JOB_ID'), 'name': name, 'stage': stage, 'status': status}
+        entry.update(info)
+        # one write per line in append mode, so several processes can share a journal
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+
+
+def read_journal(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
@@ -0,0 +1,148 @@
+"""
+    Ligand index of a screening run (dedup_ligands.py): the canonical SMILES of every input ligand, which ligand is
+    docked for it (its representative) and where the results of that ligand come from. Ligands with the same
+    canonical SMILES are docked once, ligands that were already docked with the same settings in an earlier run are
+    copied from that run instead of being docked. summarize_results.py gives every ligand of the index the scores of
+    its representative.
+
+    The index is <out_dir>/ligand_index.csv with the columns of INDEX_COLUMNS, separated by ';' like the job csvs.
+    Reading it only needs the standard library, RDKit is only imported to canonicalise molecules.
+"""
+import csv
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+INDEX_FILE = 'ligand_index.csv'
+SETTINGS_FILE = 'run_settings.json'
+INDEX_COLUMNS = ['name', 'ligand', 'canonical_smiles', 'settings', 'representative', 'source']
+# the options of inferenceVS.py that change the docking results or their layout
+RESULT_SETTINGS = ['model', 'seed', 'samples_per_complex', 'rigid_protein', 'no_final_step_noise', 'remove_hs',
+                   'save_visualisation', 'precision']
+
+
+def index_path(out_dir):
+    return os.path.join(out_dir, INDEX_FILE)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_run_settings(out_dir, args):
+    with open(os.path.join(out_dir, SETTINGS_FILE), 'w') as f:
+        json.dump({key: getattr(args, key) for key in RESULT_SETTINGS}, f, indent=2, sort_keys=True)
+
+
+def settings_key(out_dir, protein_path):
+    """Short hash of the run settings and the content of the receptor file, equal for runs with equal results"""
+    with open(os.path.join(out_dir, SETTINGS_FILE)) as f:
+        settings = json.load(f)
+    settings['receptor_sha256'] = file_sha256(protein_path)
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def canonical_smiles(ligand):
+    """
+    Isomeric canonical SMILES without explicit hydrogens of a SMILES string, a molecule file or a library record
+    (datasets/library.py), None if RDKit cannot read it. Different protonation states and tautomers stay different
+    ligands.
+    """
+    from rdkit import Chem, RDLogger
+    from datasets.library import LibraryRecord
+    from datasets.process_mols import read_molecule
+    RDLogger.DisableLog('rdApp.*')
+    try:
+        if isinstance(ligand, LibraryRecord):
+            ligand = ligand.molecule()
+        if isinstance(ligand, Chem.Mol):
+            mol = Chem.RemoveHs(ligand)
+        elif os.path.isfile(ligand):
+            mol = read_molecule(ligand, remove_hs=True, sanitize=True)
+        else:
+            mol = Chem.MolFromSmiles(ligand)
+    except Exception:
+        return None
+    if mol is None:
+        return None
+    return Chem.MolToSmiles(mol, isomericSmiles=True)
+
+
+def read_index(out_dir):
+    """The rows of the ligand index of a run as dicts, an empty list if the run has no index"""
+    path = index_path(out_dir)
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f, delimiter=';'))
+
+
+def write_index(out_dir, rows):
+    with open(index_path(out_dir), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS, delimiter=';')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def ligands_to_dock(out_dir):
+    """(name, ligand) of the representatives that are docked in this run"""
+    return [(row['name'], row['ligand']) for row in read_index(out_dir) if row['representative'] == row['name'] and not row['source']]
+
+
+def duplicates(out_dir):
+    """name -> representative of the ligands that get the results of another ligand"""
+    return {row['name']: row['representative'] for row in read_index(out_dir) if row['representative'] != row['name']}
+
+
+def result_paths(run_dir, name):
+    """The output files of ligand name in run_dir: its complexes directory, or its files in molecules/"""
+    complex_dir = os.path.join(run_dir, 'complexes', name)
+    if os.path.isdir(complex_dir):
+        return [complex_dir]
+    return sorted(glob.glob(os.path.join(run_dir, 'molecules', f'VS_DB_{glob.escape(name)}_rank*')))
+
+
+def copy_results(run_dir, old_name, out_dir, new_name):
+    """Copies the outputs of old_name in run_dir to out_dir, renamed to new_name. Returns the number of copied files"""
+    copied = 0
+    for path in result_paths(run_dir, old_name):
+        if os.path.isdir(path):
+            target_dir = os.path.join(out_dir, 'complexes', new_name)
+            os.makedirs(target_dir, exist_ok=True)
+            for file_path in glob.glob(os.path.join(path, '*')):
+                file_name = os.path.basename(file_path)
+                if file_name.startswith(f'{old_name}_'):
+                    file_name = f'{new_name}_' + file_name[len(old_name) + 1:]
+                shutil.copy(file_path, os.path.join(target_dir, file_name))
+                copied += 1
+        else:
+            os.makedirs(os.path.join(out_dir, 'molecules'), exist_ok=True)
+            file_name = f'VS_DB_{new_name}_' + os.path.basename(path)[len(f'VS_DB_{old_name}_'):]
+            shutil.copy(path, os.path.join(out_dir, 'molecules', file_name))
+            copied += 1
+    return copied
+
+
+def previous_results(run_dirs, settings):
+    """canonical SMILES -> (run directory, name) of the ligands docked with the same settings key in run_dirs"""
+    from utils.scratch import unpack_archives
+    found = {}
+    for run_dir in run_dirs:
+        rows = [row for row in read_index(run_dir) if row['settings'] == settings and row['canonical_smiles']]
+        if not rows:
+            print(f'No ligands docked with the same receptor and settings in {run_dir}')
+            continue
+        unpack_archives(run_dir)
+        for row in rows:
+            if row['canonical_smiles'] in found:
+                continue
+            # a ligand that was copied or docked as a duplicate in that run has the results of its representative
+            if result_paths(run_dir, row['representative']):
+                found[row['canonical_smiles']] = (run_dir, row['representative'])
+    return found
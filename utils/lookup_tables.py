@@ -0,0 +1,70 @@
+"""
+    On-disk cache of the lookup tables of utils/so3.py and utils/torus.py.
+
+    Tables are looked up in $DYNAMICBIND_TABLES_DIR (for instance a shared copy made once with precompute_tables.py)
+    and then in the repository folder. When they are missing they are computed once: concurrent jobs wait on a file
+    lock while the first one computes them, and every file is written under a temporary name and then renamed, so no
+    job ever reads a partially written table.
+"""
+import fcntl
+import os
+import tempfile
+
+import numpy as np
+
+package_folder_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TABLES_DIR_ENV = 'DYNAMICBIND_TABLES_DIR'
+
+
+def table_dirs():
+    dirs = [os.environ[TABLES_DIR_ENV]] if os.environ.get(TABLES_DIR_ENV) else []
+    return dirs + [package_folder_path]
+
+
+def _complete(directory, files):
+    return all(os.path.exists(os.path.join(directory, file)) for file in files.values())
+
+
+def _load(directory, files):
+    return {name: np.load(os.path.join(directory, file)) for name, file in files.items()}
+
+
+def save_atomic(path, array):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        # mkstemp creates the file readable by the owner only, the tables may be shared between users
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_tables(files, compute, lock_name):
+    """
+    files maps table names to .npy file names. Returns the tables as a dict of arrays, loaded from the first directory
+    that has all of them, or computed with compute() (which returns that dict) and saved to the first writable one.
+    """
+    for directory in table_dirs():
+        if _complete(directory, files):
+            return _load(directory, files)
+
+    directory = next((d for d in table_dirs() if os.access(d, os.W_OK) or not os.path.exists(d)), package_folder_path)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, lock_name), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # another job may have written them while this one was waiting for the lock
+            if _complete(directory, files):
+                return _load(directory, files)
+            print(f'Computing the lookup tables {", ".join(files.values())} in {directory}, this only happens once')
+            tables = compute()
+            for name, file in files.items():
+                save_atomic(os.path.join(directory, file), tables[name])
+            return tables
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
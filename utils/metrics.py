@@ -0,0 +1,168 @@
+"""
+    Per ligand stage metrics: wall and CPU time, peak RSS and peak GPU memory of every stage (conformer generation,
+    featurisation, every diffusion step, output writing, clash scoring, ...). One JSON line per ligand is appended to
+    jobs_out/metrics_<job>.jsonl, summarize_metrics.py aggregates them over a run.
+"""
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+# stages that are still running. The CUDA peak counter is reset when a stage starts, so every stage carries the
+# peak seen before its nested stages reset the counter
+_running = []
+
+
+def metrics_path(out_dir, job_name):
+    return os.path.join(out_dir, 'jobs_out', f'metrics_{job_name}.jsonl')
+
+
+def _cuda():
+    # only look at the GPU if torch is already loaded and CUDA is in use, never initialise it just for the metrics
+    torch = sys.modules.get('torch')
+    # is_initialized first: is_available() can initialise the driver, which breaks CUDA in forked workers
+    if torch is not None and torch.cuda.is_initialized():
+        return torch.cuda
+    return None
+
+
+class Stopwatch:
+    """Measures the resources used between its creation and stop(), which returns them as a dict"""
+
+    def __init__(self):
+        self.cuda = _cuda()
+        self.gpu_peak = 0
+        if self.cuda is not None:
+            if _running:
+                _running[-1].gpu_peak = max(_running[-1].gpu_peak, self.cuda.max_memory_allocated())
+            self.cuda.reset_peak_memory_stats()
+            _running.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def stop(self):
+        usage = {'wall': time.perf_counter() - self.wall, 'cpu': time.process_time() - self.cpu,
+                 'rss_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'gpu_peak_mb': None}
+        if self.cuda is not None:
+            # kernels run asynchronously, wait for them so their time ends up in this stage
+            self.cuda.synchronize()
+            usage['wall'] = time.perf_counter() - self.wall
+            peak = max(self.gpu_peak, self.cuda.max_memory_allocated())
+            usage['gpu_peak_mb'] = peak / 2 ** 20
+            _running.remove(self)
+            if _running:
+                _running[-1].gpu_peak = max(_running[-1].gpu_peak, peak)
+        return usage
+
+
+class LigandMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.steps = []
+
+    def add(self, stage, usage, step=None):
+        total = self.stages.setdefault(stage, {'count': 0, 'wall': 0., 'cpu': 0., 'rss_peak_mb': 0., 'gpu_peak_mb': None})
+        total['count'] += 1
+        total['wall'] += usage['wall']
+        total['cpu'] += usage['cpu']
+        total['rss_peak_mb'] = max(total['rss_peak_mb'], usage['rss_peak_mb'])
+        if usage['gpu_peak_mb'] is not None:
+            total['gpu_peak_mb'] = max(total['gpu_peak_mb'] or 0., usage['gpu_peak_mb'])
+        if step is not None:
+            self.steps.append(dict(usage, step=step, stage=stage))
+
+    @contextmanager
+    def stage(self, stage, step=None):
+        stopwatch = Stopwatch()
+        try:
+            yield
+        finally:
+            self.add(stage, stopwatch.stop(), step)
+
+
+def stage(metrics, name, step=None):
+    """metrics.stage(name, step), or nothing when metrics is None"""
+    return metrics.stage(name, step) if metrics is not None else nullcontext()
+
+
+class MetricsRecorder:
+    """Collects the LigandMetrics of a job and writes a line per ligand once it is done"""
+
+    def __init__(self, path, job_name=None):
+        self.path = path
+        self.job_name = job_name if job_name is not None else os.path.splitext(os.path.basename(path))[0]
+        self.ligands = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def ligand(self, name):
+        if name not in self.ligands:
+            self.ligands[name] = LigandMetrics(name)
+        return self.ligands[name]
+
+    def write(self, name, status='ok', **info):
+        metrics = self.ligands.pop(name, None) or LigandMetrics(name)
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'job': self.job_name, 'host': socket.gethostname(),
+                 'slurm_job_id': os.environ.get('SLURM_JOB_ID'), 'name': name, 'status': status,
+                 'wall': sum(s['wall'] for s in metrics.stages.values()), 'stages': metrics.stages, 'steps': metrics.steps}
+        entry.update(info)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+
+    def discard(self, name):
+        # the line of the ligand was written by another process (a sampling worker, see utils/devices.py)
+        self.ligands.pop(name, None)
+
+    def write_remaining(self, status, **info):
+        # ligands that never made it to the end of the pipeline
+        for name in list(self.ligands):
+            self.write(name, status, **info)
+
+
+def read_metrics(paths):
+    entries = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    return entries
+
+
+def percentile(values, q):
+    # linear interpolation between the closest ranks, like numpy.percentile
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(entries, percentiles=(50, 90, 99)):
+    """Per stage distribution over ligands of the time spent in that stage, with the peak memory seen in it"""
+    per_stage = {}
+    for entry in entries:
+        for stage, usage in entry['stages'].items():
+            per_stage.setdefault(stage, []).append(usage)
+    total_wall = sum(usage['wall'] for usages in per_stage.values() for usage in usages)
+    summary = {}
+    for stage, usages in per_stage.items():
+        walls = [usage['wall'] for usage in usages]
+        gpu_peaks = [usage['gpu_peak_mb'] for usage in usages if usage['gpu_peak_mb'] is not None]
+        summary[stage] = {
+            'ligands': len(usages),
+            'total_wall': sum(walls),
+            'share': sum(walls) / total_wall if total_wall else 0.,
+            **{f'p{q}': percentile(walls, q) for q in percentiles},
+            'max': max(walls),
+            'cpu_per_wall': sum(usage['cpu'] for usage in usages) / sum(walls) if sum(walls) else None,
+            'rss_peak_mb': max(usage['rss_peak_mb'] for usage in usages),
+            'gpu_peak_mb': max(gpu_peaks) if gpu_peaks else None,
+        }
+    return summary
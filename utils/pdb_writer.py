@@ -0,0 +1,64 @@
+"""
+    Template based writer of the predicted receptors.
+
+    Every sample of a ligand is written as the same receptor with other coordinates. save_protein deep copies the
+    structure and formats every record field by field for every sample. A ReceptorTemplate renders the receptor once
+    with PDBIO and keeps every ATOM/HETATM record with its coordinates cut out, so a sample is a single format
+    operation over the coordinates. The records come from PDBIO itself, so the files are byte identical to the ones
+    of save_protein.
+
+    The template works on the receptor in place: set the coordinates of a sample (modify_pdb_from_arrays), save() it
+    and reset() the receptor to its coordinates at the time the template was made.
+"""
+import io
+
+from Bio.PDB import PDBIO, Select
+
+
+class _RemoveHs(Select):
+    # the selection of save_protein
+    def accept_atom(self, atom):
+        return atom.element != 'H'
+
+
+class ReceptorTemplate:
+    """PDB file of receptor (a Biopython structure or model) with open coordinates, see the module docstring"""
+
+    def __init__(self, receptor):
+        models = [receptor] if receptor.level == 'M' else list(receptor)
+        # the atoms in the order PDBIO writes them, without the hydrogens like save_protein
+        atoms = [atom for model in models for chain in model for residue in chain.get_unpacked_list()
+                 for atom in residue.get_unpacked_list()]
+        self.atoms = [atom for atom in atoms if atom.element != 'H']
+        self.coords = [(atom, atom.coord) for atom in atoms]
+
+        handle = io.StringIO()
+        pdbio = PDBIO()
+        pdbio.set_structure(receptor)
+        pdbio.save(handle, _RemoveHs())
+        parts, written = [], iter(self.atoms)
+        for line in handle.getvalue().splitlines(keepends=True):
+            if line.startswith(('ATOM  ', 'HETATM')):
+                coord = '%8.3f%8.3f%8.3f' % tuple(next(written).coord)
+                # the coordinates are followed by fixed width fields, the atom name or residue could contain the
+                # same text
+                start = line.rindex(coord)
+                parts.append(line[:start].replace('%', '%%') + '%8.3f%8.3f%8.3f' + line[start + len(coord):].replace('%', '%%'))
+            else:
+                parts.append(line.replace('%', '%%'))
+        if next(written, None) is not None:
+            raise ValueError('The receptor has atoms that PDBIO did not write')
+        self.template = ''.join(parts)
+
+    def render(self):
+        """The PDB file of the current coordinates of the receptor"""
+        return self.template % tuple([float(value) for atom in self.atoms for value in atom.coord])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.render())
+
+    def reset(self):
+        """Back to the coordinates the receptor had when the template was made"""
+        for atom, coord in self.coords:
+            atom.coord = coord
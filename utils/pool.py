@@ -0,0 +1,103 @@
+"""
+    Process pool with a wall-clock budget per task.
+
+    multiprocessing.Pool cannot stop a task that hangs inside C++ code (RDKit embedding, OpenMM, ...) and a signal
+    based time limit is only handled once control returns to Python. Every worker here has its own pipe, so a worker
+    that runs over its budget can be killed and replaced without touching the other tasks.
+"""
+import multiprocessing
+import time
+import traceback
+from multiprocessing.connection import wait
+
+TASK_OK, TASK_ERROR, TASK_TIMEOUT = 'ok', 'error', 'timeout'
+
+
+def _worker_loop(conn, fn):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        index, item = task
+        try:
+            result = (index, TASK_OK, fn(item))
+        except Exception as e:
+            traceback.print_exc()
+            result = (index, TASK_ERROR, f'{type(e).__name__}: {e}')
+        conn.send(result)
+    conn.close()
+
+
+class TimeoutPool:
+    """
+    Runs fn over items in up to `processes` forked worker processes. imap_unordered yields (index, status, result)
+    tuples as tasks finish, where status is TASK_OK (result is the return value), TASK_ERROR (result is the error
+    message) or TASK_TIMEOUT (the task ran longer than `timeout` seconds and its worker was killed).
+    """
+
+    def __init__(self, processes, timeout=None):
+        self.processes = max(1, processes)
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('fork')
+
+    def _start_worker(self, fn):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_loop, args=(child_conn, fn), daemon=True)
+        process.start()
+        child_conn.close()
+        return parent_conn, process
+
+    def imap_unordered(self, fn, items):
+        # items are only taken from the iterable when a worker is free, so it can be a generator that reads them lazily
+        pending = enumerate(items)
+        next_task = next(pending, None)
+        idle = []
+        busy = {}  # conn -> (process, index, deadline)
+        try:
+            while next_task is not None or busy:
+                while next_task is not None and (idle or len(busy) < self.processes):
+                    conn, process = idle.pop() if idle else self._start_worker(fn)
+                    index, item = next_task
+                    conn.send((index, item))
+                    deadline = time.monotonic() + self.timeout if self.timeout else None
+                    busy[conn] = (process, index, deadline)
+                    next_task = next(pending, None)
+
+                deadlines = [d for _, _, d in busy.values() if d is not None]
+                wait_time = max(0., min(deadlines) - time.monotonic()) if deadlines else None
+                for conn in wait(list(busy), timeout=wait_time):
+                    process, index, _ = busy.pop(conn)
+                    try:
+                        result = conn.recv()
+                    except EOFError:
+                        # the worker died (segfault, out of memory, ...), a new one is started for the next task
+                        process.join()
+                        conn.close()
+                        yield index, TASK_ERROR, f'worker exited with code {process.exitcode}'
+                    else:
+                        idle.append((conn, process))
+                        yield result
+
+                now = time.monotonic()
+                for conn, (process, index, deadline) in list(busy.items()):
+                    if deadline is not None and now >= deadline:
+                        del busy[conn]
+                        process.kill()
+                        process.join()
+                        conn.close()
+                        yield index, TASK_TIMEOUT, f'no result after {self.timeout} seconds'
+        finally:
+            for conn, process in idle:
+                try:
+                    conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+                conn.close()
+                process.join(timeout=5)
+            for conn, (process, _, _) in busy.items():
+                process.kill()
+                process.join()
+                conn.close()
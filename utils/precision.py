@@ -0,0 +1,75 @@
+"""
+    Reduced precision inference of the score model: autocast to bf16 or fp16, or dynamic int8 quantisation of the
+    nn.Linear layers (the edge MLPs of the convolutions, the embeddings and the output heads) on the CPU.
+
+    Outputs are always returned in fp32, the reverse diffusion in utils/sampling.py keeps working in fp32 and NumPy.
+    benchmarks/precision.py measures the speed and the deviation from fp32 of every mode.
+"""
+import torch
+
+PRECISIONS = ['fp32', 'bf16', 'fp16', 'int8-dynamic']
+AUTOCAST_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def cpu_supports_bf16():
+    """Native bf16 arithmetic (AVX512-BF16 or AMX), without it bf16 on the CPU is emulated and slower than fp32"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def resolve_precision(precision, device):
+    """The precision that is actually used on device, falling back to fp32 where the requested one does not help"""
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expected one of {", ".join(PRECISIONS)}')
+    fallback = None
+    if device.type == 'cuda':
+        if precision == 'int8-dynamic':
+            fallback = 'dynamic int8 quantisation only runs on the CPU'
+        elif precision == 'bf16' and not torch.cuda.is_bf16_supported():
+            fallback = 'this GPU has no bf16 support'
+    else:
+        if precision == 'fp16':
+            fallback = 'fp16 autocast is not faster on the CPU, use bf16 or int8-dynamic'
+        elif precision == 'bf16' and not cpu_supports_bf16():
+            fallback = 'this CPU has no native bf16 instructions (AVX512-BF16 or AMX)'
+    if fallback is not None:
+        print(f'Running in fp32 instead of {precision}: {fallback}')
+        return 'fp32'
+    return precision
+
+
+def _to_fp32(outputs):
+    if torch.is_tensor(outputs):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(_to_fp32(output) for output in outputs)
+    return outputs
+
+
+class AutocastModel(torch.nn.Module):
+    """Runs model under torch.autocast and returns its outputs in fp32"""
+
+    def __init__(self, model, dtype, device_type):
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+        self.device_type = device_type
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast(self.device_type, dtype=self.dtype):
+            outputs = self.model(*args, **kwargs)
+        return _to_fp32(outputs)
+
+
+def apply_precision(model, precision, device):
+    """The model to run in `precision` on device. int8-dynamic quantises the linear layers of model in place"""
+    precision = resolve_precision(precision, device)
+    if precision == 'fp32':
+        return model
+    if precision == 'int8-dynamic':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return AutocastModel(model, AUTOCAST_DTYPES[precision], device.type)
@@ -0,0 +1,80 @@
+"""
+    Pre-flight checks of the ligands of a screening run (preflight_ligands.py), run before any job is submitted: every
+    ligand is parsed and sanitised like inference.py does it, its heavy atoms are counted and its elements compared to
+    the allowed ones, and with the 'embed' level its conformer is generated as well. Ligands that fail are not
+    submitted, they are listed with the reason in <out_dir>/preflight_rejects.csv (columns of REJECT_COLUMNS,
+    separated by ';' like the job csvs).
+
+    Reading the report only needs the standard library, RDKit is only imported by the checks.
+"""
+import csv
+import os
+
+REJECTS_FILE = 'preflight_rejects.csv'
+REJECT_COLUMNS = ['name', 'ligand', 'status', 'heavy_atoms', 'reason']
+PREFLIGHT_LEVELS = ['none', 'parse', 'embed']
+# status of the ligands that were read but do not pass the filters, the others are the statuses of utils/pool.py
+REJECTED = 'rejected'
+
+
+def rejects_path(out_dir):
+    return os.path.join(out_dir, REJECTS_FILE)
+
+
+def parse_ligand(ligand):
+    """The sanitised RDKit molecule of a library record, a molecule file or a SMILES string, raises if it fails"""
+    from rdkit import Chem
+    from datasets.library import LibraryRecord
+    from datasets.process_mols import read_molecule
+    if isinstance(ligand, LibraryRecord):
+        ligand = ligand.molecule()
+    if isinstance(ligand, Chem.Mol):
+        return ligand
+    mol = read_molecule(ligand, sanitize=True) if os.path.isfile(ligand) else Chem.MolFromSmiles(ligand)
+    if mol is None:
+        raise ValueError(f'RDKit could not read or sanitise {ligand}')
+    return mol
+
+
+def check_ligand(par):
+    """
+    (heavy atoms, reason) of a ligand, the reason is empty when it passes the filters. Ligands that cannot be read,
+    sanitised or embedded raise, so a TimeoutPool reports them as errors
+    """
+    ligand, level, max_lig_size, allowed_elements, keep_local_structures, seed = par
+    from rdkit import RDLogger
+    RDLogger.DisableLog('rdApp.*')
+    if level == 'embed':
+        from datasets.pdbbind import prepare_ligand
+        mol, _ = prepare_ligand((ligand, keep_local_structures, 1, seed))
+    else:
+        mol = parse_ligand(ligand)
+    heavy_atoms = mol.GetNumHeavyAtoms()
+    reasons = []
+    if max_lig_size is not None and heavy_atoms > max_lig_size:
+        reasons.append(f'{heavy_atoms} heavy atoms, more than {max_lig_size}')
+    if allowed_elements:
+        elements = sorted({atom.GetSymbol() for atom in mol.GetAtoms()} - set(allowed_elements))
+        if elements:
+            reasons.append(f'elements {" ".join(elements)} are not allowed')
+    return heavy_atoms, '; '.join(reasons)
+
+
+def read_rejects(out_dir):
+    """The rows of the pre-flight report of a run as dicts, an empty list if the run has none"""
+    path = rejects_path(out_dir)
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f, delimiter=';'))
+
+
+def write_rejects(out_dir, rows):
+    with open(rejects_path(out_dir), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REJECT_COLUMNS, delimiter=';')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def rejected_names(out_dir):
+    return {row['name'] for row in read_rejects(out_dir)}
@@ -246,8 +246,10 @@ def openmm_relax(x):
         w.close()
     return ret
 
-def openmm_relax_protein_only(x):
+def openmm_relax_protein_only(x, init_positions=None):
     # print(a)
+    # init_positions (angstrom, including hydrogens) warm-starts the minimisation, e.g. from the relaxed previous
+    # frame of a trajectory. The restraints still pull towards the coordinates in pdbfile
     pdbfile, fixed_pdbFile, toFile, gap_mask, stiffness, use_gpu  = x
     stiffness = float(stiffness)
     # use_gpu = eval(use_gpu)
@@ -321,7 +323,10 @@ def openmm_relax_protein_only(x):
     # print(1 if use_gpu else 0)
     simulation = openmm_app.Simulation(
       modeller.topology, system, integrator, platform)
-    simulation.context.setPositions(modeller.positions)
+    if init_positions is not None and len(init_positions) == modeller.topology.getNumAtoms():
+        simulation.context.setPositions(unit.Quantity(init_positions, unit.angstroms))
+    else:
+        simulation.context.setPositions(modeller.positions)
 
     ENERGY = unit.kilocalories_per_mole
     LENGTH = unit.angstroms
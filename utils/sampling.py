@@ -1,15 +1,16 @@
 import numpy as np
 import copy
 import torch
-from torch_geometric.loader import DataLoader
 
+from utils.batching import batched_forward
 from utils.diffusion_utils import modify_conformer, set_time
 from utils.torsion import modify_conformer_torsion_angles
 from scipy.spatial.transform import Rotation as R
 
 from utils.affine import T
 from utils.geometry import axis_angle_to_matrix
-from utils.visualise import modify_pdb
+from utils.trajectory import trajectory_frame
+from utils.metrics import stage
 
 def randomize_position(data_list, no_torsion, no_random, tr_sigma_max, rot_sigma_max, tor_sigma_max, res_tr_sigma_max, res_rot_sigma_max):
     # in place modification of the list
@@ -97,7 +98,7 @@ def pred_lddt_and_affinity(complex_graph_batch, model, batch_size, device, model
     return all_lddt_pred, all_affinity_pred
 
 def sampling(data_list, model, inference_steps, tr_schedule, rot_schedule, tor_schedule, res_tr_schedule, res_rot_schedule, res_chi_schedule, device, t_to_sigma, model_args,
-             no_random=False, ode=True, visualization_list=None, confidence_model=None, batch_size=32, no_final_step_noise=False, return_per_step=False, protein_dynamic=True):
+             no_random=False, ode=True, visualization_list=None, confidence_model=None, batch_size=32, no_final_step_noise=False, return_per_step=False, protein_dynamic=True, metrics=None, batch_budget=None):
     N = len(data_list)
     data_list_step = []
     for t_idx in range(inference_steps):
@@ -108,18 +109,18 @@ def sampling(data_list, model, inference_steps, tr_schedule, rot_schedule, tor_s
         dt_res_tr = res_tr_schedule[t_idx] - res_tr_schedule[t_idx + 1] if t_idx < inference_steps - 1 else res_tr_schedule[t_idx]
         dt_res_rot = res_rot_schedule[t_idx] - res_rot_schedule[t_idx + 1] if t_idx < inference_steps - 1 else res_rot_schedule[t_idx]
 
-        loader = DataLoader(data_list, batch_size=batch_size)
         new_data_list = []
+        tr_sigma, rot_sigma, tor_sigma, res_tr_sigma, res_rot_sigma, res_chi_sigma = t_to_sigma(t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi)
 
-        for complex_graph_batch in loader:
+        def forward(complex_graph_batch):
+            set_time(complex_graph_batch, t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi, complex_graph_batch.num_graphs, model_args.all_atoms, device)
+            with stage(metrics, 'model_forward', t_idx), torch.no_grad():
+                return model(complex_graph_batch)
+
+        for complex_graph_batch, outputs in batched_forward(data_list, forward, device, batch_size, batch_budget):
             b = complex_graph_batch.num_graphs
             n = complex_graph_batch['receptor'].pos.shape[0]
-            complex_graph_batch = complex_graph_batch.to(device)
-            tr_sigma, rot_sigma, tor_sigma, res_tr_sigma, res_rot_sigma, res_chi_sigma = t_to_sigma(t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi)
-            set_time(complex_graph_batch, t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi, b, model_args.all_atoms, device)
-
-            with torch.no_grad():
-                lddt_pred, affinity_pred, tr_score, rot_score, tor_score, res_tr_score, res_rot_score, res_chi_score = model(complex_graph_batch)
+            lddt_pred, affinity_pred, tr_score, rot_score, tor_score, res_tr_score, res_rot_score, res_chi_score = outputs
             tr_g = tr_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.tr_sigma_max / model_args.tr_sigma_min)))
             tr_f = (tr_g/tr_sigma) ** 2 * dt_tr
             rot_g = 2 * rot_sigma * torch.sqrt(torch.tensor(np.log(model_args.rot_sigma_max / model_args.rot_sigma_min)))
@@ -193,18 +194,21 @@ def sampling(data_list, model, inference_steps, tr_schedule, rot_schedule, tor_s
             res_per_molecule = res_tr_perturb.shape[0] // b
             # Apply denoise
             # print(tr_perturb.shape,rot_perturb.shape,res_tr_perturb.shape,res_rot_perturb.shape)
-            tor_i = 0
-            res_i = 0
-            for i, complex_graph in enumerate(complex_graph_batch.to('cpu').to_data_list()):
-                new_data_list.extend([modify_conformer(complex_graph, tr_perturb[i:i + 1], rot_perturb[i:i + 1].squeeze(0),
-                                              tor_perturb[tor_i:tor_i+complex_graph['ligand'].edge_mask.sum()] if not model_args.no_torsion else None,
-                                              res_tr_perturb[res_i:res_i+complex_graph['receptor'].pos.shape[0]], res_rot_perturb[res_i:res_i+complex_graph['receptor'].pos.shape[0]],
-                                              res_chi_perturb[res_i:res_i+complex_graph['receptor'].pos.shape[0]])])
-                tor_i += complex_graph['ligand'].edge_mask.sum()
-                res_i += complex_graph['receptor'].pos.shape[0]
+            with stage(metrics, 'denoise_update', t_idx):
+                tor_i = 0
+                res_i = 0
+                for i, complex_graph in enumerate(complex_graph_batch.to('cpu').to_data_list()):
+                    new_data_list.extend([modify_conformer(complex_graph, tr_perturb[i:i + 1], rot_perturb[i:i + 1].squeeze(0),
+                                                  tor_perturb[tor_i:tor_i+complex_graph['ligand'].edge_mask.sum()] if not model_args.no_torsion else None,
+                                                  res_tr_perturb[res_i:res_i+complex_graph['receptor'].pos.shape[0]], res_rot_perturb[res_i:res_i+complex_graph['receptor'].pos.shape[0]],
+                                                  res_chi_perturb[res_i:res_i+complex_graph['receptor'].pos.shape[0]])])
+                    tor_i += complex_graph['ligand'].edge_mask.sum()
+                    res_i += complex_graph['receptor'].pos.shape[0]
 
         data_list = new_data_list
-        data_list_step.append(new_data_list)
+        if return_per_step:
+            # only keep the arrays that change between steps, not a copy of every graph
+            data_list_step.append([trajectory_frame(complex_graph) for complex_graph in new_data_list])
         # if visualization_list is not None:
         #     for idx, visualization in enumerate(visualization_list):
         #         visualization[0].add((data_list[idx]['ligand'].pos + data_list[idx].original_center).detach().cpu(),
@@ -216,14 +220,15 @@ def sampling(data_list, model, inference_steps, tr_schedule, rot_schedule, tor_s
         #         visualization[2].add(new_receptor_pdb)
     all_lddt_pred = []
     all_affinity_pred = []
-    loader = DataLoader(data_list, batch_size=batch_size)
-    for complex_graph_batch in loader:
-        b = complex_graph_batch.num_graphs
+
+    def confidence_forward(complex_graph_batch):
         t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi = [0.6] * 6
-        complex_graph_batch = complex_graph_batch.to(device)
-        set_time(complex_graph_batch, t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi, b, model_args.all_atoms, device)
-        with torch.no_grad():
-            lddt_pred, affinity_pred, tr_score, rot_score, tor_score, res_tr_score, res_rot_score, res_chi_score = model(complex_graph_batch)
+        set_time(complex_graph_batch, t_tr, t_rot, t_tor, t_res_tr, t_res_rot, t_res_chi, complex_graph_batch.num_graphs, model_args.all_atoms, device)
+        with stage(metrics, 'confidence'), torch.no_grad():
+            return model(complex_graph_batch)
+
+    for complex_graph_batch, outputs in batched_forward(data_list, confidence_forward, device, batch_size, batch_budget):
+        lddt_pred, affinity_pred, tr_score, rot_score, tor_score, res_tr_score, res_rot_score, res_chi_score = outputs
         all_lddt_pred.append(lddt_pred)
         all_affinity_pred.append(affinity_pred)
     all_lddt_pred = torch.cat(all_lddt_pred,dim=0)
@@ -0,0 +1,147 @@
+"""
+    Node-local staging of an inference job (--scratch): the input files of the job are copied to the local disk of
+    the node, the dataset cache is kept there and the output structures are written there. Finished outputs are
+    shipped back to the shared output directory as tar archives in out_dir/archives, every sync_interval seconds and
+    when the job ends or is cancelled, so hundreds of jobs do not each create thousands of small files on the parallel
+    filesystem. The journal and metrics files are single append-only files and stay on the shared filesystem.
+
+    An archive is written under a temporary name and only renamed once it is complete, so a job that is killed during
+    a sync never leaves a truncated archive behind. summarize_results.py, relaunchFailedCompounds.py and relax_final.py
+    unpack the archives into the output directory, python -m utils.scratch <out_dir> does the same by hand.
+"""
+import fcntl
+import glob
+import os
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import time
+
+ARCHIVE_DIR = 'archives'
+SYNC_INTERVAL = 900
+
+
+def default_scratch():
+    return os.environ.get('SLURM_TMPDIR') or os.environ.get('TMPDIR') or tempfile.gettempdir()
+
+
+class ScratchStage:
+    def __init__(self, root, out_dir, job_name, sync_interval=SYNC_INTERVAL):
+        os.makedirs(root, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix=f'dynamicbind_{job_name}_', dir=root)
+        self.out_dir = out_dir
+        self.job_name = job_name
+        self.sync_interval = sync_interval
+        self.local_out = os.path.join(self.dir, 'out')
+        self.cache_path = os.path.join(self.dir, 'cache')
+        os.makedirs(self.local_out)
+        self.staged = {}
+        # relative output path -> modification time, of the complete outputs and of the ones already in an archive
+        self.committed, self.synced = {}, {}
+        self.parts = 0
+        self.last_sync = time.monotonic()
+        print(f'Staging job {job_name} in {self.dir}')
+
+    def stage(self, path):
+        """Local copy of the input file at path, copied once. Anything that is not a file (a SMILES) is returned as is"""
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return path
+        if path not in self.staged:
+            # one directory per input keeps the file name, by which the ESM embeddings of a receptor are found
+            local_dir = os.path.join(self.dir, 'inputs', str(len(self.staged)))
+            os.makedirs(local_dir)
+            self.staged[path] = shutil.copy(path, local_dir)
+        return self.staged[path]
+
+    def stage_embeddings(self, esm_dir, protein_paths):
+        """Local directory with the ESM embeddings of protein_paths, looked up as in datasets/pdbbind.py"""
+        local_dir = os.path.join(self.dir, 'esm')
+        os.makedirs(local_dir, exist_ok=True)
+        for protein_path in set(protein_paths):
+            for embeddings_path in glob.glob(os.path.join(esm_dir, os.path.basename(protein_path)) + '*'):
+                shutil.copy(embeddings_path, local_dir)
+        return local_dir
+
+    def outputs(self):
+        files = {}
+        for root, _, names in os.walk(self.local_out):
+            for name in names:
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, self.local_out)] = os.path.getmtime(path)
+        return files
+
+    def commit(self, paths=None):
+        """
+        Marks everything written so far as complete, called after every finished complex. Syncs when it is due. With
+        several sampling workers only the outputs of the finished complex (files or directories in `paths`) are
+        complete, the other workers may be writing theirs
+        """
+        outputs = self.outputs()
+        if paths is not None:
+            prefixes = [os.path.relpath(path, self.local_out) for path in paths]
+            outputs = {path: mtime for path, mtime in outputs.items()
+                       if any(path == prefix or path.startswith(prefix + os.sep) for prefix in prefixes)}
+        self.committed.update(outputs)
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Ships the complete outputs that are new or changed since the last sync to out_dir/archives"""
+        self.last_sync = time.monotonic()
+        pending = sorted(path for path, mtime in self.committed.items() if self.synced.get(path) != mtime
+                         and os.path.exists(os.path.join(self.local_out, path)))
+        if not pending:
+            return None
+        archive_dir = os.path.join(self.out_dir, ARCHIVE_DIR)
+        os.makedirs(archive_dir, exist_ok=True)
+        # host and pid keep the archives of relaunched jobs with the same job name apart
+        name = f'{self.job_name}.{socket.gethostname()}.{os.getpid()}.{self.parts:04d}.tar'
+        partial = os.path.join(archive_dir, name + '.partial')
+        with open(partial, 'wb') as f:
+            with tarfile.open(fileobj=f, mode='w') as tar:
+                for path in pending:
+                    tar.add(os.path.join(self.local_out, path), arcname=path)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, os.path.join(archive_dir, name))
+        self.synced.update((path, self.committed[path]) for path in pending)
+        self.parts += 1
+        print(f'Synced {len(pending)} output files to {os.path.join(archive_dir, name)}')
+        return name
+
+    def close(self):
+        """Final sync of everything in the local output directory, then removes the staging directory"""
+        self.committed.update(self.outputs())
+        self.sync()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def unpack_archives(out_dir):
+    """
+    Extracts the archives of scratch jobs into out_dir and removes them. An archive is only removed once it is fully
+    extracted, and a lock file serialises the processes that unpack the same directory. Returns the number of archives
+    """
+    archive_dir = os.path.join(out_dir, ARCHIVE_DIR)
+    if not os.path.isdir(archive_dir):
+        return 0
+    # the data filter (where tarfile has it) rejects members that would end up outside of out_dir
+    extract_args = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    unpacked = 0
+    with open(os.path.join(archive_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for path in sorted(glob.glob(os.path.join(archive_dir, '*.tar'))):
+            with tarfile.open(path) as tar:
+                tar.extractall(out_dir, **extract_args)
+            os.remove(path)
+            unpacked += 1
+    if unpacked:
+        print(f'Unpacked {unpacked} result archives into {out_dir}')
+    return unpacked
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python -m utils.scratch <out_dir>')
+    unpack_archives(sys.argv[1])
@@ -0,0 +1,295 @@
+"""
+    Docking service of server.py: a DynamicBindEngine (utils/engine.py) that stays loaded, behind an HTTP server on
+    localhost or on a Unix socket. Concurrent requests are queued per ligand, and a single worker thread docks the
+    queued ligands of the same receptor together, so the samples of several requests share the batches of the reverse
+    diffusion. The results of a request are streamed back as JSON lines as soon as they are ready.
+
+        POST /dock     {"receptor": "/abs/path/receptor.pdb", "ligands": ["SMILES", "/abs/path/ligand.sdf", "<molblock>"],
+                        "names": [...], "out_dir": "/abs/path", "poses": true}
+        GET  /health
+
+    /dock answers with one line per ligand, in the order they finish: index, name, error, final_affinity and the
+    per pose lddt, affinity and clash scores (best first), with poses the poses as molblocks and with out_dir the
+    files written there (ligands and receptors, named like the outputs of inference.py). The last line is
+    {"done": true, ...}. Paths are read and written by the server process.
+
+    DockingClient only uses the standard library, so clients start quickly and need none of the model dependencies.
+"""
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+DEFAULT_PORT = 8765
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+class DockingRequest:
+    def __init__(self, receptor, ligands, names, out_dir=None):
+        self.receptor = receptor
+        self.ligands = ligands
+        self.names = names
+        self.out_dir = out_dir
+        self.results = Queue()
+        self.cancelled = False
+
+
+class DockingService:
+    """
+    Queue of the ligands of all requests and the worker thread that docks them. The worker waits up to batch_wait
+    seconds after the first queued ligand for more ligands to arrive, then docks up to engine.ligands_per_batch queued
+    ligands of the same receptor at once.
+    """
+
+    def __init__(self, engine, batch_wait=0.1):
+        self.engine = engine
+        self.batch_wait = batch_wait
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self.run, name='docking-worker', daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        with self.condition:
+            self.pending.extend((request, i) for i in range(len(request.ligands)))
+            self.condition.notify()
+        return request
+
+    def queued(self):
+        with self.condition:
+            return len(self.pending)
+
+    def next_group(self):
+        """Up to ligands_per_batch queued (request, index) pairs with the receptor of the oldest one"""
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            deadline = time.monotonic() + self.batch_wait
+            while len(self.pending) < self.engine.ligands_per_batch and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            receptor = self.pending[0][0].receptor
+            group, rest = [], deque()
+            while self.pending:
+                request, i = self.pending.popleft()
+                if request.cancelled:
+                    continue
+                if request.receptor == receptor and len(group) < self.engine.ligands_per_batch:
+                    group.append((request, i))
+                else:
+                    rest.append((request, i))
+            self.pending = rest
+        return receptor, group
+
+    def run(self):
+        from utils.engine import DockingResult
+        while True:
+            receptor_path, group = self.next_group()
+            if not group:
+                continue
+            start = time.time()
+            try:
+                receptor = self.engine.load_receptor(receptor_path)
+                results = self.engine.dock_group(receptor, [request.ligands[i] for request, i in group],
+                                                 [request.names[i] for request, i in group])
+            except Exception as e:
+                results = [DockingResult(request.names[i], error=f'{type(e).__name__}: {e}') for request, i in group]
+            print(f'Docked {len(group)} ligands of {len({id(request) for request, _ in group})} requests against '
+                  f'{os.path.basename(receptor_path)} in {time.time() - start:.1f} s, {self.queued()} ligands queued', flush=True)
+            for (request, i), result in zip(group, results):
+                files = []
+                if request.out_dir is not None and result.ok:
+                    try:
+                        files = self.engine.write_result(result, request.out_dir, receptors=True)
+                    except OSError as e:
+                        result.error = f'writing the outputs failed, {type(e).__name__}: {e}'
+                request.results.put((i, result, files))
+
+
+def result_to_json(index, result, files, poses=True):
+    from rdkit import Chem
+    entry = {'index': index, 'name': result.name, 'error': result.error}
+    if result.ok:
+        entry.update({'final_affinity': result.final_affinity, 'lddt': result.lddt.tolist(),
+                      'affinity': result.affinity.tolist(), 'clash': result.clash.tolist()})
+        if poses:
+            entry['poses'] = [Chem.MolToMolBlock(pose) for pose in result.poses()]
+        if files:
+            entry['files'] = files
+    return entry
+
+
+def parse_ligand(ligand):
+    """A molblock becomes an RDKit molecule, SMILES and file paths are passed on to prepare_ligand"""
+    from rdkit import Chem
+    if '\n' not in ligand:
+        return ligand
+    mol = Chem.MolFromMolBlock(ligand, removeHs=False)
+    if mol is None:
+        raise ValueError('RDKit could not read the molblock')
+    return mol
+
+
+class DockingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # the client address of a Unix socket is an empty string
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, body):
+        data = json.dumps(body).encode() + b'\n'
+        self.wfile.write(f'{len(data):X}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+        engine = self.server.service.engine
+        self.send_json(200, {'status': 'ok', 'device': str(engine.device), 'samples_per_complex': engine.samples_per_complex,
+                             'ligands_per_batch': engine.ligands_per_batch, 'queued': self.server.service.queued(),
+                             'receptors': sorted(path for path, _ in engine.receptors)})
+
+    def do_POST(self):
+        if self.path != '/dock':
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_REQUEST_BYTES:
+                raise ValueError(f'the request is larger than {MAX_REQUEST_BYTES} bytes')
+            body = json.loads(self.rfile.read(length))
+            receptor, ligands = body['receptor'], body['ligands']
+            if isinstance(ligands, str):
+                ligands = [ligands]
+            names = body.get('names') or [f'ligand_{i}' for i in range(len(ligands))]
+            if len(names) != len(ligands):
+                raise ValueError(f'{len(names)} names for {len(ligands)} ligands')
+            if not os.path.isfile(receptor):
+                raise ValueError(f'no receptor file {receptor}')
+            out_dir = body.get('out_dir')
+            ligands = [parse_ligand(ligand) for ligand in ligands]
+        except (KeyError, TypeError, ValueError) as e:
+            return self.send_json(400, {'error': f'{type(e).__name__}: {e}'})
+
+        start = time.time()
+        request = self.server.service.submit(DockingRequest(os.path.abspath(receptor), ligands, [str(name) for name in names],
+                                                            os.path.abspath(out_dir) if out_dir else None))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            failed = 0
+            for _ in range(len(ligands)):
+                index, result, files = request.results.get()
+                failed += not result.ok
+                self.send_chunk(result_to_json(index, result, files, body.get('poses', True)))
+            self.send_chunk({'done': True, 'ligands': len(ligands), 'failed': failed, 'seconds': time.time() - start})
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client is gone, its queued ligands are dropped
+            request.cancelled = True
+            self.close_connection = True
+
+
+class DockingHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, DockingHandler)
+        self.service = service
+
+
+class UnixDockingHTTPServer(DockingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(service, port=DEFAULT_PORT, socket_path=None):
+    """An HTTP server on 127.0.0.1:port, or on the Unix socket socket_path"""
+    if socket_path is None:
+        return DockingHTTPServer(('127.0.0.1', port), service)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = UnixDockingHTTPServer(socket_path, service)
+    os.chmod(socket_path, 0o600)
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockingClient:
+    """Client of server.py. address is host:port, a port, or the path of a Unix socket"""
+
+    def __init__(self, address=f'localhost:{DEFAULT_PORT}', timeout=None):
+        self.address = str(address)
+        self.timeout = timeout
+
+    def connection(self):
+        if '/' in self.address or self.address.endswith('.sock'):
+            return UnixHTTPConnection(self.address, timeout=self.timeout)
+        host, _, port = self.address.rpartition(':')
+        return http.client.HTTPConnection(host or 'localhost', int(port), timeout=self.timeout)
+
+    def request(self, method, path, body=None):
+        conn = self.connection()
+        conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                     headers={'Content-Type': 'application/json'} if body is not None else {})
+        response = conn.getresponse()
+        if response.status != 200:
+            error = json.loads(response.read() or b'{}').get('error')
+            conn.close()
+            raise RuntimeError(f'{method} {path} failed with status {response.status}: {error}')
+        return conn, response
+
+    def health(self):
+        conn, response = self.request('GET', '/health')
+        try:
+            return json.loads(response.read())
+        finally:
+            conn.close()
+
+    def dock(self, receptor, ligands, names=None, out_dir=None, poses=True):
+        """
+        Yields the result of every ligand as a dict as soon as the server has it, see the module docstring. Existing
+        file paths are made absolute, because they are read and written by the server.
+        """
+        ligands = [os.path.abspath(ligand) if os.path.isfile(ligand) else ligand for ligand in ligands]
+        body = {'receptor': os.path.abspath(receptor), 'ligands': ligands, 'names': names, 'poses': poses,
+                'out_dir': os.path.abspath(out_dir) if out_dir else None}
+        conn, response = self.request('POST', '/dock', body)
+        try:
+            for line in response:
+                entry = json.loads(line)
+                if entry.get('done'):
+                    return
+                yield entry
+            raise RuntimeError('The server closed the connection before all results were sent')
+        finally:
+            conn.close()
@@ -1,18 +1,16 @@
-import os
 import numpy as np
 import torch
 from scipy.spatial.transform import Rotation
 
-file_path = os.path.realpath(__file__)
-script_folder = os.path.dirname(file_path)
-package_folder_path = os.path.dirname(script_folder)
+from utils import lookup_tables
 
 MIN_EPS, MAX_EPS, N_EPS = 0.01, 2, 1000
 X_N = 2000
 
 """
     Preprocessing for the SO(3) sampling and score computations, truncated infinite series are computed and then
-    cached to memory, therefore the precomputation is only run the first time the repository is run on a machine
+    cached to disk (see utils/lookup_tables.py), therefore the precomputation is only run the first time the tables are
+    needed on a machine. The series are evaluated for all l, omega and eps at once as matrix products
 """
 
 omegas = np.linspace(0, np.pi, X_N + 1)[1:]
@@ -22,11 +20,11 @@ def _compose(r1, r2):  # R1 @ R2 but for Euler vecs
     return Rotation.from_matrix(Rotation.from_rotvec(r1).as_matrix() @ Rotation.from_rotvec(r2).as_matrix()).as_rotvec()
 
 
-def _expansion(omega, eps, L=2000):  # the summation term only
-    p = 0
-    for l in range(L):
-        p += (2 * l + 1) * np.exp(-l * (l + 1) * eps**2) * np.sin(omega * (l + 1 / 2)) / np.sin(omega / 2)
-    return p
+def _expansion(omega, eps, L=2000):  # the summation term only, for every eps (rows) and omega (columns)
+    l = np.arange(L)
+    weights = (2 * l + 1) * np.exp(-l * (l + 1) * np.reshape(eps, (-1, 1)) ** 2)
+    p = weights @ np.sin(np.outer(l + 1 / 2, omega)) / np.sin(omega / 2)
+    return p.reshape(np.shape(eps) + np.shape(omega))
 
 
 def _density(expansion, omega, marginal=True):  # if marginal, density over [0, pi], else over SO(3)
@@ -36,45 +34,57 @@ def _density(expansion, omega, marginal=True):  # if marginal, density over [0,
         return expansion / 8 / np.pi ** 2  # the constant factor doesn't affect any actual calculations though
 
 
-def _score(exp, omega, eps, L=2000):  # score of density over SO(3)
-    dSigma = 0
-    for l in range(L):
-        hi = np.sin(omega * (l + 1 / 2))
-        dhi = (l + 1 / 2) * np.cos(omega * (l + 1 / 2))
-        lo = np.sin(omega / 2)
-        dlo = 1 / 2 * np.cos(omega / 2)
-        dSigma += (2 * l + 1) * np.exp(-l * (l + 1) * eps**2) * (lo * dhi - hi * dlo) / lo ** 2
-    return dSigma / exp
+def _score(exp, omega, eps, L=2000):  # score of density over SO(3), for every eps (rows) and omega (columns)
+    l = np.arange(L)
+    weights = (2 * l + 1) * np.exp(-l * (l + 1) * np.reshape(eps, (-1, 1)) ** 2)
+    hi = weights @ np.sin(np.outer(l + 1 / 2, omega))
+    dhi = weights @ ((l + 1 / 2)[:, None] * np.cos(np.outer(l + 1 / 2, omega)))
+    lo = np.sin(omega / 2)
+    dlo = 1 / 2 * np.cos(omega / 2)
+    dSigma = (lo * dhi - hi * dlo) / lo ** 2
+    return dSigma.reshape(np.shape(eps) + np.shape(omega)) / exp
 
 
-if os.path.exists(f'{package_folder_path}/.so3_omegas_array2.npy'):
-    _omegas_array = np.load(f'{package_folder_path}/.so3_omegas_array2.npy')
-    _cdf_vals = np.load(f'{package_folder_path}/.so3_cdf_vals2.npy')
-    _score_norms = np.load(f'{package_folder_path}/.so3_score_norms2.npy')
-    _exp_score_norms = np.load(f'{package_folder_path}/.so3_exp_score_norms2.npy')
-else:
-    _eps_array = 10 ** np.linspace(np.log10(MIN_EPS), np.log10(MAX_EPS), N_EPS)
-    _omegas_array = np.linspace(0, np.pi, X_N + 1)[1:]
+def _compute_tables():
+    eps_array = 10 ** np.linspace(np.log10(MIN_EPS), np.log10(MAX_EPS), N_EPS)
+    omegas_array = np.linspace(0, np.pi, X_N + 1)[1:]
 
-    _exp_vals = np.asarray([_expansion(_omegas_array, eps) for eps in _eps_array])
-    _pdf_vals = np.asarray([_density(_exp, _omegas_array, marginal=True) for _exp in _exp_vals])
-    _cdf_vals = np.asarray([_pdf.cumsum() / X_N * np.pi for _pdf in _pdf_vals])
-    _score_norms = np.asarray([_score(_exp_vals[i], _omegas_array, _eps_array[i]) for i in range(len(_eps_array))])
+    exp_vals = _expansion(omegas_array, eps_array)
+    pdf_vals = _density(exp_vals, omegas_array, marginal=True)
+    cdf_vals = pdf_vals.cumsum(axis=1) / X_N * np.pi
+    score_norms = _score(exp_vals, omegas_array, eps_array)
 
-    _exp_score_norms = np.sqrt(np.sum(_score_norms**2 * _pdf_vals, axis=1) / np.sum(_pdf_vals, axis=1) / np.pi)
+    exp_score_norms = np.sqrt(np.sum(score_norms**2 * pdf_vals, axis=1) / np.sum(pdf_vals, axis=1) / np.pi)
+    return {'omegas_array': omegas_array, 'cdf_vals': cdf_vals, 'score_norms': score_norms, 'exp_score_norms': exp_score_norms}
 
-    np.save(f'{package_folder_path}/.so3_omegas_array2.npy', _omegas_array)
-    np.save(f'{package_folder_path}/.so3_cdf_vals2.npy', _cdf_vals)
-    np.save(f'{package_folder_path}/.so3_score_norms2.npy', _score_norms)
-    np.save(f'{package_folder_path}/.so3_exp_score_norms2.npy', _exp_score_norms)
+
+_TABLE_FILES = {'omegas_array': '.so3_omegas_array2.npy', 'cdf_vals': '.so3_cdf_vals2.npy',
+                'score_norms': '.so3_score_norms2.npy', 'exp_score_norms': '.so3_exp_score_norms2.npy'}
+_tables = None
+
+
+def load_tables():
+    """The lookup tables, loaded (or computed) on first use so that importing this module stays cheap"""
+    global _tables
+    if _tables is None:
+        _tables = lookup_tables.load_tables(_TABLE_FILES, _compute_tables, '.so3_tables.lock')
+    return _tables
+
+
+def __getattr__(name):
+    # the module level arrays of older versions (so3._cdf_vals, ...) are still available, but loaded lazily
+    if name.startswith('_') and name[1:] in _TABLE_FILES:
+        return load_tables()[name[1:]]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def sample(eps):
     eps_idx = (np.log10(eps) - np.log10(MIN_EPS)) / (np.log10(MAX_EPS) - np.log10(MIN_EPS)) * N_EPS
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS - 1)
 
+    tables = load_tables()
     x = np.random.rand()
-    return np.interp(x, _cdf_vals[eps_idx], _omegas_array)
+    return np.interp(x, tables['cdf_vals'][eps_idx], tables['omegas_array'])
 
 
 def sample_vec(eps):
@@ -87,8 +97,9 @@ def score_vec(eps, vec):
     eps_idx = (np.log10(eps) - np.log10(MIN_EPS)) / (np.log10(MAX_EPS) - np.log10(MIN_EPS)) * N_EPS
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS - 1)
 
+    tables = load_tables()
     om = np.linalg.norm(vec)
-    return np.interp(om, _omegas_array, _score_norms[eps_idx]) * vec / om
+    return np.interp(om, tables['omegas_array'], tables['score_norms'][eps_idx]) * vec / om
 
 def sample_res(eps,n):
     return np.array([[sample(eps)] for _ in range(n)])
@@ -102,10 +113,11 @@ def sample_res_vec(eps, n):
 def score_res_vec(eps, vec):
     eps_idx = (np.log10(eps) - np.log10(MIN_EPS)) / (np.log10(MAX_EPS) - np.log10(MIN_EPS)) * N_EPS
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS - 1)
+    tables = load_tables()
     om = np.linalg.norm(vec,axis=-1,keepdims=True)
     interp_eps = []
     for i,e in enumerate(eps_idx):
-        interp_eps.append(np.interp(om[i], _omegas_array, _score_norms[e]))
+        interp_eps.append(np.interp(om[i], tables['omegas_array'], tables['score_norms'][e]))
     return np.array(interp_eps).reshape(-1,1) * vec / om
 
 
@@ -113,4 +125,4 @@ def score_norm(eps):
     eps = eps.numpy()
     eps_idx = (np.log10(eps) - np.log10(MIN_EPS)) / (np.log10(MAX_EPS) - np.log10(MIN_EPS)) * N_EPS
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS-1)
-    return torch.from_numpy(_exp_score_norms[eps_idx]).float()
+    return torch.from_numpy(load_tables()['exp_score_norms'][eps_idx]).float()
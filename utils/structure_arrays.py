@@ -0,0 +1,173 @@
+"""
+    Flat NumPy view of a receptor structure.
+
+    All atoms of the first model are stored once in a structured array (one row per atom, in Biopython iteration
+    order), so residue and chain level features can be computed with masked array operations instead of walking
+    the Biopython object tree atom by atom.
+"""
+import shlex
+from functools import lru_cache
+
+import numpy as np
+from Bio.Data.IUPACData import atom_weights
+
+ATOM_DTYPE = np.dtype([
+    ('chain_index', np.int32),
+    ('chain_id', 'U4'),
+    ('residue_index', np.int32),
+    ('hetfield', 'U8'),
+    ('resseq', np.int32),
+    ('icode', 'U1'),
+    ('resname', 'U5'),
+    ('name', 'U6'),
+    ('element', 'U2'),
+    ('coord', np.float32, (3,)),
+    ('occupancy', np.float32),
+])
+
+
+@lru_cache(maxsize=None)
+def _assign_element(element, name, fullname):
+    # same rules as Bio.PDB.Atom._assign_element, so elements match the ones of the parsed structure
+    if element and element.capitalize() in atom_weights:
+        return element
+    if fullname[0].isalpha() and not fullname[2:].isdigit():
+        putative_element = name.strip()
+    elif name[0].isdigit():
+        putative_element = name[1]
+    else:
+        putative_element = name[0]
+    if putative_element.capitalize() in atom_weights:
+        return putative_element
+    return 'X'
+
+
+def _hetfield(record, resname):
+    if record == 'HETATM':
+        return 'W' if resname in ('HOH', 'WAT') else 'H_' + resname
+    return ' '
+
+
+def _add_atom(chains, chain_id, res_id, resname, name, altloc, element, coord, occupancy):
+    # group atoms per chain and residue and keep the highest occupancy alternate location, like Biopython does
+    residue = chains.setdefault(chain_id, {}).setdefault(res_id, [resname, {}])
+    atoms = residue[1]
+    if name in atoms:
+        previous = atoms[name]
+        if altloc == ' ':
+            return
+        if occupancy > previous[3] or (previous[0] == ' ' and occupancy == previous[3]):
+            atoms[name] = (altloc, element, coord, occupancy)
+        return
+    atoms[name] = (altloc, element, coord, occupancy)
+
+
+def _read_pdb(path):
+    chains = {}
+    with open(path) as f:
+        for line in f:
+            record = line[0:6]
+            if record.rstrip() in ('END', 'ENDMDL'):
+                break
+            if record != 'ATOM  ' and record != 'HETATM':
+                continue
+            fullname = line[12:16]
+            split_name = fullname.split()
+            name = split_name[0] if len(split_name) == 1 else fullname
+            resname = line[17:20].strip()
+            res_id = (_hetfield(record, resname), int(line[22:26].split()[0]), line[26])
+            coord = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+            try:
+                occupancy = float(line[54:60])
+            except ValueError:
+                occupancy = 0.0
+            element = _assign_element(line[76:78].strip().upper(), name, fullname)
+            _add_atom(chains, line[21], res_id, resname, name, line[16], element, coord, occupancy)
+    return chains
+
+
+def _read_cif(path):
+    columns, rows = [], []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('_atom_site.'):
+                columns.append(line.strip())
+            elif columns:
+                line = line.strip()
+                if not line or line[0] in '#_' or line.startswith('loop_'):
+                    break
+                rows.append(shlex.split(line) if ('"' in line or "'" in line) else line.split())
+    col = {c[len('_atom_site.'):]: i for i, c in enumerate(columns)}
+    chain_col = col['auth_asym_id'] if 'auth_asym_id' in col else col['label_asym_id']
+    seq_col = col['auth_seq_id'] if 'auth_seq_id' in col else col['label_seq_id']
+    model_col = col.get('pdbx_PDB_model_num')
+    element_col = col.get('type_symbol')
+    chains = {}
+    first_model = rows[0][model_col] if rows and model_col is not None else None
+    for row in rows:
+        if model_col is not None and row[model_col] != first_model:
+            break
+        if row[seq_col] == '.':
+            continue
+        resname = row[col['label_comp_id']]
+        icode = row[col['pdbx_PDB_ins_code']]
+        altloc = row[col['label_alt_id']]
+        name = row[col['label_atom_id']]
+        res_id = (_hetfield(row[col['group_PDB']], resname), int(row[seq_col]), ' ' if icode in '.?' else icode)
+        coord = (float(row[col['Cartn_x']]), float(row[col['Cartn_y']]), float(row[col['Cartn_z']]))
+        element = _assign_element(row[element_col].upper() if element_col is not None else '', name, name)
+        _add_atom(chains, row[chain_col], res_id, resname, name, ' ' if altloc in '.?' else altloc, element, coord,
+                  float(row[col['occupancy']]))
+    return chains
+
+
+def read_structure_arrays(path):
+    """Read the first model of a .pdb or .cif file into an ATOM_DTYPE array without building a Biopython structure"""
+    chains = _read_cif(path) if path[-4:] == '.cif' else _read_pdb(path)
+    rows = []
+    residue_index = 0
+    for chain_index, (chain_id, residues) in enumerate(chains.items()):
+        for (hetfield, resseq, icode), (resname, atoms) in residues.items():
+            for name, (_, element, coord, occupancy) in atoms.items():
+                rows.append((chain_index, chain_id, residue_index, hetfield, resseq, icode, resname, name, element,
+                             coord, occupancy))
+            residue_index += 1
+    return np.array(rows, dtype=ATOM_DTYPE)
+
+
+def structure_to_arrays(model):
+    """Flatten a Biopython model (or the first model of a structure) into an ATOM_DTYPE array in a single pass"""
+    if model.level == 'S':
+        model = model[0]
+    rows = []
+    residue_index = 0
+    for chain_index, chain in enumerate(model):
+        chain_id = chain.get_id()
+        for residue in chain:
+            hetfield, resseq, icode = residue.get_id()
+            resname = residue.get_resname()
+            for atom in residue:
+                rows.append((chain_index, chain_id, residue_index, hetfield, resseq, icode, resname, atom.get_name(),
+                             atom.element, atom.coord, atom.occupancy or 0.0))
+            residue_index += 1
+    return np.array(rows, dtype=ATOM_DTYPE)
+
+
+def residue_starts(atoms):
+    """Index of the first atom of every residue"""
+    residue_index = atoms['residue_index']
+    return np.flatnonzero(np.r_[True, residue_index[1:] != residue_index[:-1]][:len(residue_index)])
+
+
+def atom_index_table(atoms, names):
+    """[n_residues, len(names)] table with the atom index of every requested atom name per residue, -1 if missing"""
+    names = np.asarray(names)
+    order = np.argsort(names)
+    position = np.searchsorted(names[order], atoms['name'])
+    position = np.minimum(position, len(names) - 1)
+    found = names[order][position] == atoms['name']
+    n_residues = len(residue_starts(atoms))
+    residue_number = np.cumsum(np.r_[False, atoms['residue_index'][1:] != atoms['residue_index'][:-1]])
+    table = np.full((n_residues, len(names)), -1, dtype=np.int64)
+    table[residue_number[found], order[position[found]]] = np.flatnonzero(found)
+    return table
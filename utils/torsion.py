@@ -1,14 +1,47 @@
-import networkx as nx
 import numpy as np
 import torch, copy
 from scipy.spatial.transform import Rotation as R
-from torch_geometric.utils import to_networkx
 from torch_geometric.data import Data
 
 import math
 import os
 from Bio import PDB
 
+from utils.structure_arrays import residue_starts, atom_index_table
+
+
+def _cross(a, b):
+    # same 2x2 determinants as Bio.PDB.vectors.Vector.__pow__, so the angles match calc_dihedral exactly
+    cols = [[1, 2], [0, 2], [0, 1]]
+    return np.linalg.det(np.stack([a[:, cols], b[:, cols]], axis=2)) * np.array([1., -1., 1.])
+
+
+def _dot(a, b):
+    ab = a * b
+    return ab[:, 0] + ab[:, 1] + ab[:, 2]
+
+
+def _angle(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = _dot(a, b) / (np.sqrt(_dot(a, a)) * np.sqrt(_dot(b, b)))
+    # same clipping as Bio.PDB.vectors.Vector.angle (min(c, 1) then max(-1, c))
+    c = np.where(1 < c, 1., c)
+    c = np.where(c > -1, c, -1.)
+    return np.arccos(c)
+
+
+def calc_dihedrals(p0, p1, p2, p3):
+    """Vectorised PDB.calc_dihedral over [n, 3] arrays of points"""
+    ab = p0 - p1
+    cb = p2 - p1
+    db = p3 - p2
+    u = _cross(ab, cb)
+    v = _cross(db, cb)
+    w = _cross(u, v)
+    angle = _angle(u, v)
+    return np.where(_angle(cb, w) > 0.001, -angle, angle)
+
+
 class get_sidechain_torsion(object):
     """
     Calculate side-chain torsion angles (also known as dihedral or chi angles).
@@ -174,41 +207,142 @@ class get_sidechain_torsion(object):
 
         return chi_list, mask+symmetry_mask
 
+    def calculate_torsions(self, atoms):
+        """calculate_torsion for every residue of an ATOM_DTYPE array (see utils.structure_arrays) at once"""
+        starts = residue_starts(atoms)
+        res_names = atoms['resname'][starts]
+        standard = atoms['hetfield'][starts] == ' '
+        n_res, n_chi = len(starts), len(self.chi_names)
+
+        # index tables: residue type -> chi -> 4 columns of the per residue atom table (-1 if the chi is not defined)
+        atom_names = sorted({a for chi in self.chi_names for atom_list in self.chi_atoms[chi].values() for a in atom_list})
+        name_column = {name: i for i, name in enumerate(atom_names)}
+        res_types, res_type_index = np.unique(res_names, return_inverse=True)
+        chi_table = np.full((len(res_types), n_chi, 4), -1, dtype=np.int64)
+        for r, res_name in enumerate(res_types):
+            for x, chi in enumerate(self.chi_names):
+                if res_name in self.chi_atoms[chi]:
+                    chi_table[r, x] = [name_column[a] for a in self.chi_atoms[chi][res_name]]
+        chi_columns = chi_table[res_type_index.reshape(-1)]
+        atom_table = atom_index_table(atoms, atom_names)
+        chi_atom_index = np.where(chi_columns >= 0,
+                                  atom_table[np.arange(n_res)[:, None, None], np.maximum(chi_columns, 0)], -1)
+
+        mask = (chi_atom_index >= 0).all(axis=-1) & standard[:, None]
+        coords = atoms['coord'].astype(np.float64)[chi_atom_index[mask]]
+        angle = calc_dihedrals(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3]) % (2 * np.pi)
+        if self.degrees:
+            angle = angle * (180.0 / math.pi)
+        chi_list = np.zeros((n_res, n_chi))
+        chi_list[mask] = angle
+        mask = mask.astype(np.int64)
+        symmetry_mask = np.zeros((n_res, 5), dtype=np.int64)
+
+        for alt_chi, (x, y) in (('altchi1', (0, 1)), ('altchi2', (2, 3))):
+            has_alt = standard & np.isin(res_names, list(self.chi_atoms[alt_chi]))
+            both = has_alt & (mask[:, x] == 1) & (mask[:, y] == 1)
+            max_angle = np.where(both, np.maximum(chi_list[:, x], chi_list[:, y]), 0)
+            min_angle = np.where(both, np.minimum(chi_list[:, x], chi_list[:, y]), 0)
+            chi_list[has_alt, x] = max_angle[has_alt]
+            chi_list[has_alt, y] = min_angle[has_alt]
+            mask[has_alt & ~both, x] = 0
+            mask[has_alt & ~both, y] = 0
+            if alt_chi == 'altchi2':
+                symmetry_mask[has_alt & (res_names != 'LEU'), 1] = 1
+
+        return chi_list, np.concatenate([mask, symmetry_mask], axis=1)
+
 """
     Preprocessing and computation for torsional updates to conformers
 """
 
 
+def _bridge_dfs(num_nodes, bonds):
+    """
+    One iterative DFS (Tarjan) over the undirected bond list. Returns the connected component of every node, the
+    preorder of the nodes, the preorder index, subtree size and subtree minimum of every node, and for every bond
+    the child node if the bond is a bridge (-1 otherwise).
+    """
+    adjacency = [[] for _ in range(num_nodes)]
+    for b, (u, v) in enumerate(bonds):
+        adjacency[u].append((v, b))
+        adjacency[v].append((u, b))
+    component = np.full(num_nodes, -1)
+    tin = np.full(num_nodes, -1)
+    low = np.zeros(num_nodes, dtype=int)
+    size = np.ones(num_nodes, dtype=int)
+    sub_min = np.arange(num_nodes)
+    bridge_child = np.full(len(bonds), -1)
+    preorder = []
+    for root in range(num_nodes):
+        if tin[root] != -1:
+            continue
+        comp = component.max() + 1
+        tin[root] = low[root] = len(preorder)
+        component[root] = comp
+        preorder.append(root)
+        stack = [(root, -1, iter(adjacency[root]))]
+        while stack:
+            node, parent_bond, neighbors = stack[-1]
+            for nxt, b in neighbors:
+                if b == parent_bond:
+                    continue
+                if tin[nxt] == -1:
+                    tin[nxt] = low[nxt] = len(preorder)
+                    component[nxt] = comp
+                    preorder.append(nxt)
+                    stack.append((nxt, b, iter(adjacency[nxt])))
+                    break
+                low[node] = min(low[node], tin[nxt])
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    size[parent] += size[node]
+                    sub_min[parent] = min(sub_min[parent], sub_min[node])
+                    if low[node] > tin[parent]:
+                        bridge_child[parent_bond] = node
+    return component, np.asarray(preorder, dtype=int), tin, size, sub_min, bridge_child
+
+
 def get_transformation_mask(pyg_data):
-    G = to_networkx(pyg_data.to_homogeneous(), to_undirected=False)
-    to_rotate = []
+    num_nodes = pyg_data['ligand'].num_nodes
     edges = pyg_data['ligand', 'ligand'].edge_index.T.numpy()
     edges_attr = pyg_data['ligand', 'ligand'].edge_attr.numpy()
-    for i in range(0, edges.shape[0], 2):
-        assert edges[i, 0] == edges[i+1, 1]
-        G2 = G.to_undirected()
-        G2.remove_edge(*edges[i])
-        if not nx.is_connected(G2) and edges_attr[i, 0] == 1:
-            l = list(sorted(nx.connected_components(G2), key=len)[0])
-            if len(l) > 1:
-                if edges[i, 0] in l:
-                    to_rotate.append([])
-                    to_rotate.append(l)
-                else:
-                    to_rotate.append(l)
-                    to_rotate.append([])
-                continue
-        to_rotate.append([])
-        to_rotate.append([])
+    assert (edges[0::2, 0] == edges[1::2, 1]).all()
+    component, preorder, tin, size, sub_min, bridge_child = _bridge_dfs(num_nodes, edges[0::2])
 
-    mask_edges = np.asarray([0 if len(l) == 0 else 1 for l in to_rotate], dtype=bool)
-    mask_rotate = np.zeros((np.sum(mask_edges), len(G.nodes())), dtype=bool)
-    idx = 0
-    for i in range(len(G.edges())):
-        if mask_edges[i]:
-            mask_rotate[idx][np.asarray(to_rotate[i], dtype=int)] = True
-            idx += 1
+    # removing a bond leaves the components of the ligand as they are unless the bond is a bridge, in which case
+    # its component is split in two. The rotated side is the smallest resulting component (ties go to the one with
+    # the lowest atom index), which is only the side of the bond itself when the ligand is a single fragment
+    comp_size = np.bincount(component, minlength=component.max() + 1)
+    comp_min = np.array([np.flatnonzero(component == c)[0] for c in range(len(comp_size))])
+    comp_order = sorted(range(len(comp_size)), key=lambda c: (comp_size[c], comp_min[c]))
+
+    mask_edges = np.zeros(edges.shape[0], dtype=bool)
+    mask_rotate = []
+    for i in range(0, edges.shape[0], 2):
+        if edges_attr[i, 0] != 1 or (len(comp_size) == 1 and bridge_child[i // 2] == -1):
+            continue
+        candidates = []  # (size, lowest atom, atoms)
+        child = bridge_child[i // 2]
+        split = -1 if child == -1 else component[child]
+        for c in comp_order:
+            if c != split:
+                candidates.append((comp_size[c], comp_min[c], component == c))
+                break
+        if split != -1:
+            subtree = np.zeros(num_nodes, dtype=bool)
+            subtree[preorder[tin[child]:tin[child] + size[child]]] = True
+            candidates.append((size[child], sub_min[child], subtree))
+            candidates.append((comp_size[split] - size[child], comp_min[split], (component == split) & ~subtree))
+        _, _, l = min(candidates, key=lambda x: (x[0], x[1]))
+        if l.sum() > 1:
+            mask_edges[i + 1 if l[edges[i, 0]] else i] = True
+            mask_rotate.append(l)
 
+    mask_rotate = np.asarray(mask_rotate, dtype=bool).reshape(-1, num_nodes)
     return mask_edges, mask_rotate
 
 
@@ -1,29 +1,35 @@
 import numpy as np
-import tqdm
-import os
 
-file_path = os.path.realpath(__file__)
-script_folder = os.path.dirname(file_path)
-package_folder_path = os.path.dirname(script_folder)
+from utils import lookup_tables
 
 """
     Preprocessing for the SO(2)/torus sampling and score computations, truncated infinite series are computed and then
-    cached to memory, therefore the precomputation is only run the first time the repository is run on a machine
+    cached to disk (see utils/lookup_tables.py), therefore the precomputation is only run the first time the tables are
+    needed on a machine
 """
 
 
-def p(x, sigma, N=10):
-    p_ = 0
-    for i in tqdm.trange(-N, N + 1):
-        p_ += np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / sigma ** 2)
-    return p_
-
-
-def grad(x, sigma, N=10):
-    p_ = 0
-    for i in tqdm.trange(-N, N + 1):
-        p_ += (x + 2 * np.pi * i) / sigma ** 2 * np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / sigma ** 2)
-    return p_
+def _wrapped_normal(x, sigma, N=10, block=64):
+    """
+    Density of the wrapped normal and its gradient, summed over the periodic images -N..N, on the grid of sigma (rows)
+    and x (columns), with x in [0, pi]. Rows are done in blocks, and the images whose terms are exactly 0. in float64
+    for every entry of a block (exponent below -750) are skipped, which leaves the sums unchanged.
+    """
+    p_ = np.empty((len(sigma), len(x)))
+    grad_ = np.empty((len(sigma), len(x)))
+    for start in range(0, len(sigma), block):
+        s = sigma[start:start + block, None]
+        p_block, grad_block = 0, 0
+        for i in range(-N, N + 1):
+            closest = 2 * np.pi * i + x.min() if i >= 0 else -2 * np.pi * i - x.max()
+            if closest ** 2 / 2 / s.max() ** 2 > 750:
+                continue
+            term = np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / s ** 2)
+            p_block += term
+            grad_block += (x + 2 * np.pi * i) / s ** 2 * term
+        p_[start:start + block] = p_block
+        grad_[start:start + block] = grad_block
+    return p_, grad_
 
 
 X_MIN, X_N = 1e-5, 5000  # relative to pi
@@ -32,15 +38,32 @@ SIGMA_MIN, SIGMA_MAX, SIGMA_N = 3e-3, 2, 5000  # relative to pi
 x = 10 ** np.linspace(np.log10(X_MIN), 0, X_N + 1) * np.pi
 sigma = 10 ** np.linspace(np.log10(SIGMA_MIN), np.log10(SIGMA_MAX), SIGMA_N + 1) * np.pi
 
-if os.path.exists(f'{package_folder_path}/.p.npy'):
-    p_ = np.load(f'{package_folder_path}/.p.npy')
-    score_ = np.load(f'{package_folder_path}/.score.npy')
-else:
-    p_ = p(x, sigma[:, None], N=100)
-    np.save(f'{package_folder_path}/.p.npy', p_)
 
-    score_ = grad(x, sigma[:, None], N=100) / p_
-    np.save(f'{package_folder_path}/.score.npy', score_)
+def _compute_tables():
+    p_, grad_ = _wrapped_normal(x, sigma, N=100)
+    return {'p': p_, 'score': grad_ / p_}
+
+
+_TABLE_FILES = {'p': '.p.npy', 'score': '.score.npy'}
+_tables = None
+_score_norm = None
+
+
+def load_tables():
+    """The lookup tables, loaded (or computed) on first use so that importing this module stays cheap"""
+    global _tables
+    if _tables is None:
+        _tables = lookup_tables.load_tables(_TABLE_FILES, _compute_tables, '.torus_tables.lock')
+    return _tables
+
+
+def __getattr__(name):
+    # the module level arrays of older versions (torus.p_, torus.score_, torus.score_norm_) are loaded lazily
+    if name == 'score_norm_':
+        return _score_norms()
+    if name.endswith('_') and name[:-1] in _TABLE_FILES:
+        return load_tables()[name[:-1]]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def score(x, sigma):
@@ -52,7 +75,7 @@ def score(x, sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return -sign * score_[sigma, x]
+    return -sign * load_tables()['score'][sigma, x]
 
 
 def p(x, sigma):
@@ -63,7 +86,7 @@ def p(x, sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return p_[sigma, x]
+    return load_tables()['p'][sigma, x]
 
 
 def sample(sigma):
@@ -72,15 +95,22 @@ def sample(sigma):
     return out
 
 
-score_norm_ = score(
-    sample(sigma[None].repeat(10000, 0).flatten()),
-    sigma[None].repeat(10000, 0).flatten()
-).reshape(10000, -1)
-score_norm_ = (score_norm_ ** 2).mean(0)
+def _score_norms(samples=10000, chunk=1000):
+    """Mean squared score for every sigma of the grid. Uses its own seeded generator, not the global numpy one"""
+    global _score_norm
+    if _score_norm is None:
+        rng = np.random.RandomState(0)
+        total = np.zeros(len(sigma))
+        for _ in range(samples // chunk):
+            sigmas = sigma[None].repeat(chunk, 0).flatten()
+            draws = (sigmas * rng.randn(*sigmas.shape) + np.pi) % (2 * np.pi) - np.pi
+            total += (score(draws, sigmas).reshape(chunk, -1) ** 2).sum(0)
+        _score_norm = total / (samples // chunk * chunk)
+    return _score_norm
 
 
 def score_norm(sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return score_norm_[sigma]
+    return _score_norms()[sigma]
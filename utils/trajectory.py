@@ -0,0 +1,65 @@
+"""
+    Compact reverse diffusion trajectories for --save_visualisation.
+
+    Only the quantities that change during sampling are kept per step: the ligand positions, the residue frames
+    (lf_3pts) and the accumulated side chain torsions (acc_pred_chis). Everything else is stored once per complex as a
+    reference receptor and ligand file, and the frames are rebuilt from those with modify_pdb_from_arrays.
+"""
+import os
+
+import numpy as np
+from rdkit import Chem
+from Bio.PDB import PDBParser, MMCIFParser, PDBIO, MMCIFIO
+
+
+def trajectory_path(write_dir, rank):
+    return os.path.join(write_dir, f'rank{rank}_reverseprocess.npz')
+
+
+def reference_receptor_path(write_dir, pdb_or_cif):
+    return os.path.join(write_dir, f'reverseprocess_receptor.{pdb_or_cif}')
+
+
+def reference_ligand_path(write_dir):
+    return os.path.join(write_dir, 'reverseprocess_ligand.sdf')
+
+
+def trajectory_frame(complex_graph):
+    """The per step state of one sample, as (ligand_pos, lf_3pts, acc_pred_chis) arrays"""
+    return (complex_graph['ligand'].pos.detach().cpu().numpy().astype(np.float32),
+            complex_graph['receptor'].lf_3pts.detach().cpu().numpy().astype(np.float32),
+            complex_graph['receptor'].acc_pred_chis.detach().cpu().numpy().astype(np.float16))
+
+
+def save_trajectory(path, frames, complex_graph):
+    """Stack the frames of one sample into a single .npz. complex_graph provides the step independent data"""
+    ligand_pos, lf_3pts, acc_pred_chis = zip(*frames)
+    np.savez_compressed(path,
+                        ligand_pos=np.stack(ligand_pos),
+                        lf_3pts=np.stack(lf_3pts),
+                        acc_pred_chis=np.stack(acc_pred_chis),
+                        chi_masks=complex_graph['receptor'].chi_masks.cpu().numpy()[:, [0, 2, 4, 5, 6]].astype(bool),
+                        original_center=complex_graph.original_center.cpu().numpy().reshape(3).astype(np.float32))
+
+
+def load_trajectory(path):
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def save_reference_structures(write_dir, lig, receptor_pdb, pdb_or_cif):
+    """Write the receptor and ligand every trajectory frame of this complex is rebuilt from, once per complex"""
+    io = MMCIFIO() if pdb_or_cif == 'cif' else PDBIO()
+    io.set_structure(receptor_pdb)
+    io.save(reference_receptor_path(write_dir, pdb_or_cif))
+    Chem.MolToMolFile(lig, reference_ligand_path(write_dir))
+
+
+def load_reference_structures(write_dir):
+    pdb_or_cif = 'cif' if os.path.exists(reference_receptor_path(write_dir, 'cif')) else 'pdb'
+    receptor_file = reference_receptor_path(write_dir, pdb_or_cif)
+    parser = MMCIFParser(QUIET=True) if pdb_or_cif == 'cif' else PDBParser(QUIET=True)
+    receptor_pdb = parser.get_structure(pdb_or_cif, receptor_file)
+    lig = Chem.MolFromMolFile(reference_ligand_path(write_dir), sanitize=False, removeHs=False)
+    lig.UpdatePropertyCache(strict=False)
+    return lig, receptor_pdb, pdb_or_cif
@@ -11,12 +11,10 @@ import torch
 import yaml
 from rdkit import Chem
 from rdkit.Chem import RemoveHs, MolToPDBFile
-from torch_geometric.nn.data_parallel import DataParallel
 
-from models.all_atom_score_model import TensorProductScoreModel as AAScoreModel
-from models.score_model import TensorProductScoreModel as CGScoreModel
 from utils.diffusion_utils import get_timestep_embedding
-from spyrmsd import rmsd, molecule
+# the score models (e3nn), DataParallel and spyrmsd are imported by the functions that use them, so that importing
+# this module for its helpers stays cheap
 
 
 def get_obrmsd(mol1_path, mol2_path, cache_name=None):
@@ -87,9 +85,9 @@ def get_optimizer_and_scheduler(args, model, scheduler_mode='min'):
 
 def get_model(args, device, t_to_sigma, no_parallel=False, confidence_mode=False):
     if 'all_atoms' in args and args.all_atoms:
-        model_class = AAScoreModel
+        from models.all_atom_score_model import TensorProductScoreModel as model_class
     else:
-        model_class = CGScoreModel
+        from models.score_model import TensorProductScoreModel as model_class
 
     timestep_emb_func = get_timestep_embedding(
         embedding_type=args.embedding_type,
@@ -122,12 +120,14 @@ def get_model(args, device, t_to_sigma, no_parallel=False, confidence_mode=False
                             args.rmsd_classification_cutoff, list) else 1)
 
     if device.type == 'cuda' and not no_parallel:
+        from torch_geometric.nn.data_parallel import DataParallel
         model = DataParallel(model)
     model.to(device)
     return model
 
 
 def get_symmetry_rmsd(mol, coords1, coords2, mol2=None):
+    from spyrmsd import rmsd, molecule
     with time_limit(10):
         mol = molecule.Molecule.from_rdkit(mol)
         mol2 = molecule.Molecule.from_rdkit(mol2) if mol2 is not None else mol2
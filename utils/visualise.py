@@ -250,11 +250,16 @@ pdb_records = {
 
 def modify_pdb(ppdb, data):
     # ppdb, data = params
-    pred_chis, chi_masks = data['receptor'].acc_pred_chis.cpu().numpy(),data['receptor'].chi_masks.cpu().numpy()
-    chi_masks = chi_masks[:,[0,2,4,5,6]]
-    new_df = []
+    return modify_pdb_from_arrays(ppdb, data['receptor'].lf_3pts, data['receptor'].acc_pred_chis.cpu().numpy(),
+                                  data['receptor'].chi_masks.cpu().numpy()[:,[0,2,4,5,6]], data.original_center)
+
+def modify_pdb_from_arrays(ppdb, lf_3pts, pred_chis, chi_masks, original_center):
+    # same as modify_pdb, but from the arrays stored in a trajectory file (see utils/trajectory.py)
+    lf_3pts = torch.as_tensor(lf_3pts).float()
+    original_center = torch.as_tensor(original_center).float().reshape(1, 3)
+    pred_chis = np.asarray(pred_chis, dtype=np.float32)
     i = 0
-    pred_lf = T.from_3_points(p_xy_plane=data['receptor'].lf_3pts[:,0,:],origin=data['receptor'].lf_3pts[:,1,:],p_neg_x_axis=data['receptor'].lf_3pts[:,2,:])
+    pred_lf = T.from_3_points(p_xy_plane=lf_3pts[:,0,:],origin=lf_3pts[:,1,:],p_neg_x_axis=lf_3pts[:,2,:])
     all_res = list(ppdb.get_residues())
     for res_idx,res in enumerate(all_res):
         if res.resname == 'HOH':
@@ -267,7 +272,7 @@ def modify_pdb(ppdb, data):
         all_atom = torch.tensor(np.stack([atom.coord for atom in res.get_atoms()])).float()
         lf = T.from_3_points(p_xy_plane=n,origin=c_alpha,p_neg_x_axis=c)
         lf_all_atom = lf.invert_apply(all_atom)
-        pred_all_atom = pred_lf[res_idx].apply(lf_all_atom) + data.original_center
+        pred_all_atom = pred_lf[res_idx].apply(lf_all_atom) + original_center
         i = 0
         for atom in res.get_atoms():
             atom.set_coord(pred_all_atom[i])
@@ -0,0 +1,121 @@
+"""
+    Output writers (inference.py --writers): writing the structures of a docked ligand (the ligand and receptor file of
+    every sample, the clash scores and the final ranking) runs on the CPU in separate processes, while the sampling
+    process goes on with the next ligand. The sampling process only hands over the coordinates, frames and scores as
+    numpy arrays. The writers are forked once the ligands are preprocessed, so they already have the ligands and the
+    receptors the structures are built from.
+
+    The queue of payloads is bounded: when the writers fall behind, submit() blocks the sampling process until a
+    writer takes the next payload, so the payloads waiting in memory stay limited.
+"""
+import multiprocessing
+import os
+import queue
+import traceback
+
+from utils.pool import TASK_OK, TASK_ERROR
+
+
+def _writer_loop(tasks, results, lock, init, write):
+    if init is not None:
+        init()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key, payload = task
+        try:
+            result = (key, TASK_OK, write(payload))
+        except Exception as e:
+            traceback.print_exc()
+            result = (key, TASK_ERROR, f'{type(e).__name__}: {e}')
+        # straight into the pipe: a result left in the buffer of a Queue would be lost if the writer dies afterwards
+        with lock:
+            results.send(result)
+    results.close()
+
+
+def _exited(pid):
+    # only the process that started the writers can join them, the other processes (sampling workers, see
+    # utils/devices.py) look at their state in /proc
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] in ('Z', 'X')
+    except OSError:
+        return True
+
+
+class OutputWriter:
+    """
+    Runs write(payload) in `processes` forked writer processes, with at most max_pending payloads (twice the number of
+    writers by default) waiting for a writer. init() is called once in every writer. Processes forked after the
+    writers can submit payloads as well, the results are only read by the process that started the writers: finished()
+    and close() yield (key, status, result) tuples with the statuses of utils/pool.py.
+    """
+
+    def __init__(self, processes, write, init=None, max_pending=None):
+        context = multiprocessing.get_context('fork')
+        processes = max(1, processes)
+        self.tasks = context.Queue(max_pending or 2 * processes)
+        self.results, results = context.Pipe(duplex=False)
+        lock = context.Lock()
+        self.processes = [context.Process(target=_writer_loop, args=(self.tasks, results, lock, init, write), daemon=True)
+                          for _ in range(processes)]
+        for process in self.processes:
+            process.start()
+        results.close()
+        self.owner = os.getpid()
+
+    def alive(self):
+        if os.getpid() == self.owner:
+            return any(process.is_alive() for process in self.processes)
+        return not all(_exited(process.pid) for process in self.processes)
+
+    def _put(self, task):
+        while True:
+            try:
+                self.tasks.put(task, timeout=1)
+                return
+            except queue.Full:
+                if not self.alive():
+                    raise RuntimeError('All output writers exited')
+
+    def submit(self, key, payload):
+        """Queues payload for the next free writer, blocks while max_pending payloads are waiting"""
+        self._put((key, payload))
+
+    def finished(self):
+        """The results that are ready, without waiting for the others"""
+        try:
+            while self.results.poll():
+                yield self.results.recv()
+        except EOFError:
+            # every writer exited, close() reports the rest
+            return
+
+    def close(self):
+        """Waits for the writers to finish the queued payloads and yields their results"""
+        try:
+            for _ in self.processes:
+                self._put(None)
+        except RuntimeError:
+            pass
+        while True:
+            try:
+                if self.results.poll(1):
+                    yield self.results.recv()
+                    continue
+            except EOFError:
+                # every writer exited
+                break
+            # a payload that was taken by a writer that died is never reported
+            if not self.alive():
+                break
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.kill()
+            process.join()